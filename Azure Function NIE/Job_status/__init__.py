@@ -0,0 +1,20 @@
+import logging
+import json
+import azure.functions as func
+from shared_code import jobs, outline
+
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Python HTTP trigger function processed a request.')
+
+    job_id = req.route_params.get('job_id')
+    job = jobs.get(job_id) if job_id else None
+
+    if job is None:
+        return func.HttpResponse(json.dumps({"error": f"Job '{job_id}' not found"}), mimetype="application/json", status_code=404)
+
+    if isinstance(job.get("result"), str):
+        # The outline JSON parsed, like the synchronous response
+        job["outline"] = outline.loads(job["result"])
+
+    return func.HttpResponse(json.dumps(job), mimetype="application/json")
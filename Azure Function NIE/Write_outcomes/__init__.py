@@ -0,0 +1,10 @@
+import logging
+import azure.functions as func
+from shared_code import outbox
+
+
+def main(msg: func.QueueMessage) -> None:
+    # Outcomes queued by the chat functions, see shared_code/outbox.py. Raising leaves the message
+    # in the queue for another attempt.
+    logging.info(f"Writing outcome from queue message {msg.id}, attempt {msg.dequeue_count}")
+    outbox.write(msg.get_body().decode())
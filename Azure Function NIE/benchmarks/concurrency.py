@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+
+# Sync against async chat pipeline under concurrency. The same burst of requests goes to the
+# function's main() on one event loop, first with the blocking pipeline on a pool of --threads
+# threads (what a synchronous Python function gets from the worker) and then with ASYNC_PIPELINE,
+# where every request waits on the network without a thread of its own. For example:
+#
+#   python benchmarks/concurrency.py --levels 4,16,64 --threads 8 --token-ms 2
+#
+# Reports throughput, latency and the most threads alive per mode and concurrency level.
+
+from run import APP_ROOT, configure_environment, distribution, flush_outbox, load_function, make_request, secrets  # noqa: E402
+from fake_services import FakeServices, StaticTokenCredential  # noqa: E402
+
+MODES = ["sync", "async"]
+
+
+async def timed(module, request):
+    start = time.perf_counter()
+    try:
+        response = await module.main(request)
+        error = None if response.status_code < 400 else response.get_body().decode(errors="replace")[:200]
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return {"latency_ms": (time.perf_counter() - start) * 1000, "error": error}
+
+
+def function_threads():
+    # The fakes run in this process too, their server threads don't count
+    return sum(1 for thread in threading.enumerate() if "serve_forever" not in thread.name and "process_request" not in thread.name)
+
+
+async def count_threads(peak, stop):
+    while not stop.is_set():
+        peak[0] = max(peak[0], function_threads())
+        await asyncio.sleep(0.02)
+
+
+async def run_level(module, mode, level, args):
+    from shared_code import async_pipeline
+
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=args.threads))
+    async_pipeline.ASYNC_PIPELINE = mode == "async"
+    requests = [make_request(args.function, f"{mode}-{level}-{i}", None) for i in range(level)]
+
+    peak, stop = [function_threads()], asyncio.Event()
+    sampler = asyncio.ensure_future(count_threads(peak, stop))
+    start = time.perf_counter()
+    results = await asyncio.gather(*(timed(module, request) for request in requests))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await sampler
+    await async_pipeline.close_clients()
+
+    succeeded = [r for r in results if r["error"] is None]
+    errors = {}
+    for r in results:
+        if r["error"] is not None:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return {
+        "requests": level,
+        "succeeded": len(succeeded),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(succeeded) / elapsed, 3) if elapsed else None,
+        "latency_ms": distribution([r["latency_ms"] for r in succeeded]),
+        "peak_threads": peak[0],
+        "errors": errors,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare the sync and async chat pipelines under concurrency.")
+    parser.add_argument("--function", default="Alex_Chatgpt-4", help="Chat function to call")
+    parser.add_argument("--levels", default="4,16,64", help="Comma separated numbers of requests sent at once")
+    parser.add_argument("--threads", type=int, default=8, help="Threads the sync pipeline may use, like PYTHON_THREADPOOL_THREAD_COUNT")
+    parser.add_argument("--token-ms", type=float, default=2, help="Fake generation time per completion token")
+    parser.add_argument("--completion-tokens", type=int, default=200, help="Length of every fake completion")
+    parser.add_argument("--modes", default=",".join(MODES), help="Comma separated modes to run, in this order")
+    parser.add_argument("--output", help="Result file, defaults to benchmarks/results/concurrency-<timestamp>.json")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # Every request pays for the whole pipeline
+    args.cold = True
+
+    with tempfile.TemporaryDirectory() as directory:
+        services = FakeServices(directory, secrets=secrets(), token_ms=args.token_ms, completion_tokens=args.completion_tokens).start()
+        try:
+            configure_environment(services, directory, args)
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+            from azure.keyvault.secrets import SecretClient
+            from shared_code import config
+
+            config._client = SecretClient(vault_url=config.KEYVAULT_URL, credential=StaticTokenCredential(), verify_challenge_resource=False)
+
+            module = load_function(args.function)
+            report = {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "settings": vars(args),
+                "modes": {},
+            }
+            for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+                report["modes"][mode] = {}
+                for level in [int(n) for n in args.levels.split(",") if n.strip()]:
+                    report["modes"][mode][level] = asyncio.run(run_level(module, mode, level, args))
+            flush_outbox()
+            report["services"] = services.stats()
+        finally:
+            services.stop()
+
+    output = args.output or os.path.join(APP_ROOT, "benchmarks", "results", time.strftime("concurrency-%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for mode, levels in report["modes"].items():
+        print(f"\n{mode} ({args.threads} threads for the sync pipeline)")
+        for level, result in levels.items():
+            latency = result["latency_ms"]
+            print(f"  {level:>4} at once: {result['succeeded']}/{result['requests']} ok, {result['throughput_rps']} req/s, "
+                  f"p50 {latency['p50']} ms, p95 {latency['p95']} ms, {result['peak_threads']} threads")
+            for error, count in result["errors"].items():
+                print(f"       {count} x {error}")
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,722 @@
+import datetime
+import hashlib
+import ipaddress
+import json
+import math
+import os
+import random
+import re
+import ssl
+import threading
+import time
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# Local stand-ins for Azure OpenAI, Cognitive Search, Cosmos DB, Blob Storage and Key Vault.
+# They speak just enough of each REST API for the SDKs the functions use, keep their data
+# in memory and can be made slow or flaky, see Faults.
+
+EMBEDDING_DIMENSIONS = 1536
+
+
+class Faults:
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, error_status=503, retry_after=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+
+    @classmethod
+    def parse(cls, spec):
+        # "latency_ms=200,jitter_ms=50,error_rate=0.05,error_status=429,retry_after=1"
+        values = {}
+        for part in (spec or "").split(","):
+            if part.strip():
+                name, value = part.split("=", 1)
+                values[name.strip()] = float(value) if name.strip() in ("error_rate", "retry_after") else int(value)
+        return cls(**values)
+
+    def delay(self, extra_ms=0):
+        seconds = (self.latency_ms + extra_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def error(self):
+        return self.error_status if random.random() < self.error_rate else None
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class Quota:
+    # Tokens and requests per minute of every deployment, enforced like Azure OpenAI does: a call
+    # costs its prompt plus max_tokens up front and the buckets refill continuously. 0 is unlimited.
+    def __init__(self, tpm=0, rpm=0):
+        self.tpm = tpm
+        self.rpm = rpm
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def charge(self, deployment, tokens):
+        # (seconds until the call would fit or 0 when it was accepted, rate limit headers)
+        with self._lock:
+            now = time.monotonic()
+            tokens_left, requests_left, updated = self._buckets.get(deployment, (self.tpm, self.rpm, now))
+            tokens_left = min(self.tpm, tokens_left + (now - updated) * self.tpm / 60)
+            requests_left = min(self.rpm, requests_left + (now - updated) * self.rpm / 60)
+            tokens = min(tokens, self.tpm)
+            wait = 0
+            if self.tpm and tokens_left < tokens:
+                wait = (tokens - tokens_left) * 60 / self.tpm
+            if self.rpm and requests_left < 1:
+                wait = max(wait, (1 - requests_left) * 60 / self.rpm)
+            if not wait:
+                tokens_left -= tokens if self.tpm else 0
+                requests_left -= 1 if self.rpm else 0
+            self._buckets[deployment] = (tokens_left, requests_left, now)
+        headers = {}
+        if self.tpm:
+            headers["x-ratelimit-remaining-tokens"] = str(int(tokens_left))
+        if self.rpm:
+            headers["x-ratelimit-remaining-requests"] = str(int(requests_left))
+        if wait:
+            headers["Retry-After"] = str(math.ceil(wait))
+            headers["retry-after-ms"] = str(int(wait * 1000))
+        return wait, headers
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def as_dict(self):
+        return {"tpm": self.tpm, "rpm": self.rpm}
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    # Keep-alive like the real services, the SDKs pool their connections
+    protocol_version = "HTTP/1.1"
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        self.route = unquote(url.path)
+        self.query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = self.rfile.read(length) if length else b""
+
+        server = self.server
+        server.count(method, self.route)
+        if self.authenticate():
+            server.faults.delay()
+            status = server.faults.error()
+            if status:
+                server.count_error(status)
+                self.send_error_response(status)
+            else:
+                getattr(self, "do_" + method.lower() + "_request")()
+
+    def authenticate(self):
+        return True
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def json_body(self):
+        return json.loads(self.body or b"{}")
+
+    def send(self, status, body=b"", content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_error_response(self, status):
+        headers = {}
+        if self.server.faults.retry_after is not None:
+            headers["Retry-After"] = str(self.server.faults.retry_after)
+        self.send(status, {"error": {"code": str(status), "message": f"Injected error from the fake {self.service}"}}, headers=headers)
+
+    def do_get_request(self):
+        self.send(404, {"error": {"code": "NotFound", "message": self.route}})
+
+    do_head_request = do_post_request = do_put_request = do_delete_request = do_get_request
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The async clients open many connections at once, the default backlog of 5 drops them
+    request_queue_size = 256
+
+    def __init__(self, handler, faults, ssl_context):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.faults = faults
+        self.socket = ssl_context.wrap_socket(self.socket, server_side=True)
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.errors = {}
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"https://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, method, route):
+        # "/openai/deployments/gpt-4/chat/completions" -> "POST /openai/deployments/*/chat/completions"
+        key = method + " " + re.sub(r"/(deployments|dbs|colls|docs|secrets|indexes\('[^']*'\))/[^/]+", r"/\1/*", route)
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def count_error(self, status):
+        with self._lock:
+            self.errors[str(status)] = self.errors.get(str(status), 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {"faults": self.faults.as_dict(), "requests": dict(self.requests), "injected_errors": dict(self.errors)}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def fake_vector(text):
+    # The same text always gets the same unit vector
+    rng = random.Random(hashlib.sha256(text.encode()).digest())
+    vector = [rng.gauss(0, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+    norm = sum(v * v for v in vector) ** 0.5
+    return [v / norm for v in vector]
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def fake_outline(weeks):
+    return json.dumps({
+        "Course synopsis": "A course about giving feedback on student writing.",
+        "ILOs for entire course": ["Students will be able to evaluate a peer's essay using a rubric with specific comments."],
+        "TE21": {"Values": ["Commitment to the learner"], "Skills": ["Communication skills"], "Knowledge": ["Educational foundation & policies"]},
+        "Week": [{
+            "Week": week,
+            "Course topics": f"Topic of week {week}",
+            "ILOs achieved": "1",
+            "ATs": "Short written reflection",
+            "TLAs": "Think-pair-share on sample essays, building on the previous lesson",
+            "Ed tech tools": "Padlet",
+            "Other learning resources": "Readings",
+            "Mode of learning": "Online" if week % 2 else "Face-to-face"
+        } for week in range(1, weeks + 1)]
+    }, indent=4)
+
+
+class OpenAIHandler(FakeHandler):
+    service = "Azure OpenAI"
+    # Generation speed of the fake model and how long its answers are
+    token_ms = 0
+    completion_tokens = 200
+    # Answers to prompts asking for JSON are an outline, cut off at max_tokens like the real thing
+    outline_weeks = 10
+    quota = None
+
+    def over_quota(self, deployment, tokens):
+        # Answers the 429 when the call doesn't fit, otherwise returns the headers for the answer
+        if self.quota is None:
+            return {}
+        wait, headers = self.quota.charge(deployment, tokens)
+        if wait:
+            self.server.count_error(429)
+            self.send(429, {"error": {"code": "429", "message": f"Requests to the {deployment} deployment have exceeded the rate limit. Please retry after {headers['Retry-After']} seconds."}}, headers=headers)
+            return None
+        return headers
+
+    def do_post_request(self):
+        match = re.match(r"/openai/deployments/([^/]+)/(chat/completions|embeddings)$", self.route)
+        if not match:
+            return self.do_get_request()
+        deployment, operation = match.groups()
+        body = self.json_body()
+        if operation == "embeddings":
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            tokens = sum(estimate_tokens(text) for text in inputs)
+            headers = self.over_quota(deployment, tokens)
+            if headers is None:
+                return
+            return self.send(200, {
+                "object": "list",
+                "model": deployment,
+                "data": [{"object": "embedding", "index": i, "embedding": fake_vector(text)} for i, text in enumerate(inputs)],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+            }, headers=headers)
+
+        prompt_tokens = sum(estimate_tokens(message.get("content") or "") for message in body["messages"])
+        completion_tokens = min(self.completion_tokens, body.get("max_tokens") or self.completion_tokens)
+        headers = self.over_quota(deployment, prompt_tokens + (body.get("max_tokens") or self.completion_tokens))
+        if headers is None:
+            return
+        time.sleep(completion_tokens * self.token_ms / 1000)
+        words = [f"word{i}" for i in range(completion_tokens)]
+        if "json" in (body["messages"][-1].get("content") or "").lower():
+            words = fake_outline(self.outline_weeks)[:(body.get("max_tokens") or 4096) * 4].split(" ")
+        created = int(time.time())
+        completion_id = "chatcmpl-" + uuid.uuid4().hex
+        if body.get("stream"):
+            events = [{"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": deployment, "choices": []}]
+            events += [{
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": deployment,
+                "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]
+            } for word in words]
+            events.append({"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": deployment,
+                           "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            stream = "".join(f"data: {json.dumps(event)}\n\n" for event in events) + "data: [DONE]\n\n"
+            return self.send(200, stream.encode(), content_type="text/event-stream", headers=headers)
+        self.send(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": deployment,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": " ".join(words)}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        }, headers=headers)
+
+
+class SearchHandler(FakeHandler):
+    service = "Cognitive Search"
+    documents = None
+    indexes = None
+    lock = threading.Lock()
+
+    def do_get_request(self):
+        if self.route == "/indexes":
+            return self.send(200, {"value": [{"name": name} for name in self.indexes]})
+        if re.match(r"/indexes\('[^']*'\)/docs/\$count$", self.route):
+            with self.lock:
+                return self.send(200, str(len(self.documents)).encode(), content_type="text/plain")
+        match = re.match(r"/indexes\('[^']*'\)/docs\('(.*)'\)$", self.route)
+        if match:
+            with self.lock:
+                document = self.documents.get(match.group(1))
+            if document is None:
+                return self.send(404, {"error": {"code": "", "message": "Document not found."}})
+            return self.send(200, {name: value for name, value in document.items() if name != "embedding"})
+        FakeHandler.do_get_request(self)
+
+    def do_post_request(self):
+        if self.route == "/indexes":
+            index = self.json_body()
+            with self.lock:
+                self.indexes[index["name"]] = index
+            return self.send(201, index)
+
+        match = re.match(r"/indexes\('([^']*)'\)/docs/search\.(post\.search|index)$", self.route)
+        if not match:
+            return FakeHandler.do_post_request(self)
+        body = self.json_body()
+        if match.group(2) == "index":
+            results = []
+            with self.lock:
+                for action in body["value"]:
+                    document = {name: value for name, value in action.items() if not name.startswith("@")}
+                    if action.get("@search.action") == "delete":
+                        self.documents.pop(document["id"], None)
+                    else:
+                        self.documents[document["id"]] = document
+                    results.append({"key": document["id"], "status": True, "errorMessage": None, "statusCode": 200})
+            return self.send(200, {"value": results})
+
+        with self.lock:
+            matches = [document for document in self.documents.values() if self.matches(document, body.get("filter"))]
+        top = body.get("top") or 50
+        skip = body.get("skip") or 0
+        # Like the service the embedding only comes back when it is selected
+        select = body.get("select").split(",") if body.get("select") else None
+        page = [{"@search.score": 1.0, **{name: value for name, value in document.items() if (name in select if select else name != "embedding")}}
+                for document in matches[skip:skip + top]]
+        result = {"value": page}
+        if body.get("count"):
+            result["@odata.count"] = len(matches)
+        self.send(200, result)
+
+    @staticmethod
+    def matches(document, filter):
+        # Only the two filters the functions use: "sourcefile eq '...'" and "category ne '...'"
+        if not filter:
+            return True
+        match = re.match(r"(\w+) (eq|ne) '(.*)'$", filter)
+        if not match:
+            return True
+        field, operator, value = match.groups()
+        value = value.replace("''", "'")
+        return (document.get(field) == value) == (operator == "eq")
+
+
+class CosmosHandler(FakeHandler):
+    service = "Cosmos DB"
+    containers = None
+    lock = threading.Lock()
+
+    def do_get_request(self):
+        if self.route in ("", "/"):
+            location = [{"name": "Local", "databaseAccountEndpoint": self.server.url + "/"}]
+            return self.send(200, {
+                "id": "fake", "_rid": "fake.documents.azure.com", "_self": "",
+                "writableLocations": location, "readableLocations": location,
+                "enableMultipleWriteLocations": False,
+                "userReplicationPolicy": {"asyncReplication": False, "minReplicaSetSize": 1, "maxReplicasetSize": 4},
+                "userConsistencyPolicy": {"defaultConsistencyLevel": "Session"},
+                "systemReplicationPolicy": {"minReplicaSetSize": 1, "maxReplicasetSize": 4},
+                "readPolicy": {"primaryReadCoefficient": 1, "secondaryReadCoefficient": 1},
+                "queryEngineConfiguration": "{}"
+            }, headers=self.session_headers())
+
+        parts = self.route.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "dbs":
+            return self.send(200, {"id": parts[1], "_rid": "db", "_self": f"dbs/{parts[1]}/"}, headers=self.session_headers())
+        if len(parts) == 4 and parts[2] == "colls":
+            if parts[3] not in self.containers:
+                return self.send(404, {"code": "NotFound", "message": "Resource Not Found"}, headers=self.session_headers())
+            return self.send(200, self.container_properties(parts[3]), headers=self.session_headers())
+        if len(parts) == 5 and parts[4] == "pkranges":
+            return self.send(200, {"_rid": "coll", "_count": 1, "PartitionKeyRanges": [{
+                "id": "0", "_rid": "range", "minInclusive": "", "maxExclusive": "FF", "parents": [], "status": "online"
+            }]}, headers=self.session_headers())
+        if len(parts) == 6 and parts[4] == "docs":
+            with self.lock:
+                document = self.documents(parts[3]).get(self.key(parts[5]))
+            if document is None:
+                return self.send(404, {"code": "NotFound", "message": "Resource Not Found"}, headers=self.session_headers())
+            return self.send(200, document, headers={"etag": document["_etag"], **self.session_headers()})
+        FakeHandler.do_get_request(self)
+
+    def do_post_request(self):
+        parts = self.route.strip("/").split("/")
+        if len(parts) == 3 and parts[2] == "colls":
+            properties = self.json_body()
+            with self.lock:
+                if properties["id"] in self.containers:
+                    return self.send(409, {"code": "Conflict", "message": "Resource with specified id already exists."}, headers=self.session_headers())
+                self.containers[properties["id"]] = {"properties": properties, "documents": {}}
+            return self.send(201, self.container_properties(properties["id"]), headers=self.session_headers())
+        if len(parts) != 5 or parts[4] != "docs":
+            return FakeHandler.do_post_request(self)
+        if self.headers.get("x-ms-cosmos-is-query-plan-request", "").lower() == "true":
+            # No aggregates to rewrite, every query runs on the single partition key range as is
+            return self.send(200, {
+                "partitionedQueryExecutionInfoVersion": 2,
+                "queryInfo": {"distinctType": "None", "top": None, "offset": None, "limit": None, "orderBy": [], "orderByExpressions": [],
+                              "groupByExpressions": [], "groupByAliases": [], "aggregates": [], "groupByAliasToAggregateType": {},
+                              "rewrittenQuery": "", "hasSelectValue": False, "dCountInfo": None, "hasNonStreamingOrderBy": False},
+                "queryRanges": [{"min": "", "max": "FF", "isMinInclusive": True, "isMaxInclusive": False}]
+            }, headers=self.session_headers())
+        if self.headers.get("x-ms-documentdb-isquery", "").lower() == "true":
+            return self.run_query(parts[3], self.json_body().get("query", ""))
+        if self.headers.get("x-ms-cosmos-is-batch-request", "").lower() == "true":
+            return self.run_batch(parts[3], self.json_body())
+
+        document = self.json_body()
+        upsert = self.headers.get("x-ms-documentdb-is-upsert", "").lower() == "true"
+        with self.lock:
+            documents = self.documents(parts[3])
+            key = self.key(document["id"], document)
+            if key in documents and not upsert:
+                return self.send(409, {"code": "Conflict", "message": "Resource with specified id already exists."}, headers=self.session_headers())
+            status = 200 if key in documents else 201
+            documents[key] = self.stamp(document)
+        self.send(status, document, headers={"etag": document["_etag"], **self.session_headers()})
+
+    def do_put_request(self):
+        parts = self.route.strip("/").split("/")
+        if len(parts) != 6 or parts[4] != "docs":
+            return FakeHandler.do_put_request(self)
+        document = self.json_body()
+        with self.lock:
+            documents = self.documents(parts[3])
+            current = documents.get(self.key(parts[5]))
+            if current is None:
+                return self.send(404, {"code": "NotFound", "message": "Resource Not Found"}, headers=self.session_headers())
+            if self.headers.get("If-Match") and self.headers["If-Match"] != current["_etag"]:
+                return self.send(412, {"code": "PreconditionFailed", "message": "Operation cannot be performed because one of the specified precondition is not met."}, headers=self.session_headers())
+            documents[self.key(parts[5])] = self.stamp(document)
+        self.send(200, document, headers={"etag": document["_etag"], **self.session_headers()})
+
+    def do_delete_request(self):
+        parts = self.route.strip("/").split("/")
+        if len(parts) != 6 or parts[4] != "docs":
+            return FakeHandler.do_delete_request(self)
+        with self.lock:
+            document = self.documents(parts[3]).pop(self.key(parts[5]), None)
+        self.send(204 if document else 404, b"", headers=self.session_headers())
+
+    def run_query(self, container, query):
+        with self.lock:
+            documents = list(self.documents(container).values())
+        # Good enough for "SELECT VALUE MAX(c.field) FROM c" and "SELECT * FROM c"
+        match = re.match(r"SELECT VALUE MAX\(c\.(\w+)\) FROM c", query, re.IGNORECASE)
+        if match:
+            values = [document[match.group(1)] for document in documents if document.get(match.group(1)) is not None]
+            result = [max(values)] if values else []
+        else:
+            result = documents
+        self.send(200, {"_rid": "coll", "Documents": result, "_count": len(result)}, headers=self.session_headers())
+
+    def run_batch(self, container, operations):
+        # Transactional batch of creates and upserts in one partition, all or nothing
+        with self.lock:
+            documents = self.documents(container)
+            for operation in operations:
+                key = self.key(operation["resourceBody"]["id"])
+                if operation["operationType"] == "Create" and key in documents:
+                    results = [{"statusCode": 424}] * len(operations)
+                    results[operations.index(operation)] = {"statusCode": 409}
+                    return self.send(207, results, headers=self.session_headers())
+            results = []
+            for operation in operations:
+                key = self.key(operation["resourceBody"]["id"])
+                status = 200 if key in documents else 201
+                documents[key] = self.stamp(operation["resourceBody"])
+                results.append({"statusCode": status, "eTag": documents[key]["_etag"]})
+        self.send(200, results, headers=self.session_headers())
+
+    def key(self, document_id, document=None):
+        # Ids are only unique within a logical partition
+        header = self.headers.get("x-ms-documentdb-partitionkey")
+        partition = json.loads(header)[0] if header else (document or {}).get("partitionKey")
+        return json.dumps(partition), document_id
+
+    def documents(self, container):
+        return self.containers.setdefault(container, {"properties": {"id": container}, "documents": {}})["documents"]
+
+    def container_properties(self, container):
+        properties = self.containers.get(container, {}).get("properties", {})
+        return {
+            "id": container, "_rid": "coll", "_self": f"dbs/db/colls/{container}/", "_etag": '"0"', "_ts": int(time.time()),
+            "partitionKey": properties.get("partitionKey") or {"paths": ["/partitionKey"], "kind": "Hash", "version": 2},
+            "indexingPolicy": {"indexingMode": "consistent", "automatic": True},
+            **({"defaultTtl": properties["defaultTtl"]} if "defaultTtl" in properties else {})
+        }
+
+    @staticmethod
+    def stamp(document):
+        document["_etag"] = f'"{uuid.uuid4()}"'
+        document["_ts"] = int(time.time())
+        document["_rid"] = "doc"
+        return document
+
+    @staticmethod
+    def session_headers():
+        return {"x-ms-session-token": "0:1#1", "x-ms-request-charge": "1"}
+
+
+class BlobHandler(FakeHandler):
+    service = "Blob Storage"
+    blobs = None
+    lock = threading.Lock()
+
+    def storage_headers(self):
+        return {"x-ms-request-id": str(uuid.uuid4()), "x-ms-version": "2021-08-06", "Date": formatdate(usegmt=True)}
+
+    def split(self):
+        # https://127.0.0.1:port/<account>/<container>/<blob>, like Azurite
+        parts = self.route.strip("/").split("/", 2)
+        return parts[1] if len(parts) > 1 else None, parts[2] if len(parts) > 2 else None
+
+    def container_headers(self):
+        return {"ETag": '"0x1"', "Last-Modified": formatdate(usegmt=True), "x-ms-lease-state": "available", "x-ms-lease-status": "unlocked",
+                "x-ms-has-immutability-policy": "false", "x-ms-has-legal-hold": "false", **self.storage_headers()}
+
+    def do_get_request(self):
+        container, blob = self.split()
+        if self.query.get("restype") == "container" and self.query.get("comp") == "list":
+            with self.lock:
+                names = sorted(name for (c, name) in self.blobs if c == container)
+            xml = "".join(f"<Blob><Name>{name}</Name><Properties><BlobType>BlockBlob</BlobType></Properties></Blob>" for name in names)
+            body = f'<?xml version="1.0" encoding="utf-8"?><EnumerationResults ContainerName="{container}"><Blobs>{xml}</Blobs><NextMarker /></EnumerationResults>'
+            return self.send(200, body.encode(), content_type="application/xml", headers=self.storage_headers())
+        if self.query.get("restype") == "container":
+            with self.lock:
+                exists = container in self.containers
+            if not exists:
+                return self.storage_error(404, "ContainerNotFound")
+            return self.send(200, b"", headers=self.container_headers())
+        with self.lock:
+            data = self.blobs.get((container, blob))
+        if data is None:
+            return self.storage_error(404, "BlobNotFound")
+        self.send(200, data, content_type="application/octet-stream", headers={"x-ms-blob-type": "BlockBlob", **self.container_headers()})
+
+    do_head_request = do_get_request
+
+    def do_put_request(self):
+        container, blob = self.split()
+        with self.lock:
+            if blob is None:
+                if container in self.containers:
+                    return self.storage_error(409, "ContainerAlreadyExists")
+                self.containers.add(container)
+            else:
+                self.containers.add(container)
+                self.blobs[(container, blob)] = self.body
+        headers = self.container_headers()
+        if blob is not None:
+            headers["Content-MD5"] = ""
+            headers["x-ms-request-server-encrypted"] = "true"
+        self.send(201, b"", headers=headers)
+
+    def do_delete_request(self):
+        container, blob = self.split()
+        with self.lock:
+            found = self.blobs.pop((container, blob), None) is not None
+        if not found:
+            return self.storage_error(404, "BlobNotFound")
+        self.send(202, b"", headers=self.storage_headers())
+
+    def storage_error(self, status, code):
+        body = f'<?xml version="1.0" encoding="utf-8"?><Error><Code>{code}</Code><Message>{code}</Message></Error>'
+        self.send(status, body.encode(), content_type="application/xml", headers={"x-ms-error-code": code, **self.storage_headers()})
+
+
+class KeyVaultHandler(FakeHandler):
+    service = "Key Vault"
+    secrets = None
+
+    def authenticate(self):
+        # The SDK sends the first request without a token and waits for the challenge
+        if not (self.headers.get("Authorization") or "").startswith("Bearer "):
+            self.send(401, {"error": {"code": "Unauthorized", "message": "AKV10000: Request is missing a Bearer or PoP token."}}, headers={
+                "WWW-Authenticate": 'Bearer authorization="https://login.microsoftonline.com/00000000-0000-0000-0000-000000000000", resource="https://vault.azure.net"'
+            })
+            return False
+        return True
+
+    def do_get_request(self):
+        match = re.match(r"/secrets/([^/]+)/?$", self.route)
+        if not match or match.group(1) not in self.secrets:
+            return self.send(404, {"error": {"code": "SecretNotFound", "message": f"A secret with (name/id) {match and match.group(1)} was not found in this key vault."}})
+        name = match.group(1)
+        self.send(200, {
+            "value": self.secrets[name],
+            "id": f"{self.server.url}/secrets/{name}/{hashlib.md5(name.encode()).hexdigest()}",
+            "attributes": {"enabled": True, "created": 1690000000, "updated": 1690000000, "recoveryLevel": "Recoverable+Purgeable"}
+        })
+
+
+class StaticTokenCredential:
+    # Stands in for DefaultAzureCredential in front of the fake Key Vault
+    def get_token(self, *scopes, **kwargs):
+        from azure.core.credentials import AccessToken
+        return AccessToken("fake-token", int(time.time()) + 3600)
+
+
+def create_certificate(directory):
+    # Self-signed certificate for 127.0.0.1, the clients trust it through REQUESTS_CA_BUNDLE
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(name)
+                   .issuer_name(name)
+                   .public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(days=1))
+                   .not_valid_after(now + datetime.timedelta(days=7))
+                   .add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+                   .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+                   .sign(key, hashes.SHA256()))
+    certificate_path = os.path.join(directory, "fake-services.pem")
+    key_path = os.path.join(directory, "fake-services.key")
+    with open(certificate_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
+    return certificate_path, key_path
+
+
+def seed_corpus(count, category="MOE"):
+    # Documents the chat functions find when nothing was uploaded yet
+    words = ["learning", "outcomes", "students", "assessment", "inquiry", "feedback", "curriculum", "reflection", "practice", "teacher"]
+    rng = random.Random(42)
+    documents = {}
+    for i in range(count):
+        content = ". ".join(" ".join(rng.choice(words) for _ in range(12)).capitalize() for _ in range(8)) + "."
+        documents[f"corpus-{i}"] = {
+            "id": f"corpus-{i}",
+            "content": content,
+            "embedding": fake_vector(content),
+            "category": category,
+            "sourcepage": f"corpus-{i // 10}-{i % 10}.pdf",
+            "sourcefile": f"corpus-{i // 10}.pdf"
+        }
+    return documents
+
+
+def outcome_container(secrets):
+    # The container the functions write outcomes to exists already, the others are created on first use
+    name = (secrets or {}).get("azure-cosmosdb-contanier")
+    return {name: {"properties": {"id": name}, "documents": {}}} if name else {}
+
+
+class FakeServices:
+    def __init__(self, directory, faults=None, secrets=None, corpus_documents=200, token_ms=0, completion_tokens=200, outline_weeks=10, quota=None):
+        faults = faults or {}
+        self.certificate, key = create_certificate(directory)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.certificate, key)
+
+        def handler(base, **attributes):
+            return type(base.__name__, (base,), attributes)
+
+        self.servers = {
+            "openai": FakeServer(handler(OpenAIHandler, token_ms=token_ms, completion_tokens=completion_tokens, outline_weeks=outline_weeks, quota=quota), faults.get("openai") or Faults(), context),
+            "search": FakeServer(handler(SearchHandler, documents=seed_corpus(corpus_documents), indexes={}, lock=threading.Lock()), faults.get("search") or Faults(), context),
+            "cosmos": FakeServer(handler(CosmosHandler, containers=outcome_container(secrets), lock=threading.Lock()), faults.get("cosmos") or Faults(), context),
+            "blob": FakeServer(handler(BlobHandler, blobs={}, containers=set(), lock=threading.Lock()), faults.get("blob") or Faults(), context),
+            "keyvault": FakeServer(handler(KeyVaultHandler, secrets=dict(secrets or {})), faults.get("keyvault") or Faults(), context),
+        }
+
+    def url(self, name):
+        return self.servers[name].url
+
+    def start(self):
+        for server in self.servers.values():
+            server.start()
+        return self
+
+    def stop(self):
+        for server in self.servers.values():
+            server.stop()
+
+    def stats(self):
+        return {name: server.stats() for name, server in self.servers.items()}
@@ -0,0 +1,132 @@
+import argparse
+import asyncio
+import copy
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.cosmos import exceptions
+
+# Concurrent inserts against shared_code/id_allocator.py. Several allocators, one per simulated
+# worker, hand out ids from threads (and from tasks for AsyncIdAllocator) against one in-memory
+# container that checks ETags like Cosmos DB does, with a short delay so replaces overlap.
+# Every id has to be unique and every reserved block used by one worker only. For example:
+#
+#   python benchmarks/id_allocator_check.py --workers 4 --threads 8 --ids 200
+#
+# Exits with 1 when an id was handed out twice.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared_code import id_allocator  # noqa: E402
+
+
+class MemoryContainer:
+    # read_item, create_item, replace_item with an ETag condition and the MAX query of the allocator
+    def __init__(self, delay=0.001, existing_max_id=None):
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._items = {}
+        self.conflicts = 0
+        if existing_max_id is not None:
+            self._items["outcome"] = {"id": "outcome", "id_identity": existing_max_id, "_etag": "0"}
+
+    def read_item(self, item, partition_key):
+        time.sleep(self.delay)
+        with self._lock:
+            if item not in self._items:
+                raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Resource Not Found")
+            return copy.deepcopy(self._items[item])
+
+    def create_item(self, body):
+        time.sleep(self.delay)
+        with self._lock:
+            if body["id"] in self._items:
+                raise exceptions.CosmosResourceExistsError(status_code=409, message="Conflict")
+            self._items[body["id"]] = dict(body, _etag=str(uuid.uuid4()))
+
+    def replace_item(self, item, body, etag=None, match_condition=None):
+        time.sleep(self.delay)
+        with self._lock:
+            if etag is not None and self._items[item]["_etag"] != etag:
+                self.conflicts += 1
+                raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="Precondition Failed")
+            self._items[item] = dict(body, _etag=str(uuid.uuid4()))
+
+    def query_items(self, query, **kwargs):
+        with self._lock:
+            values = [item["id_identity"] for item in self._items.values() if "id_identity" in item]
+        return [max(values) if values else None]
+
+
+class AsyncMemoryContainer:
+    # The same container for AsyncIdAllocator, the calls run on threads so they really overlap
+    def __init__(self, container):
+        self.container = container
+
+    async def read_item(self, item, partition_key):
+        return await asyncio.to_thread(self.container.read_item, item, partition_key)
+
+    async def create_item(self, body):
+        return await asyncio.to_thread(self.container.create_item, body)
+
+    async def replace_item(self, item, body, etag=None, match_condition=None):
+        return await asyncio.to_thread(self.container.replace_item, item, body, etag, match_condition)
+
+    async def query_items(self, query, **kwargs):
+        for value in self.container.query_items(query):
+            yield value
+
+
+def check(name, ids, expected, start):
+    duplicates = len(ids) - len(set(ids))
+    ok = duplicates == 0 and len(ids) == expected and min(ids) >= start
+    print(f"{name}: {len(ids)} ids, {duplicates} duplicates, lowest {min(ids)}, highest {max(ids)} - {'ok' if ok else 'FAILED'}")
+    return ok
+
+
+def run_threads(args, container):
+    allocators = [id_allocator.IdAllocator(container, block_size=args.block_size) for _ in range(args.workers)]
+
+    def take(i):
+        return allocators[i % args.workers].next_id()
+
+    with ThreadPoolExecutor(max_workers=args.workers * args.threads) as executor:
+        return list(executor.map(take, range(args.ids)))
+
+
+async def run_tasks(args, container):
+    allocators = [id_allocator.AsyncIdAllocator(AsyncMemoryContainer(container), block_size=args.block_size) for _ in range(args.workers)]
+    return await asyncio.gather(*(allocators[i % args.workers].next_id() for i in range(args.ids)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Hand out ids from several allocators at once and look for duplicates.")
+    parser.add_argument("--workers", type=int, default=4, help="Allocators sharing the counter document")
+    parser.add_argument("--threads", type=int, default=8, help="Threads per allocator")
+    parser.add_argument("--ids", type=int, default=400, help="Ids to hand out per run")
+    parser.add_argument("--block-size", type=int, default=5, help="Ids per reserved block, small so blocks are reserved often")
+    parser.add_argument("--existing-max-id", type=int, default=41, help="Highest id already in the container")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    ok = True
+
+    container = MemoryContainer(existing_max_id=args.existing_max_id)
+    ids = run_threads(args, container)
+    ok &= check(f"threads ({container.conflicts} ETag conflicts)", ids, args.ids, args.existing_max_id + 1)
+
+    container = MemoryContainer(existing_max_id=args.existing_max_id)
+    ids = asyncio.run(run_tasks(args, container))
+    ok &= check(f"async ({container.conflicts} ETag conflicts)", ids, args.ids, args.existing_max_id + 1)
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+
+# Simulation of the Azure OpenAI quota: chat requests and a bulk upload run side by side against
+# a fake OpenAI that answers 429 once a deployment is over its tokens/requests per minute, first
+# without client side limits and then with the buckets of shared_code/rate_limit.py. For example:
+#
+#   python benchmarks/quota.py --tpm 40000 --rpm 240 --chat-requests 4 --uploads 2 --pages 40
+#
+# Reports the 429s the service had to send, chat latency and how long the uploads took per mode.
+# Every chat call reserves its max_tokens, so with a small quota a run takes a few minutes.
+
+from run import APP_ROOT, call, configure_environment, distribution, flush_outbox, load_function, make_pdf, make_request, secrets  # noqa: E402
+from fake_services import FakeServices, Quota, StaticTokenCredential  # noqa: E402
+
+MODES = ["no limits", "limits"]
+
+
+def set_limits(args, enabled):
+    from shared_code import rate_limit
+
+    # The client side quota sits a bit below the real one, our token counts are estimates
+    rate_limit.RATE_LIMIT_TPM = int(args.tpm * args.headroom) if enabled else 0
+    rate_limit.RATE_LIMIT_RPM = int(args.rpm * args.headroom) if enabled else 0
+    rate_limit.limits.cache_clear()
+    rate_limit._limiter = None
+
+
+def run_mode(services, chat, upload, args, pdf):
+    services.servers["openai"].RequestHandlerClass.quota.reset()
+    errors_before = dict(services.servers["openai"].errors)
+    chat_requests = [make_request(args.function, f"quota-{i}-{time.time()}", pdf) for i in range(args.chat_requests)]
+    upload_requests = [make_request("Upload_files", f"quota-{i}", pdf) for i in range(args.uploads)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.uploads or 1) as uploads, ThreadPoolExecutor(max_workers=args.concurrency) as chats:
+        upload_futures = [uploads.submit(call, upload, request) for request in upload_requests]
+        # Let ingestion get going first, chat traffic arrives while it is running
+        time.sleep(args.chat_delay)
+        chat_results = list(chats.map(lambda request: call(chat, request), chat_requests))
+        upload_results = [future.result() for future in upload_futures]
+    elapsed = time.perf_counter() - start
+
+    errors_after = services.servers["openai"].errors
+    errors = {}
+    for r in chat_results + upload_results:
+        if r["error"] is not None:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "throttled": errors_after.get("429", 0) - errors_before.get("429", 0),
+        "chat": {
+            "succeeded": sum(r["error"] is None for r in chat_results),
+            "failed": sum(r["error"] is not None for r in chat_results),
+            "latency_ms": distribution([r["latency_ms"] for r in chat_results if r["error"] is None]),
+            "quota_wait_ms": distribution([r["stages"].get("quota", 0) for r in chat_results if r["error"] is None]),
+        },
+        "upload": {
+            "succeeded": sum(r["error"] is None for r in upload_results),
+            "failed": sum(r["error"] is not None for r in upload_results),
+            "latency_ms": distribution([r["latency_ms"] for r in upload_results if r["error"] is None]),
+        },
+        "errors": errors,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulate chat and ingestion sharing one Azure OpenAI quota.")
+    parser.add_argument("--tpm", type=int, default=40000, help="Tokens per minute of every fake deployment")
+    parser.add_argument("--rpm", type=int, default=240, help="Requests per minute of every fake deployment")
+    parser.add_argument("--headroom", type=float, default=0.9, help="Share of the quota the client side buckets allow")
+    parser.add_argument("--function", default="Alex_Chatgpt-4", help="Chat function sending the interactive traffic")
+    parser.add_argument("--chat-requests", type=int, default=4, help="Chat requests per mode")
+    parser.add_argument("--concurrency", type=int, default=4, help="Chat requests in flight at the same time")
+    parser.add_argument("--uploads", type=int, default=2, help="Uploads running next to the chat requests")
+    parser.add_argument("--pages", type=int, default=40, help="Pages of every uploaded PDF")
+    parser.add_argument("--chat-delay", type=float, default=0.5, help="Seconds between starting the uploads and the chat requests")
+    parser.add_argument("--completion-tokens", type=int, default=200, help="Length of every fake completion")
+    parser.add_argument("--modes", default=",".join(MODES), help="Comma separated modes to run, in this order")
+    parser.add_argument("--output", help="Result file, defaults to benchmarks/results/quota-<timestamp>.json")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.cold = True
+    quota = Quota(tpm=args.tpm, rpm=args.rpm)
+
+    with tempfile.TemporaryDirectory() as directory:
+        services = FakeServices(directory, secrets=secrets(), completion_tokens=args.completion_tokens, quota=quota).start()
+        try:
+            configure_environment(services, directory, args)
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+            from azure.keyvault.secrets import SecretClient
+            from shared_code import config
+
+            config._client = SecretClient(vault_url=config.KEYVAULT_URL, credential=StaticTokenCredential(), verify_challenge_resource=False)
+
+            pdf = make_pdf(args.pages)
+            chat = load_function(args.function)
+            upload = load_function("Upload_files")
+            report = {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "settings": vars(args),
+                "modes": {},
+            }
+            for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+                set_limits(args, mode == "limits")
+                report["modes"][mode] = run_mode(services, chat, upload, args, pdf)
+            flush_outbox()
+            report["services"] = services.stats()["openai"]
+        finally:
+            services.stop()
+
+    output = args.output or os.path.join(APP_ROOT, "benchmarks", "results", time.strftime("quota-%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for mode, result in report["modes"].items():
+        chat_latency, upload_latency = result["chat"]["latency_ms"], result["upload"]["latency_ms"]
+        print(f"\n{mode}: {result['throttled']} x 429 in {result['elapsed_s']} s")
+        print(f"  chat    {result['chat']['succeeded']} ok, {result['chat']['failed']} failed, p50 {chat_latency['p50']} ms, p95 {chat_latency['p95']} ms, "
+              f"quota wait p95 {result['chat']['quota_wait_ms']['p95']} ms")
+        print(f"  upload  {result['upload']['succeeded']} ok, {result['upload']['failed']} failed, p50 {upload_latency['p50']} ms")
+        for error, count in result["errors"].items():
+            print(f"  {count} x {error}")
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import argparse
+import asyncio
+import json
+import os
+import ssl
+import sys
+import tempfile
+import threading
+import time
+
+# Retries, circuit breaker and fallback of shared_code/resilience.py against a fake Azure OpenAI
+# that answers every deployment from a script: delays past CHAT_TIMEOUT, 429s with Retry-After,
+# 503s, 400s, slow answers that get hedged and streams that break after a few tokens. Each case checks how many requests the
+# deployments got, how long the call took and what it raised. For example:
+#
+#   python benchmarks/resilience_check.py --cooldown 1
+#
+# Exits with 1 when a case failed.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_services import Faults, FakeServer, OpenAIHandler, create_certificate  # noqa: E402
+
+
+class ScriptedOpenAIHandler(OpenAIHandler):
+    # script: deployment -> list of steps, one per request, an empty step or none left is a normal answer
+    script = {}
+    calls = {}
+    lock = threading.Lock()
+
+    def do_post_request(self):
+        deployment = self.route.split("/")[3]
+        with self.lock:
+            self.calls[deployment] = self.calls.get(deployment, 0) + 1
+            steps = self.script.get(deployment)
+            step = steps.pop(0) if steps else {}
+        time.sleep(step.get("delay", 0))
+        if "status" in step:
+            headers = {"Retry-After": str(step["retry_after"])} if "retry_after" in step else {}
+            self.server.count_error(step["status"])
+            return self.send(step["status"], {"error": {"code": str(step["status"]), "message": "Scripted error"}}, headers=headers)
+        if "stream_error_after" in step:
+            # A few tokens, then the error event Azure sends when it gives up in the middle of an answer
+            events = [{"id": "chatcmpl-scripted", "object": "chat.completion.chunk", "created": int(time.time()), "model": deployment,
+                       "choices": [{"index": 0, "delta": {"content": f"word{i} "}, "finish_reason": None}]} for i in range(step["stream_error_after"])]
+            events.append({"error": {"code": "500", "message": "The server had an error while processing your request"}})
+            stream = "".join(f"data: {json.dumps(event)}\n\n" for event in events)
+            return self.send(200, stream.encode(), content_type="text/event-stream")
+        super().do_post_request()
+
+
+def configure(args, certificate):
+    # Settings are read when shared_code is imported
+    os.environ.update({
+        "REQUESTS_CA_BUNDLE": certificate,
+        "CHAT_TIMEOUT": str(args.timeout),
+        "CHAT_MAX_RETRIES": str(args.retries),
+        "CHAT_MAX_BACKOFF": "5",
+        "CIRCUIT_FAILURE_THRESHOLD": str(args.threshold),
+        "CIRCUIT_COOLDOWN": str(args.cooldown),
+        "HEDGE_MIN_SAMPLES": str(args.hedge_samples),
+    })
+
+
+def chat(resilience, deployment, on_token=None):
+    import openai
+
+    from shared_code import streaming
+
+    response = openai.ChatCompletion.create(
+        engine=deployment,
+        messages=[{"role": "user", "content": "Hello"}],
+        max_tokens=20,
+        request_timeout=resilience.CHAT_TIMEOUT,
+        stream=on_token is not None)
+    if on_token is None:
+        return response["choices"][0]["message"]["content"]
+    return streaming.collect(response, on_token)
+
+
+def attempt(fn):
+    start = time.monotonic()
+    try:
+        result, error = fn(), None
+    except Exception as e:
+        result, error = None, e
+    return result, error, time.monotonic() - start
+
+
+def report(name, ok, detail):
+    print(f"{name}: {detail} - {'ok' if ok else 'FAILED'}")
+    return ok
+
+
+def run_cases(args, resilience, script, calls):
+    from shared_code import streaming
+
+    ok = True
+
+    # 429 with Retry-After: one retry after the time the service asked for
+    script["retry-after"] = [{"status": 429, "retry_after": 1}]
+    result, error, seconds = attempt(lambda: resilience.call(lambda d: chat(resilience, d), "retry-after"))
+    ok &= report("429 with Retry-After", error is None and calls.get("retry-after") == 2 and seconds >= 1,
+                 f"{calls.get('retry-after')} requests in {seconds:.1f}s, {error!r}")
+
+    # Slower than CHAT_TIMEOUT on every attempt: the fallback answers
+    script["slow"] = [{"delay": args.timeout * 3}] * (args.retries + 1)
+    result, error, seconds = attempt(lambda: resilience.call(lambda d: chat(resilience, d), "slow", "slow-fallback"))
+    ok &= report("timeouts, then the fallback", error is None and calls.get("slow") == args.retries + 1 and calls.get("slow-fallback") == 1,
+                 f"{calls.get('slow')} timed out, {calls.get('slow-fallback')} to the fallback in {seconds:.1f}s, {error!r}")
+
+    # Enough 503s open the circuit, the next call fails without a request
+    script["probe"] = [{"status": 503}] * args.threshold
+    for _ in range(args.threshold):
+        attempt(lambda: resilience.call_with_retries(lambda d: chat(resilience, d), "probe", max_retries=0))
+    before = calls.get("probe")
+    result, error, seconds = attempt(lambda: resilience.call_with_retries(lambda d: chat(resilience, d), "probe"))
+    ok &= report("circuit opens", isinstance(error, resilience.CircuitOpenError) and calls.get("probe") == before,
+                 f"{before} requests, then {error!r}")
+
+    # Half open: the probe gets a 400, which says nothing about the deployment. The next call probes again and closes it.
+    time.sleep(args.cooldown)
+    script["probe"] = [{"status": 400}]
+    _, probe_error, _ = attempt(lambda: resilience.call_with_retries(lambda d: chat(resilience, d), "probe"))
+    result, error, seconds = attempt(lambda: resilience.call_with_retries(lambda d: chat(resilience, d), "probe"))
+    ok &= report("half-open probe with a 400", error is None and result is not None,
+                 f"probe raised {type(probe_error).__name__}, next call {error!r}")
+
+    # Half open: a probe that fails again opens the circuit for another cooldown
+    script["reopen"] = [{"status": 503}] * (args.threshold + 1)
+    for _ in range(args.threshold):
+        attempt(lambda: resilience.call_with_retries(lambda d: chat(resilience, d), "reopen", max_retries=0))
+    time.sleep(args.cooldown)
+    attempt(lambda: resilience.call_with_retries(lambda d: chat(resilience, d), "reopen", max_retries=0))
+    result, error, seconds = attempt(lambda: resilience.call_with_retries(lambda d: chat(resilience, d), "reopen"))
+    ok &= report("half-open probe with a 503", isinstance(error, resilience.CircuitOpenError), f"next call {error!r}")
+
+    # Half open, async: a probe that is cancelled lets the next call probe
+    script["cancel"] = [{"status": 503}] * args.threshold + [{"delay": args.timeout / 2}]
+    for _ in range(args.threshold):
+        attempt(lambda: resilience.call_with_retries(lambda d: chat(resilience, d), "cancel", max_retries=0))
+    time.sleep(args.cooldown)
+
+    async def cancelled_probe():
+        task = asyncio.ensure_future(resilience.call_with_retries_async(lambda d: asyncio.to_thread(chat, resilience, d), "cancel"))
+        await asyncio.sleep(args.timeout / 10)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return await resilience.call_with_retries_async(lambda d: asyncio.to_thread(chat, resilience, d), "cancel")
+
+    result, error, seconds = attempt(lambda: asyncio.run(cancelled_probe()))
+    ok &= report("half-open probe cancelled (async)", error is None and result is not None, f"next call {error!r}")
+
+    # Hedging: after enough fast calls of a kind, a slow one is sent to the fallback as well and
+    # the first answer wins
+    for _ in range(args.hedge_samples):
+        resilience.call(lambda d: chat(resilience, d), "hedge", "hedge-fallback", hedge=True, kind="short")
+    script["hedge"] = [{"delay": args.timeout * 0.8}]
+    result, error, seconds = attempt(lambda: resilience.call(lambda d: chat(resilience, d), "hedge", "hedge-fallback", hedge=True, kind="short"))
+    ok &= report("hedged on the fallback", error is None and calls.get("hedge-fallback") == 1 and seconds < args.timeout * 0.8,
+                 f"{calls.get('hedge-fallback')} to the fallback, answered in {seconds:.2f}s, {error!r}")
+
+    # Latencies are per kind of call, a kind without samples isn't hedged
+    script["hedge"] = [{"delay": args.timeout * 0.8}]
+    result, error, seconds = attempt(lambda: resilience.call(lambda d: chat(resilience, d), "hedge", "hedge-fallback", hedge=True, kind="long"))
+    ok &= report("no hedge without samples of the kind", error is None and calls.get("hedge-fallback") == 1,
+                 f"{calls.get('hedge-fallback') - 1} more to the fallback, {error!r}")
+
+    # Both legs fail: the fallback had its attempts as the hedge, it isn't tried once more
+    for _ in range(args.hedge_samples):
+        resilience.call(lambda d: chat(resilience, d), "hedge-both", "hedge-both-fallback", hedge=True, kind="short")
+    script["hedge-both"] = [{"delay": args.timeout * 0.6, "status": 503}] * (args.retries + 1)
+    script["hedge-both-fallback"] = [{"status": 503}] * (args.retries + 1)
+    result, error, seconds = attempt(lambda: resilience.call(lambda d: chat(resilience, d), "hedge-both", "hedge-both-fallback", hedge=True, kind="short"))
+    ok &= report("both hedge legs fail", isinstance(error, resilience.RETRYABLE_ERRORS) and calls.get("hedge-both-fallback") == args.retries + 1,
+                 f"{calls.get('hedge-both-fallback')} to the fallback, {error!r}")
+
+    # A stream that breaks after some tokens is neither retried nor sent to the fallback
+    script["stream"] = [{"stream_error_after": 5}]
+    tokens = []
+    result, error, seconds = attempt(lambda: resilience.call(lambda d: chat(resilience, d, tokens.append), "stream", "stream-fallback"))
+    ok &= report("stream interrupted", isinstance(error, streaming.StreamInterruptedError) and len(tokens) == 5 and calls.get("stream") == 1 and not calls.get("stream-fallback"),
+                 f"{len(tokens)} tokens, {calls.get('stream')} requests, {calls.get('stream-fallback') or 0} to the fallback, {type(error).__name__}")
+
+    # A stream that fails before its first token is retried like any other call
+    script["stream-early"] = [{"status": 503}]
+    tokens = []
+    result, error, seconds = attempt(lambda: resilience.call(lambda d: chat(resilience, d, tokens.append), "stream-early"))
+    ok &= report("stream failed before the first token", error is None and calls.get("stream-early") == 2 and len(tokens) == 20,
+                 f"{len(tokens)} tokens, {calls.get('stream-early')} requests, {error!r}")
+    return ok
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check retries, circuit breaker and fallback against a scripted fake Azure OpenAI.")
+    parser.add_argument("--timeout", type=float, default=0.5, help="CHAT_TIMEOUT in seconds")
+    parser.add_argument("--retries", type=int, default=2, help="CHAT_MAX_RETRIES")
+    parser.add_argument("--threshold", type=int, default=3, help="CIRCUIT_FAILURE_THRESHOLD")
+    parser.add_argument("--cooldown", type=float, default=1, help="CIRCUIT_COOLDOWN in seconds")
+    parser.add_argument("--hedge-samples", type=int, default=5, help="HEDGE_MIN_SAMPLES")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        certificate, key = create_certificate(directory)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certificate, key)
+        handler = type("ScriptedOpenAIHandler", (ScriptedOpenAIHandler,), {"script": {}, "calls": {}, "completion_tokens": 20})
+        server = FakeServer(handler, Faults(), context).start()
+        # Answers to calls that timed out can't be written any more, that is expected
+        server.handle_error = lambda request, client_address: None
+        try:
+            configure(args, certificate)
+            import openai
+
+            from shared_code import resilience
+
+            openai.api_type = "azure"
+            openai.api_base = server.url
+            openai.api_version = "2023-05-15"
+            openai.api_key = "fake-key"
+            ok = run_cases(args, resilience, handler.script, handler.calls)
+        finally:
+            server.stop()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+import argparse
+import asyncio
+import base64
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+
+# Offline benchmark of the real function entry points against the fakes in fake_services.py,
+# nothing leaves the machine. For example:
+#
+#   python benchmarks/run.py --requests 40 --concurrency 8 \
+#       --openai "latency_ms=400,jitter_ms=150,error_rate=0.05,error_status=429,retry_after=1" --token-ms 2
+#
+# Writes throughput and p50/p95/p99 per stage for every function to benchmarks/results/.
+# tiktoken needs its cl100k_base file, run once with network access or point TIKTOKEN_CACHE_DIR at a copy.
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_services import Faults, FakeServices, StaticTokenCredential  # noqa: E402
+
+FUNCTIONS = ["Alex_Chatgpt-4", "Alex_Chatgpt-35", "Upload_files"]
+SERVICES = ["openai", "search", "cosmos", "blob", "keyvault"]
+STORAGE_ACCOUNT = "devstoreaccount1"
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return round(values[low] + (values[high] - values[low]) * (rank - low), 1)
+
+
+def distribution(values):
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 1) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": round(max(values), 1) if values else None,
+    }
+
+
+def make_pdf(pages, words_per_page=400):
+    # Small text-only PDF that pypdf can extract again
+    vocabulary = ["teachers", "design", "lessons", "around", "clear", "learning", "outcomes", "and", "check", "understanding", "often"]
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(pages):
+        words = [vocabulary[(page + i) % len(vocabulary)] for i in range(words_per_page)]
+        lines = [" ".join(words[i:i + 12]) + "." for i in range(0, len(words), 12)]
+        text = " ".join(f"({line}) Tj T*" for line in lines)
+        stream = f"BT /F1 9 Tf 11 TL 40 800 Td {text} ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    pdf += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return pdf
+
+
+def configure_environment(services, directory, args):
+    # Endpoints and keys of the fakes, must be set before the functions are imported
+    os.environ.update({
+        "KEYVAULT_URL": services.url("keyvault") + "/",
+        "AZURE_OPENAI_ENDPOINT": services.url("openai"),
+        "AZURE_SEARCH_ENDPOINT": services.url("search"),
+        "COSMOS_ENDPOINT": services.url("cosmos") + "/",
+        "AZURE_STORAGE_ENDPOINT": f"{services.url('blob')}/{STORAGE_ACCOUNT}",
+        "OPENAI_API_KEY": "fake-key",
+        "REQUESTS_CA_BUNDLE": services.certificate,
+        "VECTOR_INDEX_DIR": os.path.join(directory, "vector_index"),
+        "SEMANTIC_CACHE_PATH": os.path.join(directory, "semantic_cache.npz"),
+        "OUTBOX_QUEUE_TYPE": "memory",
+        "AZURE_OPENAI_GPT4_DEPLOYMENT": "gpt-4",
+        "AZURE_OPENAI_GPT35_DEPLOYMENT": "gpt-35-turbo",
+        "JOB_STORE": "memory",
+        "CHECKPOINT_STORE": "memory",
+        # A new database, the containers besides the outcomes one are created on first use
+        "COSMOS_CREATE_CONTAINERS": "true",
+    })
+    if args.cold:
+        # Every request pays for the engage stage and the full pipeline
+        os.environ.update({"PRIMING_CACHE_TTL": "0", "RESULT_CACHE_SIZE": "0"})
+
+
+def flush_outbox():
+    # The outcomes still waiting in the outbox go to the fake Cosmos DB before it stops, there is
+    # no Write_outcomes function to take them from the memory queue
+    from shared_code import outbox
+
+    outbox.drain()
+
+
+def secrets():
+    return {
+        "azure-storage-account": STORAGE_ACCOUNT,
+        "azure-search-service": "fake-search",
+        "azure-search-index": "gptkbindex",
+        "azure-openai-service": "fake-openai",
+        "azure-openai-chatgpt": "gpt-4",
+        "azure-search-api-key": "fake-search-key",
+        "azure-cosmosdb-name": "nie",
+        "azure-cosmosdb-contanier": "conversations",
+        "azure-cosmosdb-key": base64.b64encode(b"fake-cosmos-key").decode(),
+    }
+
+
+def load_function(name):
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), os.path.join(APP_ROOT, name, "__init__.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_request(name, i, pdf):
+    import azure.functions as func
+
+    if name == "Upload_files":
+        body, content_type = urllib3.encode_multipart_formdata({"File": (f"bench-{i}.pdf", pdf, "application/pdf")})
+        return func.HttpRequest(method="POST", url=f"/api/{name}", headers={"Content-Type": content_type}, body=body)
+    body = json.dumps({"Input": f"{name} benchmark course {i}: giving feedback on student writing"}).encode()
+    return func.HttpRequest(method="POST", url=f"/api/{name}", headers={"Content-Type": "application/json"}, body=body)
+
+
+async def run_async(response):
+    from shared_code import async_pipeline
+
+    # asyncio.run() gives every call a new loop, the clients of the async pipeline go with it
+    try:
+        return await response
+    finally:
+        await async_pipeline.close_clients()
+
+
+def call(module, request):
+    from shared_code import telemetry
+
+    # The function's own trace joins this one, so the stage spans end up here
+    with telemetry.trace("benchmark") as trace:
+        start = time.perf_counter()
+        try:
+            response = module.main(request)
+            if asyncio.iscoroutine(response):
+                response = asyncio.run(run_async(response))
+            status, error = response.status_code, None
+            if status >= 400:
+                error = response.get_body().decode(errors="replace")[:200]
+        except Exception as e:
+            status, error = None, f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+        latency = (time.perf_counter() - start) * 1000
+        summary = trace.summary()
+    return {
+        "status": status,
+        "error": error,
+        "latency_ms": latency,
+        "stages": trace.durations(),
+        "prompt_tokens": summary["prompt_tokens"],
+        "completion_tokens": summary["completion_tokens"],
+    }
+
+
+def run_function(name, module, args, pdf):
+    requests = [make_request(name, i, pdf) for i in range(args.requests)]
+    for i in range(args.warmup):
+        call(module, make_request(name, f"warmup-{i}", pdf))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda request: call(module, request), requests))
+    elapsed = time.perf_counter() - start
+
+    succeeded = [r for r in results if r["error"] is None]
+    stages = sorted({stage for r in succeeded for stage in r["stages"]})
+    errors = {}
+    for r in results:
+        if r["error"] is not None:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return {
+        "requests": len(results),
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(succeeded) / elapsed, 3) if elapsed else None,
+        "latency_ms": distribution([r["latency_ms"] for r in succeeded]),
+        "stages_ms": {stage: distribution([r["stages"][stage] for r in succeeded if stage in r["stages"]]) for stage in stages},
+        "tokens": {
+            "prompt": sum(r["prompt_tokens"] for r in succeeded),
+            "completion": sum(r["completion_tokens"] for r in succeeded),
+        },
+    }
+
+
+def print_report(report):
+    for name, result in report["functions"].items():
+        latency = result["latency_ms"]
+        print(f"\n{name}: {result['succeeded']}/{result['requests']} ok, {result['throughput_rps']} req/s, "
+              f"p50 {latency['p50']} ms, p95 {latency['p95']} ms, p99 {latency['p99']} ms")
+        for stage, stats in result["stages_ms"].items():
+            print(f"  {stage:<16} p50 {stats['p50']:>9} p95 {stats['p95']:>9} p99 {stats['p99']:>9}  (n={stats['count']})")
+        for error, count in result["errors"].items():
+            print(f"  {count} x {error}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the functions against local fakes of the Azure services.")
+    parser.add_argument("--functions", default=",".join(FUNCTIONS), help="Comma separated functions to run, in this order")
+    parser.add_argument("--requests", type=int, default=20, help="Requests per function")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at the same time")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed requests per function before the run")
+    parser.add_argument("--cold", action="store_true", help="Disable the priming and result caches")
+    parser.add_argument("--token-ms", type=float, default=0, help="Fake generation time per completion token")
+    parser.add_argument("--completion-tokens", type=int, default=200, help="Length of every fake completion")
+    parser.add_argument("--outline-weeks", type=int, default=10, help="Weeks in the fake outline JSON, more weeks get cut off at max_tokens sooner")
+    parser.add_argument("--corpus-documents", type=int, default=200, help="Documents in the fake search index")
+    parser.add_argument("--pages", type=int, default=5, help="Pages of the generated PDF that is uploaded")
+    parser.add_argument("--pdf", help="Upload this PDF instead of a generated one")
+    parser.add_argument("--output", help="Result file, defaults to benchmarks/results/<timestamp>.json")
+    for service in SERVICES:
+        parser.add_argument(f"--{service}", default="", metavar="FAULTS",
+                            help=f"Faults of the fake {service}, e.g. latency_ms=200,jitter_ms=50,error_rate=0.05,error_status=429,retry_after=1")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    faults = {service: Faults.parse(getattr(args, service)) for service in SERVICES}
+
+    with tempfile.TemporaryDirectory() as directory:
+        services = FakeServices(directory, faults=faults, secrets=secrets(), corpus_documents=args.corpus_documents,
+                                token_ms=args.token_ms, completion_tokens=args.completion_tokens, outline_weeks=args.outline_weeks).start()
+        try:
+            configure_environment(services, directory, args)
+            # The Cosmos SDK never verifies certificates of 127.0.0.1, like with the emulator
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+            from azure.keyvault.secrets import SecretClient
+            from shared_code import config
+
+            # DefaultAzureCredential has nobody to ask for a token offline
+            config._client = SecretClient(vault_url=config.KEYVAULT_URL, credential=StaticTokenCredential(), verify_challenge_resource=False)
+
+            pdf = open(args.pdf, "rb").read() if args.pdf else make_pdf(args.pages)
+            report = {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "settings": {name: value for name, value in vars(args).items() if name not in SERVICES},
+                "functions": {},
+                "startup_ms": {},
+            }
+            for name in [n.strip() for n in args.functions.split(",") if n.strip()]:
+                start = time.perf_counter()
+                module = load_function(name)
+                report["startup_ms"][name] = round((time.perf_counter() - start) * 1000, 1)
+                report["functions"][name] = run_function(name, module, args, pdf)
+            flush_outbox()
+            report["services"] = services.stats()
+        finally:
+            services.stop()
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print_report(report)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
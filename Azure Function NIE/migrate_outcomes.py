@@ -0,0 +1,132 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+
+from shared_code import config, cosmos, outcomes, retrieval, token_budget
+
+# Rewrites the outcome documents stored in the old format (full conversation, partitioned by the
+# hash of the response) into the compact format of shared_code/outcomes.py:
+#
+#   python migrate_outcomes.py --dry-run        # only report what would change
+#   python migrate_outcomes.py                  # migrate, then delete the old documents
+#
+# A line of chunk text that is exactly a chunk of the search index is stored as its id, every
+# other line (compressed chunks, "(same source as above)", chunks that changed) is kept as text
+# in its place, so the expanded document is the conversation as it was sent. Documents already in
+# the compact format are skipped, so it can be rerun.
+
+SYSTEM_PROPERTIES = ["_rid", "_self", "_etag", "_attachments", "_ts"]
+
+
+class ChunkResolver:
+    # (sourcepage, content) -> chunk id, one search per source page
+    def __init__(self, search_client):
+        self.search_client = search_client
+        self.pages = {}
+
+    def chunks(self, sourcepage):
+        if sourcepage not in self.pages:
+            results = self.search_client.search(
+                "",
+                filter="{} eq '{}'".format(retrieval.KB_FIELDS_SOURCEPAGE, sourcepage.replace("'", "''")),
+                select=["id", retrieval.KB_FIELDS_CONTENT],
+                top=1000)
+            self.pages[sourcepage] = [(doc["id"], str(doc[retrieval.KB_FIELDS_CONTENT]).replace("\n", "").replace("\r", "")) for doc in results]
+        return self.pages[sourcepage]
+
+    def resolve(self, sourcepage, content):
+        # Only the whole chunk, a compressed one expanded from its id would read differently
+        for chunk_id, chunk_content in self.chunks(sourcepage):
+            if content == chunk_content:
+                return chunk_id
+        return None
+
+
+def compact_conversation(messages, resolver):
+    compacted = []
+    stats = {"resolved": 0, "unresolved": 0}
+    for message in messages:
+        content = message.get("content") or ""
+        if message.get("role") != "user" or token_budget.SOURCES_MARKER not in content:
+            compacted.append(outcomes.compact_message(message))
+            continue
+
+        source_lines = []
+        for line in content.split(token_budget.SOURCES_MARKER, 1)[1].split("\n"):
+            sourcepage, _, text = line.partition(": ")
+            chunk_id = resolver.resolve(sourcepage, text) if text else None
+            if chunk_id is None:
+                source_lines.append({"text": line})
+                stats["unresolved"] += 1
+            else:
+                source_lines.append(chunk_id)
+                stats["resolved"] += 1
+        compacted.append(outcomes.compact_message(message, source_lines=source_lines))
+    return compacted, stats
+
+
+def migrate(document, resolver):
+    created = datetime.datetime.fromtimestamp(document.get("_ts") or 0, datetime.timezone.utc)
+    conversation, stats = compact_conversation(document["chat_conversation"], resolver)
+    migrated = {name: value for name, value in document.items() if name not in SYSTEM_PROPERTIES}
+    migrated.update({
+        "partitionKey": outcomes.partition_key(document.get("user"), created, document["id"]),
+        "format": "compact",
+        "format_version": outcomes.COMPACT_VERSION,
+        "created": created.isoformat(),
+        "chat_conversation": conversation,
+    })
+    return migrated, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate outcome documents to the compact storage format.")
+    parser.add_argument("--dry-run", action="store_true", help="Report the savings without writing anything")
+    parser.add_argument("--keep-old", action="store_true", help="Don't delete the old documents after copying them")
+    parser.add_argument("--limit", type=int, default=0, help="Stop after this many documents")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    config.load()
+    container = cosmos.get_container()
+    search_client = SearchClient(
+        endpoint=os.environ.get("AZURE_SEARCH_ENDPOINT") or f"https://{config.get('azure-search-service')}.search.windows.net",
+        index_name=config.get("azure-search-index"),
+        credential=AzureKeyCredential(config.get("azure-search-api-key")))
+    resolver = ChunkResolver(search_client)
+
+    totals = {"documents": 0, "bytes_before": 0, "bytes_after": 0, "resolved": 0, "unresolved": 0, "failed": 0}
+    query = "SELECT * FROM c WHERE IS_DEFINED(c.chat_conversation) AND NOT IS_DEFINED(c.format)"
+    for document in container.query_items(query, enable_cross_partition_query=True):
+        if args.limit and totals["documents"] >= args.limit:
+            break
+        if outcomes.is_compact(document) or "chat_conversation" not in document:
+            continue
+        try:
+            migrated, stats = migrate(document, resolver)
+            if not args.dry_run:
+                # The partition key changes, so it is a new document and the old one goes away
+                container.upsert_item(body=migrated)
+                if not args.keep_old:
+                    container.delete_item(item=document["id"], partition_key=document["partitionKey"])
+        except Exception:
+            logging.exception(f"Could not migrate {document['id']}")
+            totals["failed"] += 1
+            continue
+        totals["documents"] += 1
+        totals["bytes_before"] += len(json.dumps(document))
+        totals["bytes_after"] += len(json.dumps(migrated))
+        totals["resolved"] += stats["resolved"]
+        totals["unresolved"] += stats["unresolved"]
+        logging.info(f"{document['id']}: {len(json.dumps(document))} -> {len(json.dumps(migrated))} bytes, partition {migrated['partitionKey']}")
+
+    print(json.dumps({"dry_run": args.dry_run, **totals}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import asyncio
+import os
+import ssl
+
+import aiohttp
+import openai
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.cosmos.aio import CosmosClient
+from azure.search.documents.aio import SearchClient
+
+from shared_code import config, cosmos, embeddings, id_allocator, outbox, outcomes, pipeline, rate_limit, resilience, retrieval, stages, streaming, telemetry
+
+# The chat pipeline of pipeline.py on the event loop: the same steps, see pipeline.run_steps, with
+# OpenAI, Cognitive Search and Cosmos DB called through their async clients, so a request that
+# waits on the network holds no thread and one worker can have many requests in flight. The secrets still come from shared_code/config.py:
+# they are read once when the worker starts and refreshed in the background, never per request.
+ASYNC_PIPELINE = (os.environ.get("ASYNC_PIPELINE") or "false").lower() == "true"
+# Connections of the aiohttp session all the async clients share
+ASYNC_POOL_SIZE = int(os.environ.get("ASYNC_POOL_SIZE") or 100)
+
+
+class Clients:
+    def __init__(self):
+        # aiohttp doesn't read REQUESTS_CA_BUNDLE like the requests based clients do
+        ssl_context = ssl.create_default_context(cafile=os.environ.get("REQUESTS_CA_BUNDLE") or None)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=ASYNC_POOL_SIZE, ssl=ssl_context))
+
+        def transport():
+            return AioHttpTransport(session=self.session, session_owner=False)
+
+        self.search_client = SearchClient(
+            endpoint=pipeline.AZURE_SEARCH_ENDPOINT,
+            index_name=pipeline.AZURE_SEARCH_INDEX,
+            credential=AzureKeyCredential(pipeline.AZURE_SEARCH_API_KEY),
+            transport=transport())
+        database_name = config.get("azure-cosmosdb-name")
+        self.cosmos_client = CosmosClient(
+            cosmos.COSMOS_ENDPOINT or f"https://{database_name}.documents.azure.com:443/",
+            config.get("azure-cosmosdb-key"),
+            preferred_locations=cosmos.COSMOS_PREFERRED_REGIONS or None,
+            connection_timeout=cosmos.COSMOS_CONNECTION_TIMEOUT,
+            transport=transport())
+        self.container = self.cosmos_client.get_database_client(database_name).get_container_client(config.get("azure-cosmosdb-contanier"))
+        self.ids = id_allocator.AsyncIdAllocator(self.container)
+
+    async def close(self):
+        await self.search_client.close()
+        await self.cosmos_client.close()
+        await self.session.close()
+
+
+_clients = {}
+
+
+def get_clients():
+    # One set per event loop, an aiohttp session can't be used from another loop
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        _clients[loop] = Clients()
+    return _clients[loop]
+
+
+async def close_clients():
+    clients = _clients.pop(asyncio.get_running_loop(), None)
+    if clients is not None:
+        await clients.close()
+
+
+async def create_completion(messages, route, deployment, on_token=None):
+    budget = pipeline.route_budget(route, deployment)
+    messages = budget.fit(messages, route["max_tokens"])
+    # Waiting for quota may block, keep it off the event loop
+    await asyncio.to_thread(rate_limit.acquire, deployment, budget.count(messages) + route["max_tokens"])
+    with telemetry.span("chat", stage=route["stage"], deployment=deployment, stream=on_token is not None):
+        response = await openai.ChatCompletion.acreate(
+            engine=deployment,
+            messages=messages,
+            temperature=route["temperature"],
+            max_tokens=route["max_tokens"],
+            request_timeout=resilience.CHAT_TIMEOUT,
+            stream=on_token is not None
+        )
+        if on_token is None:
+            telemetry.record_usage(route["stage"], deployment, response.get("usage"))
+            return response['choices'][0]['message']['content']
+
+        content = await streaming.collect_async(response, on_token)
+        telemetry.record_usage(route["stage"], deployment, {
+            "prompt_tokens": budget.count(messages),
+            "completion_tokens": budget.count_text(content),
+            "estimated": True
+        })
+        return content
+
+
+async def send_message(messages, route, on_token=None):
+    # Retries, circuit breaker and fallback like pipeline.send_message, no hedging
+    return await resilience.call_async(
+        lambda deployment: create_completion(messages, route, deployment, on_token),
+        route["deployment"],
+        route["fallback"],
+        kind=(route["stage"], route["max_tokens"]))
+
+
+async def store_outcome(messages, response, telemetry_summary=None, sources=None, user=""):
+    if outbox.OUTBOX:
+        # Queued for Write_outcomes like in pipeline.store_outcome
+        document = outcomes.make_document(None, messages, response, sources or {}, user, telemetry_summary)
+        with telemetry.span("outbox"):
+            await asyncio.to_thread(outbox.put, document)
+        return
+
+    clients = get_clients()
+    with telemetry.span("cosmos_id"):
+        next_id = await clients.ids.next_id()
+
+    outcome = outcomes.make_document(next_id, messages, response, sources or {}, user, telemetry_summary)
+
+    with telemetry.span("cosmos_write"):
+        await clients.container.create_item(body=outcome)
+
+
+async def run_steps(steps):
+    # pipeline.run_steps on the event loop, every call of the shared steps is awaited. Blocking
+    # ones (caches, checkpoints, the priming cache) get a thread.
+    result, error = None, None
+    while True:
+        try:
+            call = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = await CALLS[call[0]](*call[1:]), None
+        except Exception as e:
+            result, error = None, e
+
+
+async def _run_stages(named_steps, messages, done, on_stage, done_answers):
+    return await stages.run_stages_async(
+        [stages.Stage(name, [], lambda stage_messages, steps=steps: run_steps(steps(stage_messages))) for name, steps in named_steps],
+        messages, done, lambda *args: run_steps(on_stage(*args)), done_answers=done_answers)
+
+
+CALLS = {
+    "blocking": lambda fn, *args: asyncio.to_thread(fn, *args),
+    "embed": lambda text: embeddings.embed_text_async(text),
+    "retrieve": lambda queries: retrieval.retrieve_all_async(get_clients().search_client, queries),
+    "send": lambda messages, route, on_token: send_message(messages, route, on_token),
+    "send_all": lambda conversations, route: retrieval.run_concurrently_async(lambda messages: send_message(messages, route), conversations),
+    "stages": lambda *args: _run_stages(*args),
+    "store": lambda *args: store_outcome(*args),
+}
+
+
+async def generate_outline(Input, routes, on_event=None, user="", request_id=None):
+    # pipeline.generate_outline on the event loop, the OpenAI calls of this request share one aiohttp session
+    openai.aiosession.set(get_clients().session)
+    with telemetry.trace("generate_outline") as trace:
+        response = await run_steps(pipeline.outline_steps(Input, routes, on_event, user, None, request_id))
+        telemetry.log(trace)
+    return response
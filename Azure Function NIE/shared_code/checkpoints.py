@@ -0,0 +1,115 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from shared_code import result_cache, stores, telemetry
+
+# The conversation is saved after the engage and explore stages of a request that comes with a
+# request_id, and the turns of explain and elaborate as each of them finishes. When a call fails,
+# the client sends the same request with the same request_id again and the pipeline continues with
+# what is missing instead of making all ten LLM calls again. "cosmos" lets any instance resume, "sqlite" or "memory" only
+# the same worker.
+CHECKPOINT_STORE = os.environ.get("CHECKPOINT_STORE") or "cosmos"
+CHECKPOINT_CONTAINER = os.environ.get("CHECKPOINT_CONTAINER") or "checkpoints"
+CHECKPOINT_SQLITE_PATH = os.environ.get("CHECKPOINT_SQLITE_PATH") or "checkpoints.sqlite3"
+# Checkpoints are removed after this many seconds, a request is retried soon or not at all
+CHECKPOINT_TTL = int(os.environ.get("CHECKPOINT_TTL") or 3600)
+
+# In pipeline order, a checkpoint of a stage includes the ones before it. The stages after explore
+# run side by side and are kept in the turns and answers of the checkpoint.
+STAGES = ["engage", "explore"]
+
+
+def request_id(req):
+    # Chosen by the client and sent again with the retry of a failed request
+    value = req.params.get("request_id")
+    if value is None:
+        try:
+            value = (req.get_json() or {}).get("request_id")
+        except ValueError:
+            value = None
+    return str(value) if value else None
+
+
+def make_key(request_id, Input, routes, user=""):
+    # Another course, user or routes under the same request_id starts from scratch. Not the index
+    # generation like the result cache: an upload between the failure and the retry must not lose the checkpoint.
+    key = json.dumps([request_id, user or "", result_cache.normalize_input(Input), result_cache.route_scope(routes)])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+_lock = threading.Lock()
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _lock:
+            if _store is None:
+                # Cosmos removes the checkpoints by itself once the TTL has passed
+                _store = stores.make_store(CHECKPOINT_STORE, CHECKPOINT_CONTAINER, CHECKPOINT_SQLITE_PATH, CHECKPOINT_TTL)
+    return _store
+
+
+class Checkpoint:
+    # The saved progress of one request, does nothing without a request_id. A checkpoint that
+    # can't be read or written is logged and the request goes on as if there was none.
+    def __init__(self, request_id, Input, routes, user="", store=None):
+        self.key = make_key(request_id, Input, routes, user) if request_id else None
+        self.store = store
+        self.stage = None
+        self.messages = None
+        self.sources = None
+        # Turns and answers of the stages that ran on their own copy of the conversation, see shared_code/stages.py
+        self.turns = {}
+        self.answers = {}
+
+    def _store(self):
+        return self.store or get_store()
+
+    def load(self):
+        # The last saved stage, None when the request starts from scratch
+        if not self.key:
+            return None
+        with telemetry.span("checkpoint_load"):
+            try:
+                checkpoint = self._store().get(self.key)
+            except Exception:
+                logging.exception("Checkpoint couldn't be read")
+                checkpoint = None
+        if checkpoint and checkpoint.get("stage") in STAGES:
+            self.stage = checkpoint["stage"]
+            self.messages = checkpoint["messages"]
+            # JSON keys are strings, the indexes of the engage messages are ints
+            self.sources = {int(i): ids for i, ids in checkpoint["sources"].items()}
+            self.turns = checkpoint.get("turns") or {}
+            self.answers = checkpoint.get("answers") or {}
+        return self.stage
+
+    def done(self, stage):
+        return self.stage is not None and STAGES.index(stage) <= STAGES.index(self.stage)
+
+    def save(self, stage, messages, sources, turns=None, answers=None):
+        if not self.key:
+            return
+        self.stage = stage
+        self.turns = dict(self.turns, **(turns or {}))
+        self.answers = dict(self.answers, **(answers or {}))
+        with telemetry.span("checkpoint", stage=stage):
+            try:
+                self._store().put({"id": self.key, "stage": stage, "messages": messages, "sources": sources, "turns": self.turns, "answers": self.answers, "updated": time.time()})
+            except Exception:
+                logging.exception(f"Checkpoint of stage {stage} couldn't be saved")
+
+    def clear(self):
+        # The outline is done and stored, a retry now comes from the result cache
+        if not self.key or self.stage is None:
+            return
+        try:
+            self._store().delete(self.key)
+        except Exception:
+            logging.exception("Checkpoint couldn't be deleted")
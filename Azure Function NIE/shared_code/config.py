@@ -0,0 +1,99 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.identity import DefaultAzureCredential
+from azure.keyvault.secrets import SecretClient
+
+# Replace these values with your Azure Key Vault URL
+KEYVAULT_URL = os.environ.get("KEYVAULT_URL") or "https://kv-nie.vault.azure.net/"
+
+# Secrets are fetched once per worker and refreshed in the background after this many seconds
+CONFIG_REFRESH_TTL = int(os.environ.get("CONFIG_REFRESH_TTL") or 900)
+
+SECRET_NAMES = [
+    "azure-storage-account",
+    "azure-search-service",
+    "azure-search-index",
+    "azure-openai-service",
+    "azure-openai-chatgpt",
+    "azure-search-api-key",
+    "azure-cosmosdb-name",
+    "azure-cosmosdb-contanier",
+    "azure-cosmosdb-key",
+]
+
+_lock = threading.Lock()
+_load_lock = threading.Lock()
+_client = None
+_values = {}
+_loaded_at = None
+_refreshing = False
+
+
+def env_name(name):
+    # azure-search-service -> AZURE_SEARCH_SERVICE
+    return name.upper().replace("-", "_")
+
+
+def _secret_client():
+    global _client
+    if _client is None:
+        _client = SecretClient(vault_url=KEYVAULT_URL, credential=DefaultAzureCredential())
+    return _client
+
+
+def _fetch(name):
+    try:
+        return _secret_client().get_secret(name).value
+    except Exception as e:
+        logging.warning(f"Could not read secret '{name}' from Key Vault: {e}")
+        return None
+
+
+def load(names=SECRET_NAMES):
+    # Fetch every secret at once instead of one round trip after the other
+    global _loaded_at
+    names = list(names)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        fetched = dict(zip(names, executor.map(_fetch, names)))
+    logging.info(f"Read {len(names)} secrets from Key Vault in {(time.monotonic() - start) * 1000:.0f} ms")
+    with _lock:
+        for name, value in fetched.items():
+            # Keep serving the last known value when a refresh fails
+            if value is not None:
+                _values[name] = value
+        _loaded_at = time.monotonic()
+
+
+def _refresh_in_background():
+    global _refreshing
+    try:
+        load()
+    finally:
+        _refreshing = False
+
+
+def get(name, default=None):
+    global _refreshing
+    if _loaded_at is None:
+        with _load_lock:
+            if _loaded_at is None:
+                load()
+    elif time.monotonic() - _loaded_at > CONFIG_REFRESH_TTL and not _refreshing:
+        with _lock:
+            start = not _refreshing
+            _refreshing = True
+        if start:
+            threading.Thread(target=_refresh_in_background, daemon=True).start()
+
+    value = _values.get(name)
+    if value is None:
+        # Key Vault is unreachable or doesn't have it, fall back to the app settings
+        value = os.environ.get(env_name(name), default)
+    if value is None:
+        raise KeyError(f"Secret '{name}' is not in Key Vault and {env_name(name)} is not set")
+    return value
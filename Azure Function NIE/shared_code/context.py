@@ -0,0 +1,47 @@
+import os
+import re
+
+# Trim every chunk to the sentences that match the question best before it goes into the prompt
+CONTEXT_COMPRESSION = (os.environ.get("CONTEXT_COMPRESSION") or "false").lower() == "true"
+CONTEXT_MAX_SENTENCES = int(os.environ.get("CONTEXT_MAX_SENTENCES") or 4)
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "in", "is", "it",
+    "of", "on", "or", "some", "that", "the", "their", "they", "this", "to", "what", "which", "with", "used",
+}
+
+
+def words(text):
+    return {w for w in re.findall(r"[a-z0-9]+", text.lower()) if w not in STOPWORDS}
+
+
+def compress(content, query, max_sentences=CONTEXT_MAX_SENTENCES):
+    # Extractive: keep the sentences sharing the most words with the query, in their original order
+    sentences = [s for s in re.split(r"(?<=[.!?])\s+", content) if s.strip()]
+    if len(sentences) <= max_sentences:
+        return content
+    query_words = words(query)
+    scores = [len(words(s) & query_words) for s in sentences]
+    best = sorted(range(len(sentences)), key=lambda i: (-scores[i], i))[:max_sentences]
+    return " ".join(sentences[i] for i in sorted(best))
+
+
+class ContextAssembler:
+    # Tracks which chunks the conversation already contains, so each one is pasted only once
+    def __init__(self, compression=CONTEXT_COMPRESSION):
+        self.compression = compression
+        self.seen = set()
+
+    def format(self, query, chunks):
+        lines = []
+        for chunk in chunks:
+            if chunk["id"] in self.seen:
+                lines.append(chunk["sourcepage"] + ": (same source as above)")
+                continue
+            self.seen.add(chunk["id"])
+            content = compress(chunk["content"], query) if self.compression else chunk["content"]
+            lines.append(chunk["sourcepage"] + ": " + content)
+        return "\n".join(lines)
+
+    def user_message(self, query, chunks):
+        return query + " \nSOURCES:\n" + self.format(query, chunks)
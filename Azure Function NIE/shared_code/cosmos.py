@@ -0,0 +1,88 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import RequestsTransport
+from azure.cosmos import CosmosClient, PartitionKey
+
+from shared_code import config
+
+# Comma separated list of regions, e.g. "Southeast Asia,East Asia"
+COSMOS_PREFERRED_REGIONS = [r.strip() for r in (os.environ.get("COSMOS_PREFERRED_REGIONS") or "").split(",") if r.strip()]
+COSMOS_CONNECTION_TIMEOUT = int(os.environ.get("COSMOS_CONNECTION_TIMEOUT") or 10)
+COSMOS_POOL_SIZE = int(os.environ.get("COSMOS_POOL_SIZE") or 20)
+# Defaults to https://<azure-cosmosdb-name>.documents.azure.com:443/
+COSMOS_ENDPOINT = os.environ.get("COSMOS_ENDPOINT")
+# The containers of shared_code/stores.py (jobs, checkpoints, outlines, settings, ratelimits) are
+# created with the database, partitioned by /id and with the TTL of their store. "true" creates
+# missing ones on first use instead, for a new or local database.
+COSMOS_CREATE_CONTAINERS = (os.environ.get("COSMOS_CREATE_CONTAINERS") or "false").lower() == "true"
+
+_lock = threading.Lock()
+_client = None
+_container = None
+_containers = {}
+
+
+def _transport():
+    # One pooled HTTP session for every request of this worker
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=COSMOS_POOL_SIZE, pool_maxsize=COSMOS_POOL_SIZE)
+    session.mount("https://", adapter)
+    return RequestsTransport(session=session, session_owner=False)
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                database_name = config.get("azure-cosmosdb-name")
+                key = config.get("azure-cosmosdb-key")
+                endpoint = COSMOS_ENDPOINT or f"https://{database_name}.documents.azure.com:443/"
+                _client = CosmosClient(
+                    endpoint,
+                    key,
+                    preferred_locations=COSMOS_PREFERRED_REGIONS or None,
+                    connection_timeout=COSMOS_CONNECTION_TIMEOUT,
+                    transport=_transport())
+    return _client
+
+
+def get_container():
+    # Created on first use and shared by every function in the worker
+    global _container
+    if _container is None:
+        client = get_client()
+        with _lock:
+            if _container is None:
+                database = client.get_database_client(config.get("azure-cosmosdb-name"))
+                _container = database.get_container_client(config.get("azure-cosmosdb-contanier"))
+    return _container
+
+
+def get_named_container(name, default_ttl=None):
+    # The other containers by name, looked up once per worker
+    container = _containers.get(name)
+    if container is None:
+        client = get_client()
+        with _lock:
+            container = _containers.get(name)
+            if container is None:
+                database = client.get_database_client(config.get("azure-cosmosdb-name"))
+                if COSMOS_CREATE_CONTAINERS:
+                    container = database.create_container_if_not_exists(id=name, partition_key=PartitionKey(path="/id"), default_ttl=default_ttl)
+                else:
+                    container = database.get_container_client(name)
+                _containers[name] = container
+    return container
+
+
+def reset():
+    # Drop the cached handles, e.g. after the Cosmos key was rotated
+    global _client, _container
+    with _lock:
+        _client = None
+        _container = None
+        _containers.clear()
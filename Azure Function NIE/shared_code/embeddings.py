@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import os
+
+import openai
+from tenacity import AsyncRetrying, Retrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+from shared_code import rate_limit, resilience, telemetry
+
+AZURE_OPENAI_EMB_DEPLOYMENT = os.environ.get("AZURE_OPENAI_EMB_DEPLOYMENT") or "embedding"
+
+# Azure OpenAI accepts at most 16 inputs per embeddings request and 8191 tokens per input.
+# The token limit per request is kept below the model limit because we only estimate tokens.
+EMBEDDING_BATCH_MAX_ITEMS = int(os.environ.get("EMBEDDING_BATCH_MAX_ITEMS") or 16)
+EMBEDDING_BATCH_MAX_TOKENS = int(os.environ.get("EMBEDDING_BATCH_MAX_TOKENS") or 7000)
+# Attempts per request. The chat functions have somebody waiting for the answer, Upload_files can
+# wait out the quota. Only throttling, timeouts and server errors are retried, see resilience.RETRYABLE_ERRORS.
+EMBEDDING_MAX_ATTEMPTS = int(os.environ.get("EMBEDDING_MAX_ATTEMPTS") or 3)
+EMBEDDING_BULK_MAX_ATTEMPTS = int(os.environ.get("EMBEDDING_BULK_MAX_ATTEMPTS") or 15)
+
+
+def estimate_tokens(text):
+    # Roughly 4 characters per token for English text
+    return len(text) // 4 + 1
+
+
+def make_batches(texts, max_items=EMBEDDING_BATCH_MAX_ITEMS, max_tokens=EMBEDDING_BATCH_MAX_TOKENS):
+    # Yields lists of indexes into texts, each list fits in one request
+    batch = []
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= max_items or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def before_retry_sleep(retry_state):
+    logging.warning(f"OpenAI embeddings request failed ({retry_state.outcome.exception()!r}), sleeping before retrying...")
+
+
+_backoff = wait_random_exponential(min=1, max=60)
+
+
+def wait_for_quota(retry_state, max_wait=60):
+    # As long as the service asked for in Retry-After, otherwise random exponential backoff
+    delay = rate_limit.retry_after(getattr(retry_state.outcome.exception(), "headers", None))
+    return min(delay if delay is not None else _backoff(retry_state), max_wait)
+
+
+def retrying(priority, retrying_class=Retrying):
+    # Interactive calls wait no longer than the chat calls do, see resilience.CHAT_MAX_BACKOFF
+    interactive = priority == rate_limit.INTERACTIVE
+    attempts = EMBEDDING_MAX_ATTEMPTS if interactive else EMBEDDING_BULK_MAX_ATTEMPTS
+    max_wait = resilience.CHAT_MAX_BACKOFF if interactive else 60
+    return retrying_class(retry=retry_if_exception_type(resilience.RETRYABLE_ERRORS), wait=lambda retry_state: wait_for_quota(retry_state, max_wait),
+                          stop=stop_after_attempt(attempts), before_sleep=before_retry_sleep, reraise=True)
+
+
+def embed_batch(inputs, deployment=AZURE_OPENAI_EMB_DEPLOYMENT, priority=rate_limit.INTERACTIVE, api=None):
+    # api: api_type, api_key, api_base and api_version for callers that don't use the ones the
+    # chat functions set on the openai module, those are shared by the whole worker
+    return retrying(priority)(_embed_batch, inputs, deployment, priority, api)
+
+
+async def embed_batch_async(inputs, deployment=AZURE_OPENAI_EMB_DEPLOYMENT, priority=rate_limit.INTERACTIVE):
+    return await retrying(priority, AsyncRetrying)(_embed_batch_async, inputs, deployment, priority)
+
+
+def _embed_batch(inputs, deployment, priority, api=None):
+    # Query embeddings of the chat functions go first, the bulk ones of Upload_files leave them room
+    rate_limit.acquire(deployment, sum(estimate_tokens(text) for text in inputs), priority)
+    with telemetry.span("embedding", inputs=len(inputs)):
+        try:
+            response = openai.Embedding.create(engine=deployment, input=inputs, **(api or {}))
+        except openai.error.OpenAIError as e:
+            rate_limit.note_error(deployment, e)
+            raise
+    telemetry.record_usage("embedding", deployment, response.get("usage"))
+    # The service returns an index per input, don't rely on the order of data
+    return {item["index"]: item["embedding"] for item in response["data"]}
+
+
+async def _embed_batch_async(inputs, deployment, priority):
+    # The quota wait may block, keep it off the event loop
+    await asyncio.to_thread(rate_limit.acquire, deployment, sum(estimate_tokens(text) for text in inputs), priority)
+    with telemetry.span("embedding", inputs=len(inputs)):
+        try:
+            response = await openai.Embedding.acreate(engine=deployment, input=inputs)
+        except openai.error.OpenAIError as e:
+            rate_limit.note_error(deployment, e)
+            raise
+    telemetry.record_usage("embedding", deployment, response.get("usage"))
+    return {item["index"]: item["embedding"] for item in response["data"]}
+
+
+def embed_texts(texts, deployment=AZURE_OPENAI_EMB_DEPLOYMENT, priority=rate_limit.INTERACTIVE, api=None):
+    texts = list(texts)
+    vectors = [None] * len(texts)
+    for batch in make_batches(texts):
+        embedded = embed_batch([texts[i] for i in batch], deployment, priority, api)
+        for position, i in enumerate(batch):
+            vectors[i] = embedded[position]
+    return vectors
+
+
+def embed_text(text, deployment=AZURE_OPENAI_EMB_DEPLOYMENT):
+    return embed_texts([text], deployment)[0]
+
+
+async def embed_texts_async(texts, deployment=AZURE_OPENAI_EMB_DEPLOYMENT, priority=rate_limit.INTERACTIVE):
+    texts = list(texts)
+    vectors = [None] * len(texts)
+    batches = list(make_batches(texts))
+    embedded = await asyncio.gather(*(embed_batch_async([texts[i] for i in batch], deployment, priority) for batch in batches))
+    for batch, batch_vectors in zip(batches, embedded):
+        for position, i in enumerate(batch):
+            vectors[i] = batch_vectors[position]
+    return vectors
+
+
+async def embed_text_async(text, deployment=AZURE_OPENAI_EMB_DEPLOYMENT):
+    return (await embed_texts_async([text], deployment))[0]
@@ -0,0 +1,128 @@
+import asyncio
+import os
+import threading
+
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
+
+from shared_code import cosmos
+
+# Every worker reserves this many ids at a time from the counter document (hi/lo), so
+# Cosmos is only touched once per block instead of scanning every partition per request
+ID_BLOCK_SIZE = int(os.environ.get("ID_BLOCK_SIZE") or 20)
+ID_COUNTER_DOCUMENT = os.environ.get("ID_COUNTER_DOCUMENT") or "id-counter"
+
+
+class IdAllocator:
+    def __init__(self, container, block_size=ID_BLOCK_SIZE, counter_id=ID_COUNTER_DOCUMENT):
+        self.container = container
+        self.block_size = block_size
+        self.counter_id = counter_id
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+
+    def next_id(self):
+        with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = self._reserve_block()
+            value = self._next
+            self._next += 1
+            return value
+
+    def _reserve_block(self):
+        while True:
+            counter = self._read_counter()
+            start = counter["next_id"]
+            counter["next_id"] = start + self.block_size
+            try:
+                # Only succeeds if nobody else moved the counter since we read it
+                self.container.replace_item(
+                    item=self.counter_id,
+                    body=counter,
+                    etag=counter["_etag"],
+                    match_condition=MatchConditions.IfNotModified)
+                return start, start + self.block_size
+            except exceptions.CosmosAccessConditionFailedError:
+                continue
+
+    def _read_counter(self):
+        try:
+            return self.container.read_item(item=self.counter_id, partition_key=self.counter_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+        # First run against this container, continue after the ids that are already in use
+        results = list(self.container.query_items("SELECT VALUE MAX(c.id_identity) FROM c", enable_cross_partition_query=True))
+        max_id = results[0] if results and results[0] is not None else 0
+        try:
+            self.container.create_item(body={
+                "id": self.counter_id,
+                "partitionKey": self.counter_id,
+                "next_id": max_id + 1
+            })
+        except exceptions.CosmosResourceExistsError:
+            # Another worker created it first
+            pass
+        return self.container.read_item(item=self.counter_id, partition_key=self.counter_id)
+
+
+class AsyncIdAllocator(IdAllocator):
+    # The same blocks from the same counter document, for a container of azure.cosmos.aio
+    def __init__(self, container, block_size=ID_BLOCK_SIZE, counter_id=ID_COUNTER_DOCUMENT):
+        super().__init__(container, block_size, counter_id)
+        self._lock = asyncio.Lock()
+
+    async def next_id(self):
+        async with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = await self._reserve_block()
+            value = self._next
+            self._next += 1
+            return value
+
+    async def _reserve_block(self):
+        while True:
+            counter = await self._read_counter()
+            start = counter["next_id"]
+            counter["next_id"] = start + self.block_size
+            try:
+                await self.container.replace_item(
+                    item=self.counter_id,
+                    body=counter,
+                    etag=counter["_etag"],
+                    match_condition=MatchConditions.IfNotModified)
+                return start, start + self.block_size
+            except exceptions.CosmosAccessConditionFailedError:
+                continue
+
+    async def _read_counter(self):
+        try:
+            return await self.container.read_item(item=self.counter_id, partition_key=self.counter_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+        results = [value async for value in self.container.query_items("SELECT VALUE MAX(c.id_identity) FROM c")]
+        max_id = results[0] if results and results[0] is not None else 0
+        try:
+            await self.container.create_item(body={
+                "id": self.counter_id,
+                "partitionKey": self.counter_id,
+                "next_id": max_id + 1
+            })
+        except exceptions.CosmosResourceExistsError:
+            pass
+        return await self.container.read_item(item=self.counter_id, partition_key=self.counter_id)
+
+
+_lock = threading.Lock()
+_allocator = None
+
+
+def next_id():
+    global _allocator
+    if _allocator is None:
+        with _lock:
+            if _allocator is None:
+                _allocator = IdAllocator(cosmos.get_container())
+    return _allocator.next_id()
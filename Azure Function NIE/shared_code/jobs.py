@@ -0,0 +1,149 @@
+import logging
+import os
+import threading
+import time
+import uuid
+
+from shared_code import stores
+
+# Where job status lives: "cosmos" in Azure so any instance can answer the status call,
+# "sqlite" or "memory" when running locally
+JOB_STORE = os.environ.get("JOB_STORE") or "cosmos"
+JOB_CONTAINER = os.environ.get("JOB_CONTAINER") or "jobs"
+JOB_SQLITE_PATH = os.environ.get("JOB_SQLITE_PATH") or "jobs.sqlite3"
+# Finished jobs are removed after this many seconds
+JOB_TTL = int(os.environ.get("JOB_TTL") or 86400)
+# A job runs on a thread of the worker that accepted it and is lost when that worker stops (scale
+# in, restart, deployment). While it runs it writes a heartbeat every JOB_HEARTBEAT_INTERVAL
+# seconds, a job that is queued or running without one for JOB_STALE_AFTER seconds is reported as
+# failed. Sent again with the same request_id, the request resumes from its checkpoint.
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get("JOB_HEARTBEAT_INTERVAL") or 15)
+JOB_STALE_AFTER = float(os.environ.get("JOB_STALE_AFTER") or 120)
+# The outline streams into job["partial"] while it is generated, saved at most every
+# JOB_PARTIAL_INTERVAL seconds so a poller sees it grow without one write per token
+JOB_PARTIAL_INTERVAL = float(os.environ.get("JOB_PARTIAL_INTERVAL") or 2)
+
+
+def wants_async(req):
+    mode = req.params.get("mode")
+    if mode is None:
+        try:
+            mode = (req.get_json() or {}).get("mode")
+        except ValueError:
+            mode = None
+    return str(mode).lower() == "async"
+
+
+_lock = threading.Lock()
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _lock:
+            if _store is None:
+                # Cosmos removes the job documents by itself once the TTL has passed
+                _store = stores.make_store(JOB_STORE, JOB_CONTAINER, JOB_SQLITE_PATH, JOB_TTL)
+    return _store
+
+
+def submit(run, Input, store=None):
+    # Starts run(Input, on_event=...) in the background and returns the job id right away
+    store = store or get_store()
+    job = {
+        "id": str(uuid.uuid4()),
+        "status": "queued",
+        "input": Input,
+        "stage": None,
+        "stages": [],
+        "result": None,
+        "partial": None,
+        "error": None,
+        "created": time.time(),
+        "updated": time.time(),
+        "heartbeat": time.time(),
+    }
+    store.put(job)
+    lock = threading.Lock()
+    finished = threading.Event()
+
+    def heartbeat():
+        while not finished.wait(JOB_HEARTBEAT_INTERVAL):
+            with lock:
+                if finished.is_set():
+                    return
+                job["heartbeat"] = time.time()
+                try:
+                    store.put(job)
+                except Exception:
+                    logging.exception(f"Heartbeat of job {job['id']} couldn't be saved")
+
+    def on_event(event, data):
+        if event == "course":
+            # Batch jobs keep every finished course, the client can show them before the rest is done
+            with lock:
+                job.setdefault("courses", []).append(data)
+                job["updated"] = time.time()
+                store.put(job)
+            return
+        if event == "token":
+            with lock:
+                job["partial"] = (job["partial"] or "") + data["text"]
+                now = time.time()
+                if now - job["updated"] >= JOB_PARTIAL_INTERVAL:
+                    job["updated"] = now
+                    store.put(job)
+            return
+        if event != "stage":
+            return
+        with lock:
+            now = time.time()
+            # A stage that streams starts over, repair stages after it keep what it wrote
+            if data["stage"] == "elaborate":
+                job["partial"] = None
+            if job["stages"]:
+                job["stages"][-1]["finished"] = now
+            job["stages"].append({"stage": data["stage"], "started": now, "finished": None})
+            job["stage"] = data["stage"]
+            job["updated"] = now
+            store.put(job)
+
+    def target():
+        with lock:
+            job["status"] = "running"
+            job["heartbeat"] = time.time()
+            store.put(job)
+        threading.Thread(target=heartbeat, daemon=True).start()
+        try:
+            result = run(Input, on_event=on_event)
+        except Exception as e:
+            logging.exception(f"Job {job['id']} failed")
+            status, result, error = "failed", None, str(e)
+        else:
+            status, error = "succeeded", None
+        finished.set()
+        with lock:
+            now = time.time()
+            job["status"] = status
+            job["result"] = result
+            job["partial"] = None if status == "succeeded" else job["partial"]
+            job["error"] = error
+            if job["stages"]:
+                job["stages"][-1]["finished"] = now
+            job["updated"] = now
+            store.put(job)
+
+    threading.Thread(target=target, daemon=True).start()
+    return job["id"]
+
+
+def get(job_id, store=None):
+    job = (store or get_store()).get(job_id)
+    if job is not None and job["status"] in ("queued", "running"):
+        last_seen = max(job.get("heartbeat") or 0, job["updated"])
+        if time.time() - last_seen > JOB_STALE_AFTER:
+            # Nobody works on it any more, the worker that had it stopped
+            job["status"] = "failed"
+            job["error"] = f"The job stopped with its worker, there was no sign of it for {time.time() - last_seen:.0f}s. Send the request again, with the same request_id it continues where it stopped."
+    return job
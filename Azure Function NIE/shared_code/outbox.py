@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import threading
+import uuid
+
+from shared_code import cosmos, id_allocator, outcomes
+
+# Outcome documents are written to Cosmos DB from a storage queue instead of before the response.
+# The request only sends the document to the queue, the Write_outcomes function takes it from there
+# and writes it. A failed write leaves the message in the queue, the host retries it later and moves
+# it to outcomes-poison after maxDequeueCount attempts (host.json). Nothing is kept on the instance,
+# so an instance that is scaled in or recycled loses nothing.
+OUTBOX = (os.environ.get("OUTBOX") or "true").lower() == "true"
+# "storage" or "memory", the memory queue keeps the documents in the worker until drain() is
+# called and is only meant for local runs and the benchmarks
+OUTBOX_QUEUE_TYPE = os.environ.get("OUTBOX_QUEUE_TYPE") or "storage"
+# The storage account of the function app, the queue trigger of Write_outcomes reads from the same one
+OUTBOX_CONNECTION = os.environ.get("OUTBOX_CONNECTION") or os.environ.get("AzureWebJobsStorage")
+# Must match queueName in Write_outcomes/function.json
+OUTBOX_QUEUE = os.environ.get("OUTBOX_QUEUE") or "outcomes"
+# Queue messages are limited to 64 KB (48 KB before base64), larger documents are saved as a blob
+# in this container and the message only holds its name
+OUTBOX_CONTAINER = os.environ.get("OUTBOX_CONTAINER") or "outbox"
+OUTBOX_MAX_MESSAGE = int(os.environ.get("OUTBOX_MAX_MESSAGE") or 45000)
+
+
+class StorageQueue:
+    def __init__(self, connection=OUTBOX_CONNECTION, queue=OUTBOX_QUEUE, container=OUTBOX_CONTAINER):
+        from azure.storage.blob import BlobServiceClient
+        from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+
+        # The queue trigger expects base64 messages
+        self.queue = QueueClient.from_connection_string(connection, queue, message_encode_policy=TextBase64EncodePolicy())
+        self.container = BlobServiceClient.from_connection_string(connection).get_container_client(container)
+        self._created = False
+
+    def _create(self):
+        # Once per worker, both exist after the first deployment
+        if self._created:
+            return
+        for create in (self.queue.create_queue, self.container.create_container):
+            try:
+                create()
+            except Exception as e:
+                if getattr(e, "status_code", None) != 409:
+                    raise
+        self._created = True
+
+    def send(self, message):
+        self._create()
+        self.queue.send_message(message)
+
+    def save(self, name, body):
+        self._create()
+        self.container.upload_blob(name, body, overwrite=True)
+
+    def load(self, name):
+        return self.container.download_blob(name).readall().decode()
+
+    def remove(self, name):
+        self.container.delete_blob(name)
+
+
+class MemoryQueue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.messages = []
+        self.blobs = {}
+
+    def send(self, message):
+        with self._lock:
+            self.messages.append(message)
+
+    def save(self, name, body):
+        with self._lock:
+            self.blobs[name] = body
+
+    def load(self, name):
+        with self._lock:
+            return self.blobs[name]
+
+    def remove(self, name):
+        with self._lock:
+            self.blobs.pop(name, None)
+
+    def take(self):
+        with self._lock:
+            messages, self.messages = self.messages, []
+        return messages
+
+
+_lock = threading.Lock()
+_queue = None
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        with _lock:
+            if _queue is None:
+                if OUTBOX_QUEUE_TYPE == "memory":
+                    _queue = MemoryQueue()
+                else:
+                    _queue = StorageQueue()
+    return _queue
+
+
+def assign_id(document):
+    # Taken before the document is queued, a message that is delivered twice upserts the same document
+    if "id" not in document:
+        outcomes.set_id(document, id_allocator.next_id())
+    return document
+
+
+def put(document):
+    # Returns once the queue has the document, the write to Cosmos happens in Write_outcomes
+    assign_id(document)
+    body = json.dumps(document)
+    queue = get_queue()
+    try:
+        if len(body.encode()) > OUTBOX_MAX_MESSAGE:
+            name = f"{document['id']}-{uuid.uuid4().hex}.json"
+            queue.save(name, body)
+            body = json.dumps({"blob": name})
+        queue.send(body)
+    except Exception as e:
+        # Better late in the response than lost
+        logging.warning(f"Could not queue outcome {document['id']}, writing it now: {e}")
+        cosmos.get_container().upsert_item(body=document)
+
+
+def write(message):
+    # Called by Write_outcomes for every message. An error is raised to the host, which retries the message.
+    # Upserts because a message may come again after a write whose answer got lost.
+    document = json.loads(message)
+    blob = document.get("blob") if len(document) == 1 else None
+    queue = get_queue()
+    if blob:
+        document = json.loads(queue.load(blob))
+    cosmos.get_container().upsert_item(body=document)
+    if blob:
+        try:
+            queue.remove(blob)
+        except Exception as e:
+            logging.warning(f"Could not remove outbox blob {blob}: {e}")
+
+
+def drain():
+    # Writes what the memory queue holds, like Write_outcomes does for the storage queue
+    queue = get_queue()
+    if isinstance(queue, MemoryQueue):
+        for message in queue.take():
+            write(message)
@@ -0,0 +1,166 @@
+import base64
+import datetime
+import hashlib
+import os
+import zlib
+
+from shared_code import context, retrieval, token_budget
+
+# How the conversations are stored in Cosmos DB:
+#   compact - the source chunks of the engage turns are stored as their ids, long assistant
+#             answers are compressed and the partition key is "<user>/<yyyy-mm-dd>/<bucket>"
+#   full    - every message as it was sent, partitioned by the hash of the response (the old format)
+OUTCOME_FORMAT = os.environ.get("OUTCOME_FORMAT") or "compact"
+# Assistant answers longer than this are stored zlib compressed
+OUTCOME_COMPRESS_MIN_CHARS = int(os.environ.get("OUTCOME_COMPRESS_MIN_CHARS") or 2000)
+# Documents of one user and day are spread over this many logical partitions, all anonymous
+# requests of a day would otherwise land in a single one
+OUTCOME_PARTITION_BUCKETS = int(os.environ.get("OUTCOME_PARTITION_BUCKETS") or 8)
+# 2 added source_lines, what migrate_outcomes.py writes
+COMPACT_VERSION = 2
+
+
+def request_user(req):
+    # The signed in user when App Service authentication is on, otherwise what the client sent
+    user = req.headers.get("x-ms-client-principal-name") or req.params.get("user")
+    if not user:
+        try:
+            user = (req.get_json() or {}).get("user")
+        except ValueError:
+            user = None
+    return str(user or "")
+
+
+def partition_key(user, created, seed=""):
+    # Documents of one user and day share OUTCOME_PARTITION_BUCKETS logical partitions, so "my
+    # outlines of today/this week" query a few partitions instead of one per document. seed picks
+    # the bucket, e.g. the response.
+    bucket = int(hashlib.sha256(seed.encode("utf-8")).hexdigest(), 16) % OUTCOME_PARTITION_BUCKETS
+    return f"{user or 'anonymous'}/{created:%Y-%m-%d}/{bucket}"
+
+
+def compress(text):
+    return base64.b64encode(zlib.compress(text.encode("utf-8"), 9)).decode("ascii")
+
+
+def decompress(data):
+    return zlib.decompress(base64.b64decode(data)).decode("utf-8")
+
+
+def compact_message(message, source_ids=None, source_lines=None):
+    # source_lines: every line of the SOURCES block in order, the id of a chunk when the line is
+    # "<sourcepage>: <content>" of that chunk, otherwise {"text": line} with the line as it was
+    message = dict(message)
+    content = message.get("content") or ""
+    if source_lines is not None and token_budget.SOURCES_MARKER in content:
+        message["content"] = content.split(token_budget.SOURCES_MARKER, 1)[0]
+        message["source_lines"] = list(source_lines)
+    elif source_ids is not None and token_budget.SOURCES_MARKER in content:
+        # The chunk text is in the search index already, keep only the question and which chunks it got
+        message["content"] = content.split(token_budget.SOURCES_MARKER, 1)[0]
+        message["sources"] = list(source_ids)
+    elif message["role"] == "assistant" and len(content) > OUTCOME_COMPRESS_MIN_CHARS:
+        message["content_zlib"] = compress(content)
+        del message["content"]
+    return message
+
+
+def compact_conversation(messages, sources):
+    # sources maps the index of an engage user message to the ids of its chunks, see pipeline.engage_steps
+    return [compact_message(message, sources.get(i)) for i, message in enumerate(messages)]
+
+
+def make_document(next_id, messages, response, sources, user="", telemetry_summary=None, created=None, outcome_format=None):
+    outcome_format = outcome_format or OUTCOME_FORMAT
+    created = created or datetime.datetime.now(datetime.timezone.utc)
+    document = {}
+    if next_id is not None:
+        set_id(document, next_id)
+    document["user"] = user or ""
+    if outcome_format == "full":
+        # Hash of the response, every document in its own logical partition
+        document["partitionKey"] = hashlib.sha256(response.encode()).hexdigest()
+        document["chat_conversation"] = messages
+    else:
+        document["partitionKey"] = partition_key(user, created, response)
+        document["format"] = "compact"
+        document["format_version"] = COMPACT_VERSION
+        document["created"] = created.isoformat()
+        document["chat_conversation"] = compact_conversation(messages, sources)
+    document["telemetry"] = telemetry_summary
+    return document
+
+
+def set_id(document, next_id):
+    # Documents that go through the outbox get their id when they are queued, see shared_code/outbox.py
+    document["id"] = f"NIE - {next_id}"
+    document["id_identity"] = next_id
+    return document
+
+
+def is_compact(document):
+    return document.get("format") == "compact"
+
+
+def search_lookup(search_client):
+    # lookup(ids) -> {id: chunk} straight from the search index
+    def lookup(ids):
+        chunks = {}
+        for chunk_id in ids:
+            try:
+                doc = search_client.get_document(key=chunk_id, selected_fields=["id", retrieval.KB_FIELDS_SOURCEPAGE, retrieval.KB_FIELDS_CONTENT])
+            except Exception:
+                continue
+            chunks[chunk_id] = {
+                "id": chunk_id,
+                "sourcepage": str(doc[retrieval.KB_FIELDS_SOURCEPAGE]),
+                "content": str(doc[retrieval.KB_FIELDS_CONTENT]).replace("\n", "").replace("\r", "")
+            }
+        return chunks
+    return lookup
+
+
+def missing_chunk(chunk_id):
+    return {"id": chunk_id, "sourcepage": chunk_id, "content": "(no longer in the index)"}
+
+
+def expand_conversation(messages, lookup):
+    # Back to the messages that were sent, with the chunk text taken from the index as it is now
+    assembler = context.ContextAssembler()
+    ids = [chunk_id for message in messages for chunk_id in message.get("sources") or []]
+    ids += [line for message in messages for line in message.get("source_lines") or [] if isinstance(line, str)]
+    chunks = lookup(list(dict.fromkeys(ids))) if ids else {}
+    expanded = []
+    for message in messages:
+        message = dict(message)
+        if "content_zlib" in message:
+            message["content"] = decompress(message.pop("content_zlib"))
+        if "source_lines" in message:
+            # Migrated documents: line by line as they were sent, nothing is deduplicated
+            lines = []
+            for line in message.pop("source_lines"):
+                if isinstance(line, dict):
+                    lines.append(line["text"])
+                else:
+                    chunk = chunks.get(line) or missing_chunk(line)
+                    lines.append(chunk["sourcepage"] + ": " + chunk["content"])
+            message["content"] += token_budget.SOURCES_MARKER + "\n".join(lines)
+        elif "sources" in message:
+            # Written by the pipeline, whose ContextAssembler pasted each chunk once per conversation
+            found = [chunks.get(chunk_id) or missing_chunk(chunk_id) for chunk_id in message.pop("sources")]
+            text = assembler.user_message(message["content"], found)
+            # Version 1 migrations kept the lines they couldn't match to a chunk at the end
+            unresolved = message.pop("sources_text", None)
+            if unresolved:
+                text += ("\n" if found else "") + unresolved
+            message["content"] = text
+        expanded.append(message)
+    return expanded
+
+
+def expand_document(document, lookup):
+    if not is_compact(document):
+        return document
+    document = dict(document)
+    document["chat_conversation"] = expand_conversation(document["chat_conversation"], lookup)
+    return document
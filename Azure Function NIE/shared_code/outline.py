@@ -0,0 +1,181 @@
+import json
+import os
+
+# How many times the elaborate stage is asked to fill in a missing, broken or cut off part
+# of the outline JSON before the best effort is returned. 0 turns the repair off.
+OUTLINE_REPAIR_ATTEMPTS = int(os.environ.get("OUTLINE_REPAIR_ATTEMPTS") or 2)
+
+# The structure the ELABORATE prompt asks for
+OUTLINE_FIELDS = ["Course synopsis", "ILOs for entire course", "TE21", "Week"]
+WEEK_FIELDS = ["Week", "Course topics", "ILOs achieved", "ATs", "TLAs", "Ed tech tools", "Other learning resources", "Mode of learning"]
+
+_decoder = json.JSONDecoder()
+
+
+def _skip(text, i):
+    while i < len(text) and text[i] in " \t\r\n":
+        i += 1
+    return i
+
+
+def _decode(text, i):
+    # (value, next position) or None when the value is broken or cut off
+    try:
+        return _decoder.raw_decode(text, i)
+    except ValueError:
+        return None
+
+
+def parse(text):
+    # Reads the outline one field at a time, and the weeks one at a time, so everything before
+    # the point where the JSON is cut off or broken is kept. Returns (course, complete, weeks_closed).
+    course = {}
+    weeks_closed = False
+    start = text.find("{")
+    if start < 0:
+        return course, False, weeks_closed
+    i = start + 1
+    while True:
+        i = _skip(text, i)
+        if i >= len(text):
+            return course, False, weeks_closed
+        if text[i] == "}":
+            return course, True, weeks_closed
+        if text[i] == ",":
+            i += 1
+            continue
+
+        decoded = _decode(text, i)
+        if decoded is None or not isinstance(decoded[0], str):
+            return course, False, weeks_closed
+        key, i = decoded
+        i = _skip(text, i)
+        if i >= len(text) or text[i] != ":":
+            return course, False, weeks_closed
+        i = _skip(text, i + 1)
+
+        if key == "Week" and text[i:i + 1] == "[":
+            weeks = course["Week"] = []
+            i += 1
+            while True:
+                i = _skip(text, i)
+                if i >= len(text):
+                    return course, False, False
+                if text[i] == "]":
+                    weeks_closed = True
+                    i += 1
+                    break
+                if text[i] == ",":
+                    i += 1
+                    continue
+                decoded = _decode(text, i)
+                if decoded is None:
+                    return course, False, False
+                week, i = decoded
+                weeks.append(week)
+            continue
+
+        decoded = _decode(text, i)
+        if decoded is None:
+            return course, False, weeks_closed
+        course[key], i = decoded
+
+
+def loads(text):
+    # The parsed outline, None when the text holds no complete outline object
+    if not text:
+        return None
+    course, complete, _ = parse(text)
+    return course if complete else None
+
+
+def _filled(value):
+    return value not in (None, "", [], {})
+
+
+def _field_ok(course, field):
+    value = course.get(field)
+    if field == "TE21" and not isinstance(value, (dict, str)):
+        return False
+    return _filled(value)
+
+
+def _week_ok(week):
+    return isinstance(week, dict) and all(field in week for field in WEEK_FIELDS)
+
+
+def check(text):
+    # Parses the answer of the elaborate stage and lists what is wrong with it
+    course, _, weeks_closed = parse(text)
+    return course, problems(course, weeks_closed)
+
+
+def problems(course, weeks_closed=True):
+    missing = [field for field in OUTLINE_FIELDS if field != "Week" and not _field_ok(course, field)]
+    weeks = course.get("Week")
+    broken = []
+    if isinstance(weeks, list):
+        broken = [week_number(week, i) for i, week in enumerate(weeks) if not _week_ok(week)]
+    return {
+        "missing": missing,
+        # No weeks at all, or the list was cut off before its closing bracket
+        "weeks_truncated": not isinstance(weeks, list) or not weeks or not weeks_closed,
+        "broken_weeks": broken,
+    }
+
+
+def is_valid(problems):
+    return not (problems["missing"] or problems["weeks_truncated"] or problems["broken_weeks"])
+
+
+def week_number(week, index):
+    if isinstance(week, dict):
+        try:
+            return int(str(week.get("Week")).split()[-1])
+        except (ValueError, IndexError):
+            pass
+    return index + 1
+
+
+def repair_request(course, problems):
+    # One line per part the model has to send again
+    parts = [f'- "{field}"' for field in problems["missing"]]
+    weeks = []
+    if problems["broken_weeks"]:
+        weeks.append("weeks " + ", ".join(str(n) for n in problems["broken_weeks"]) + " again, each with all of " + ", ".join(f'"{f}"' for f in WEEK_FIELDS))
+    if problems["weeks_truncated"]:
+        existing = course.get("Week") if isinstance(course.get("Week"), list) else []
+        good = [week_number(week, i) for i, week in enumerate(existing) if _week_ok(week)]
+        weeks.append(f"the remaining weeks of the course, starting from week {max(good) + 1}" if good else "every week of the course")
+    if weeks:
+        parts.append('- "Week": a list with ' + " and ".join(weeks))
+    return "\n".join(parts)
+
+
+def merge(course, repair):
+    # Takes the fields the repair answer brings, broken weeks are replaced by number and new weeks appended
+    merged = dict(course)
+    for field in OUTLINE_FIELDS:
+        if field != "Week" and _field_ok(repair, field) and not _field_ok(merged, field):
+            merged[field] = repair[field]
+    new_weeks = repair.get("Week")
+    new_weeks = [week for week in new_weeks if isinstance(week, dict)] if isinstance(new_weeks, list) else []
+    if new_weeks:
+        weeks = merged.get("Week")
+        weeks = list(weeks) if isinstance(weeks, list) else []
+        positions = {week_number(week, i): i for i, week in enumerate(weeks)}
+        for week in new_weeks:
+            number = week_number(week, len(weeks))
+            if number in positions:
+                # Never trade a complete week for a worse one
+                if not _week_ok(weeks[positions[number]]):
+                    weeks[positions[number]] = week
+            else:
+                positions[number] = len(weeks)
+                weeks.append(week)
+        merged["Week"] = [week for _, week in sorted(enumerate(weeks), key=lambda pair: week_number(pair[1], pair[0]))]
+    return merged
+
+
+def dumps(course):
+    return json.dumps(course, ensure_ascii=False, indent=4)
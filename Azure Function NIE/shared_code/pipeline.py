@@ -0,0 +1,445 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import openai
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+
+from shared_code import checkpoints, config, context, cosmos, embeddings, id_allocator, outbox, outcomes, outline, priming_cache, prompts, rate_limit, resilience, result_cache, retrieval, semantic_cache, stages, streaming, telemetry, token_budget, vector_index
+
+# All the secrets are fetched concurrently once per worker and cached, see shared_code/config.py
+config.load()
+
+# Replace these with your own values, either in environment variables or directly here
+AZURE_SEARCH_SERVICE = config.get("azure-search-service")
+AZURE_SEARCH_INDEX = config.get("azure-search-index")
+AZURE_OPENAI_SERVICE = config.get("azure-openai-service")
+AZURE_SEARCH_API_KEY = config.get("azure-search-api-key")
+
+# Only needed to point the functions somewhere else than the public endpoints, e.g. the fakes in benchmarks/
+AZURE_OPENAI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT") or f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+AZURE_SEARCH_ENDPOINT = os.environ.get("AZURE_SEARCH_ENDPOINT") or f"https://{AZURE_SEARCH_SERVICE}.search.windows.net"
+
+# The two chat deployments the stages can be routed to
+AZURE_OPENAI_GPT4_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT4_DEPLOYMENT") or config.get("azure-openai-chatgpt")
+AZURE_OPENAI_GPT35_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT35_DEPLOYMENT") or config.get("azure-openai-chatgpt")
+# Context windows by deployment name, e.g. "chat35=4096,chat4=8192". The deployment names don't
+# say which model is behind them, so a deployment without a window here uses CHAT_CONTEXT_WINDOW
+# and prompts to it are not trimmed when that isn't set either.
+CHAT_CONTEXT_WINDOWS = {
+    name.strip(): int(window)
+    for name, window in (item.split("=", 1) for item in (os.environ.get("CHAT_CONTEXT_WINDOWS") or "").split(",") if "=" in item)
+}
+
+CHATGPT_TEMPERATURE = 0.2
+
+STAGES = ["engage", "explore", "explain", "elaborate"]
+
+# Courses of one batch request that are generated at the same time, and how many one batch may ask for
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY") or 4)
+BATCH_MAX_INPUTS = int(os.environ.get("BATCH_MAX_INPUTS") or 30)
+
+# Used by the OpenAI SDK
+openai.api_base = AZURE_OPENAI_ENDPOINT
+openai.api_version = "2023-05-15"
+
+# Comment these two lines out if using keys, set your API key in the OPENAI_API_KEY environment variable and set openai.api_type = "azure" instead
+openai.api_type = "azure"
+# openai.api_key = azure_credential.get_token("https://cognitiveservices.azure.com/.default").token
+
+# Set up clients for Cognitive Search and Storage
+search_client = SearchClient(
+    endpoint=AZURE_SEARCH_ENDPOINT,
+    index_name=AZURE_SEARCH_INDEX,
+    credential=AzureKeyCredential(AZURE_SEARCH_API_KEY))
+
+# Load the local mirror of the search corpus when the worker starts instead of on the first request,
+# copying the search index into it when it is empty or out of date
+if retrieval.RETRIEVAL_BACKEND != "search":
+    try:
+        vector_index.sync(search_client)
+    except Exception:
+        logging.exception("The local vector index couldn't be synced from the search index")
+
+# Keeps every prompt inside the context window of its deployment, see shared_code/token_budget.py
+_budgets = {}
+
+
+def get_budget(context_window):
+    if context_window not in _budgets:
+        _budgets[context_window] = token_budget.TokenBudget(context_window=context_window)
+    return _budgets[context_window]
+
+
+def context_window(deployment):
+    return CHAT_CONTEXT_WINDOWS.get(deployment, token_budget.CHAT_CONTEXT_WINDOW)
+
+
+def route_budget(route, deployment):
+    # The fallback deployment may have a smaller window than the one the route was set up for
+    if deployment == route["deployment"]:
+        return get_budget(route["context_window"])
+    return get_budget(context_window(deployment))
+
+
+def stage_routes(default, fallback=None, env_prefix=None, **stages):
+    # Builds {stage: route} where a route says which deployment, max_tokens and temperature
+    # a stage runs with, and which deployment to try when that one is throttled.
+    # Any of them can be overridden with <env_prefix>_<STAGE>_DEPLOYMENT, _FALLBACK, _MAX_TOKENS,
+    # _TEMPERATURE and _CONTEXT_WINDOW app settings.
+    routes = {}
+    for stage in STAGES:
+        def setting(name, value):
+            if not env_prefix:
+                return value
+            return os.environ.get(f"{env_prefix}_{stage.upper()}_{name}") or value
+
+        deployment = setting("DEPLOYMENT", stages.get(stage, default))
+        routes[stage] = {
+            "stage": stage,
+            "deployment": deployment,
+            "fallback": setting("FALLBACK", fallback if fallback != deployment else None),
+            "max_tokens": int(setting("MAX_TOKENS", 2048)),
+            "temperature": float(setting("TEMPERATURE", CHATGPT_TEMPERATURE)),
+            "context_window": int(setting("CONTEXT_WINDOW", context_window(deployment)) or 0) or None,
+        }
+    return routes
+
+
+def create_completion(messages, route, deployment, on_token=None):
+    # Defining a function to send the prompt to the ChatGPT model
+    # More info : https://learn.microsoft.com/en-us/azure/cognitive-services/openai/how-to/chatgpt?pivots=programming-language-chat-completions
+    budget = route_budget(route, deployment)
+    messages = budget.fit(messages, route["max_tokens"])
+    # The service charges max_tokens against the quota up front, so do we
+    rate_limit.acquire(deployment, budget.count(messages) + route["max_tokens"])
+    with telemetry.span("chat", stage=route["stage"], deployment=deployment, stream=on_token is not None):
+        if on_token is None:
+            response = openai.ChatCompletion.create(
+                engine=deployment,
+                messages=messages,
+                temperature=route["temperature"],
+                max_tokens=route["max_tokens"],
+                request_timeout=resilience.CHAT_TIMEOUT
+            )
+            telemetry.record_usage(route["stage"], deployment, response.get("usage"))
+            return response['choices'][0]['message']['content']
+
+        # Forward the completion piece by piece as it is generated
+        response = openai.ChatCompletion.create(
+            engine=deployment,
+            messages=messages,
+            temperature=route["temperature"],
+            max_tokens=route["max_tokens"],
+            request_timeout=resilience.CHAT_TIMEOUT,
+            stream=True
+        )
+        content = streaming.collect(response, on_token)
+        # Streamed responses carry no usage, count the tokens ourselves
+        telemetry.record_usage(route["stage"], deployment, {
+            "prompt_tokens": budget.count(messages),
+            "completion_tokens": budget.count_text(content),
+            "estimated": True
+        })
+        return content
+
+
+def send_message(messages, route, on_token=None):
+    # Timeouts, retries that honour Retry-After, a circuit breaker per deployment and the
+    # fallback deployment, see shared_code/resilience.py. Streamed calls are never hedged.
+    return resilience.call(
+        lambda deployment: create_completion(messages, route, deployment, on_token),
+        route["deployment"],
+        route["fallback"],
+        hedge=resilience.HEDGE_REQUESTS and on_token is None,
+        kind=(route["stage"], route["max_tokens"]))
+
+
+def run_steps(steps, calls=None):
+    # The pipeline is written once, as generators of steps shared by this module and
+    # shared_code/async_pipeline.py. A step yields (name, *args) for every call that blocks,
+    # the driver runs calls[name](*args) and sends the result back, or throws the error in.
+    # async_pipeline.run_steps drives the same steps with coroutines.
+    calls = calls or CALLS
+    result, error = None, None
+    while True:
+        try:
+            call = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = calls[call[0]](*call[1:]), None
+        except Exception as e:
+            result, error = None, e
+
+
+def engage_steps(messages, route):
+    engages = prompts.ENGAGES
+    deployment = route["deployment"]
+    temperature = route["temperature"]
+
+    # The priming turns don't depend on the request, reuse them until the index changes
+    # Taken before retrieval, an upload during this request must not make its answers look current
+    generation = yield ("blocking", priming_cache.index_generation)
+    cached = yield ("blocking", lambda: {engage: priming_cache.get(engage, deployment, temperature) for engage in engages})
+    missing = [engage for engage in engages if not cached[engage]]
+
+    # Fetch the sources of every uncached question at once, they don't depend on each other
+    retrieved = dict(zip(missing, (yield ("retrieve", missing))))
+
+    if retrieval.ENGAGE_INDEPENDENT_ANSWERS:
+        alone = [[messages[0], {"role": "user", "content": context.ContextAssembler().user_message(engage, retrieved[engage][1])}] for engage in missing]
+        answers = dict(zip(missing, (yield ("send_all", alone, route))))
+
+    # The seven searches overlap a lot, every chunk is pasted into the conversation only once
+    assembler = context.ContextAssembler()
+    # Index of every engage user message -> ids of its chunks, the compact outcome stores only these
+    source_ids = {}
+
+    for engage in engages:
+
+        if cached[engage]:
+            source_ids[len(messages)] = [chunk["id"] for chunk in cached[engage]["sources"]]
+            messages.append({"role": "user", "content": assembler.user_message(engage, cached[engage]["sources"])})
+            messages.append({"role": "assistant", "content": cached[engage]["answer"]})
+            continue
+
+        query_vector, sources = retrieved[engage]
+
+        # This is the first user message that will be sent to the model. Feel free to update this.
+        user_message = assembler.user_message(engage, sources)
+
+        # Create the list of messages. role can be either "user" or "assistant"
+        source_ids[len(messages)] = [chunk["id"] for chunk in sources]
+        messages.append({"role": "user", "content": user_message})
+
+        if retrieval.ENGAGE_INDEPENDENT_ANSWERS:
+            response = answers[engage]
+        else:
+            response = yield ("send", messages, route, None)
+        messages.append({"role": "assistant", "content": response})
+
+        yield ("blocking", priming_cache.put, engage, deployment, temperature, query_vector, sources, response, generation)
+
+    return source_ids
+
+
+def stage_steps(messages, prompt, route, on_token=None):
+    messages.append({"role": "system", "content": prompts.CONTINUE_SYSTEM_MESSAGE})
+    messages.append({"role": "user", "content": prompt})
+
+    response = yield ("send", messages, route, on_token)
+
+    messages.append({"role": "assistant", "content": response})
+    return response
+
+
+def complete_outline_steps(messages, response, route, notify):
+    # The elaborate answer has to be the outline JSON. When it is cut off at max_tokens or broken,
+    # only the missing part is asked for again in the same conversation instead of rerunning everything.
+    course, complete, weeks_closed = outline.parse(response)
+    problems = outline.problems(course, weeks_closed)
+    attempt = 0
+    while not outline.is_valid(problems) and attempt < outline.OUTLINE_REPAIR_ATTEMPTS:
+        attempt += 1
+        logging.info(f"Outline JSON needs repair {attempt}: {problems}")
+        notify("stage", {"stage": "repair", "problems": problems})
+        with telemetry.span("repair", attempt=attempt):
+            answer = yield from stage_steps(messages, prompts.REPAIR_OUTLINE.format(parts=outline.repair_request(course, problems)), route)
+        repair, _, repair_weeks_closed = outline.parse(answer)
+        course = outline.merge(course, repair)
+        weeks_closed = weeks_closed or repair_weeks_closed
+        problems = outline.problems(course, weeks_closed)
+
+    if not outline.is_valid(problems):
+        logging.warning(f"Outline JSON is still incomplete after {attempt} repairs: {problems}")
+    if not course or (attempt == 0 and (complete or not outline.is_valid(problems))):
+        # Nothing usable was parsed, or nothing had to change
+        return response
+    return outline.dumps(course)
+
+
+def prime_steps(routes):
+    # The system message and the seven engage turns, they are the same for every course
+    messages = [{"role": "system", "content": prompts.BASE_SYSTEM_MESSAGE.strip()}]
+    with telemetry.span("engage"):
+        sources = yield from engage_steps(messages, routes["engage"])
+    return messages, sources
+
+
+def outline_steps(Input, routes, on_event, user, primer, request_id):
+    def notify(event, data):
+        if on_event:
+            on_event(event, data)
+
+    # Many teachers ask for the same course, skip the ten LLM calls when it was generated before.
+    # The caches and checkpoints can sit in Cosmos DB or on disk, they are blocking calls.
+    with telemetry.span("result_cache"):
+        response = yield ("blocking", result_cache.get, Input, routes)
+    if response is not None:
+        notify("cache", {"hit": True})
+        return response
+
+    # Near duplicates of earlier requests, see shared_code/semantic_cache.py
+    seed = None
+    if semantic_cache.enabled():
+        with telemetry.span("semantic_cache"):
+            input_vector = yield ("embed", Input)
+            scope = yield ("blocking", result_cache.make_scope, routes)
+            match = yield ("blocking", lambda: semantic_cache.get_cache().lookup(input_vector, scope))
+        logging.info(f"Semantic cache: {semantic_cache.get_cache().stats()}")
+        if match:
+            seed, similarity = match
+            notify("cache", {"hit": True, "similar_input": seed["input"], "similarity": similarity})
+            if semantic_cache.SEMANTIC_CACHE_MODE == "return":
+                return seed["response"]
+
+    # A retry of a failed request continues after its last finished stage, see shared_code/checkpoints.py
+    checkpoint = checkpoints.Checkpoint(request_id, Input, routes, user)
+    if (yield ("blocking", checkpoint.load)):
+        notify("resume", {"stage": checkpoint.stage, "done": list(checkpoint.turns)})
+        messages, sources = checkpoint.messages, checkpoint.sources
+    else:
+        notify("stage", {"stage": "engage"})
+        if primer:
+            primed, sources = yield ("blocking", primer)
+        else:
+            primed, sources = yield from prime_steps(routes)
+        # The later stages append to their own copy, the primed turns may be shared with other courses
+        messages = list(primed)
+
+        if seed:
+            messages.append({"role": "system", "content": prompts.SEED_SYSTEM_MESSAGE.format(Input=seed["input"], outline=seed["response"])})
+        yield ("blocking", checkpoint.save, "engage", messages, sources)
+
+    if not checkpoint.done("explore"):
+        notify("stage", {"stage": "explore"})
+        with telemetry.span("explore"):
+            yield from stage_steps(messages, prompts.EXPLORE.format(Input = Input), routes["explore"])
+        yield ("blocking", checkpoint.save, "explore", messages, sources)
+
+    # explain and elaborate both build on explore, not on each other, see shared_code/stages.py
+    on_token = (lambda text: notify("token", {"text": text})) if on_event else None
+
+    def explain(stage_messages):
+        notify("stage", {"stage": "explain"})
+        with telemetry.span("explain"):
+            return (yield from stage_steps(stage_messages, prompts.EXPLAIN, routes["explain"]))
+
+    def elaborate(stage_messages):
+        notify("stage", {"stage": "elaborate"})
+        # The final outline is what the client waits for, a job shows it to pollers as it streams in
+        with telemetry.span("elaborate"):
+            response = yield from stage_steps(stage_messages, prompts.ELABORATE, routes["elaborate"], on_token)
+        return (yield from complete_outline_steps(stage_messages, response, routes["elaborate"], notify))
+
+    def on_stage(name, turns, answer):
+        # Either one is kept when the other fails, the retry only runs what is missing. The answer of
+        # elaborate is the repaired outline, not its last turn.
+        yield ("blocking", checkpoint.save, "explore", messages, sources, {name: turns}, {name: answer})
+
+    answers = yield ("stages", [("explain", explain), ("elaborate", elaborate)], messages, checkpoint.turns, on_stage, checkpoint.answers)
+    response = answers["elaborate"]
+    notify("outline", {"outline": outline.loads(response)})
+
+    notify("stage", {"stage": "store"})
+    with telemetry.span("store"):
+        yield ("store", messages, response, telemetry.summary(), sources, user)
+    yield ("blocking", result_cache.put, Input, routes, response)
+    yield ("blocking", checkpoint.clear)
+    if semantic_cache.enabled():
+        yield ("blocking", lambda: semantic_cache.get_cache().add(input_vector, Input, response, scope))
+
+    return response
+
+
+def store_outcome(messages, response, telemetry_summary=None, sources=None, user=""):
+    #Store the outcome in Azure Cosmos DB
+    if outbox.OUTBOX:
+        # Sent to a storage queue and written by Write_outcomes, the response doesn't wait for Cosmos
+        with telemetry.span("outbox"):
+            outbox.put(outcomes.make_document(None, messages, response, sources or {}, user, telemetry_summary))
+        return
+
+    container = cosmos.get_container()
+
+    # Ids come from a counter document in blocks, no cross-partition scan and no duplicates
+    with telemetry.span("cosmos_id"):
+        next_id = id_allocator.next_id()
+
+    # Chunk ids instead of chunk text and a user/day partition key, see shared_code/outcomes.py
+    outcome = outcomes.make_document(next_id, messages, response, sources or {}, user, telemetry_summary)
+
+    # Insert the document into the container
+    with telemetry.span("cosmos_write"):
+        container.create_item(body=outcome)
+
+
+def _run_stages(named_steps, messages, done, on_stage, done_answers):
+    return stages.run_stages(
+        [stages.Stage(name, [], lambda stage_messages, steps=steps: run_steps(steps(stage_messages))) for name, steps in named_steps],
+        messages, done, lambda *args: run_steps(on_stage(*args)), done_answers=done_answers)
+
+
+# How this module runs the steps, looked up when they run so a patched function is picked up
+CALLS = {
+    "blocking": lambda fn, *args: fn(*args),
+    "embed": lambda text: embeddings.embed_text(text),
+    "retrieve": lambda queries: retrieval.retrieve_all(search_client, queries),
+    "send": lambda messages, route, on_token: send_message(messages, route, on_token),
+    "send_all": lambda conversations, route: retrieval.run_concurrently(lambda messages: send_message(messages, route), conversations),
+    "stages": lambda *args: _run_stages(*args),
+    "store": lambda *args: store_outcome(*args),
+}
+
+
+def prime(routes):
+    return run_steps(prime_steps(routes))
+
+
+def generate_outline(Input, routes, on_event=None, user="", primer=None, request_id=None):
+    # on_event(event, data) is called as the pipeline moves on, see shared_code/jobs.py.
+    # Stage timings and token usage are logged and stored with the outcome, see shared_code/telemetry.py
+    with telemetry.trace("generate_outline") as trace:
+        response = run_steps(outline_steps(Input, routes, on_event, user, primer, request_id))
+        telemetry.log(trace)
+    return response
+
+
+def generate_outlines(Inputs, routes, on_event=None, user="", max_workers=BATCH_CONCURRENCY):
+    # A whole programme in one request: the engage turns run once for the batch and every course
+    # continues from them, max_workers courses at a time. on_event("course", result) fires as each
+    # course finishes, in whatever order that happens. Returns the results in the order of Inputs.
+    def notify(event, data):
+        if on_event:
+            on_event(event, data)
+
+    lock = threading.Lock()
+    primed = []
+
+    def primer():
+        # Only courses that miss the result cache need it, the first one primes and the others wait
+        with lock:
+            if not primed:
+                notify("stage", {"stage": "engage"})
+                primed.append(prime(routes))
+        return primed[0]
+
+    results = [None] * len(Inputs)
+    notify("stage", {"stage": "courses"})
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(Inputs)))) as executor:
+        futures = {executor.submit(generate_outline, Input, routes, None, user, primer): i for i, Input in enumerate(Inputs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                response = future.result()
+                result = {"index": i, "Input": Inputs[i], "response": response, "outline": outline.loads(response), "error": None}
+            except Exception as e:
+                # One failed course doesn't fail the others
+                logging.exception(f"Course {i} of the batch failed")
+                result = {"index": i, "Input": Inputs[i], "response": None, "outline": None, "error": str(e)}
+            results[i] = result
+            notify("course", result)
+    return results
@@ -0,0 +1,109 @@
+import logging
+import os
+import threading
+import time
+import uuid
+
+from shared_code import stores
+
+# The seven engage questions are the same for every request, so their embedding, retrieved
+# sources and answer can be reused until the search index changes. Upload_files bumps the
+# index generation after it touches the index, the other workers pick it up within
+# INDEX_GENERATION_TTL.
+PRIMING_CACHE_TTL = int(os.environ.get("PRIMING_CACHE_TTL") or 3600)
+# Where the index generation lives. "cosmos" so every instance and every restarted worker sees
+# an upload, the result and semantic caches are scoped by it too. "memory" for this worker only.
+INDEX_GENERATION_STORE = os.environ.get("INDEX_GENERATION_STORE") or "cosmos"
+INDEX_GENERATION_CONTAINER = os.environ.get("INDEX_GENERATION_CONTAINER") or "settings"
+INDEX_GENERATION_DOCUMENT = "index-generation"
+# Seconds a worker uses the generation it read before reading it again
+INDEX_GENERATION_TTL = float(os.environ.get("INDEX_GENERATION_TTL") or 30)
+
+_lock = threading.Lock()
+_entries = {}
+
+
+_store_lock = threading.Lock()
+_generation_lock = threading.Lock()
+_store = None
+_generation = None
+_generation_read = 0.0
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = stores.make_store(INDEX_GENERATION_STORE, INDEX_GENERATION_CONTAINER)
+    return _store
+
+
+def _set_generation(generation):
+    global _generation, _generation_read
+    with _lock:
+        if generation != _generation:
+            # Entries of the old generation can't be hit anymore
+            _entries.clear()
+        _generation = generation
+        _generation_read = time.monotonic()
+
+
+def index_generation():
+    if _generation is None or time.monotonic() - _generation_read > INDEX_GENERATION_TTL:
+        with _generation_lock:
+            if _generation is None or time.monotonic() - _generation_read > INDEX_GENERATION_TTL:
+                try:
+                    document = get_store().get(INDEX_GENERATION_DOCUMENT)
+                    _set_generation(document["generation"] if document else 0)
+                except Exception:
+                    # Keep the last one we know, and try again after the TTL
+                    logging.exception("Index generation couldn't be read")
+                    _set_generation(_generation or 0)
+    return _generation
+
+
+def bump_index_generation():
+    with _generation_lock:
+        # A new random value instead of a counter, two uploads at once don't need to agree on it
+        generation = uuid.uuid4().hex
+        get_store().put({"id": INDEX_GENERATION_DOCUMENT, "generation": generation})
+        _set_generation(generation)
+        return generation
+
+
+def get(question, deployment, temperature):
+    key = (question, index_generation(), deployment, temperature)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry["created"] > PRIMING_CACHE_TTL:
+            del _entries[key]
+            return None
+        return entry
+
+
+def put(question, deployment, temperature, embedding, sources, answer, generation=None):
+    # generation is index_generation() from before the sources were retrieved. When the index
+    # changed since, the answer is grounded on the old index and isn't kept.
+    # An answer without sources isn't grounded on the index at all, it isn't kept either
+    if not sources:
+        return
+    if generation is None:
+        generation = index_generation()
+    key = (question, generation, deployment, temperature)
+    with _lock:
+        if generation != _generation:
+            return
+        _entries[key] = {
+            "embedding": embedding,
+            "sources": sources,
+            "answer": answer,
+            "created": time.monotonic(),
+        }
+
+
+def clear():
+    with _lock:
+        _entries.clear()
@@ -0,0 +1,102 @@
+# Bump this whenever a prompt below changes, cached outlines built with older prompts are ignored
+PROMPT_VERSION = "2"
+
+BASE_SYSTEM_MESSAGE = """You are a faculty who assists teachers design a course outline for their students. 
+    Answer ONLY with the facts listed in the list of sources below. If there isn't enough information below, say you don't know. 
+    Do not generate answers that don't use the sources below. If asking a clarifying question to the user would help, ask the question.
+    """
+
+# This is the first user message that will be sent to the model. Feel free to update this.
+engage_0 = """What is constructive alignment and how does it relate to blended courses and modes of learning?"""
+engage_1 = """How can the ABCD model be used to develop Intended Learning Outcomes (ILO) based on Bloom's Taxonomy?, What are some examples of verbs used for the "Behaviour" component of ILO and how do they relate to the ABCD components?"""    
+engage_2 = """How can multiple ILOs be achieved in a single lesson?"""
+engage_3 = """What are some examples of learner-centered Teaching and Learning Activities (TLA) and corresponding Assessment Tasks (AT) for both online and face-to-face settings?"""
+engage_4 = """What does it mean to weave TLAs from lesson to lesson?"""
+engage_5 = """What are some ed-tech tools and resources that can complement learner-centered TLAs?, what information should be included in a course synopsis?"""
+engage_6 = """What are the components of V3SK table and how are they defined?"""
+
+ENGAGES = [engage_0, engage_1, engage_2, engage_3, engage_4, engage_5, engage_6]
+
+SEED_SYSTEM_MESSAGE = """An outline was created before for the similar request “{Input}”. Use it as a starting point and adapt it to the request below:
+{outline}"""
+
+CONTINUE_SYSTEM_MESSAGE = """Based on the above information and given sources, please continue answer the following question"""
+
+EXPLORE = """
+                Given the above explanations, create “{Input}” provide a course synopsis for the entire course within 200 words.
+                Write a maximum of 5 ILOs,using the ABCD model, for the entire 
+                course.
+                For each week, list the topic and mode of delivery determined by 
+                the nature of the content and TLAs. 
+                For each week, provide a variety of TLAs and a variety of 
+                formative assessment tasks (ATs) for the first 4 weeks and a 
+                summative assessment task for the last week. Ensure the ATs 
+                and TLAs are weaved.
+                For each week, allow for more than one ILO to be achieved and 
+                state which ILOs has been achieved in each lesson.
+                Suggest ed tech tools to support the TLAs in each week.
+                Suggest other learning resources (books,websites,journals) to 
+                support the TLAs in each week".
+                """
+
+EXPLAIN = """
+        For the course outline you just created, Examine if the ATs and TLAs support 
+        the constructive alignment with the 
+        ILOs.
+        Explain how are the various ILOs 
+        achieved for each lesson
+        Explain and analyze the Components of V3SK with its Values, Skills and Knowledge. 
+        Examine if the ATs and TLAs from 
+        week to week are weaved.
+        Explain how the nature of the content 
+        and TLAs determine the mode of 
+        delivery for each lesson. 
+        Making sure, you provide your 
+        explanation with reference to the 
+        above course outline."""
+
+ELABORATE = """
+        For the same course, present the 
+        following information using a json format with this structure
+        {{
+            "Course synopsis": "Information of Course synopsis",
+            "ILOs for entire course": "List out maximum of 5 ILOs using the ABCD model.
+                MUST Following this sample format: "Student(Audience) will be able to write a food memoir(Behavior) that describes a personal experience(Condition) with food using emotional depth(Degree)".
+                In the Behavior part, MUST use these verbs: Remember, Comprehension, Apply, Analyse, Evaluate, Create",
+            "TE21": "Analyze the keywords from Course synopsis and ILOs then classify them with appropriate skills, values and knowledge from the Components of V3SK table
+            For example: "TE21": {
+                        "Values": [
+                            "Commitment to the learner",
+                            "Commitment to the profession",
+                            "Commitment to the community"
+                        ],
+                        "Skills": [
+                            "Communication skills",
+                            "Critical & metacognitive skills",
+                            "Creative & innovative skills"
+                        ],
+                        "Knowledge": [
+                            "Health & mental well-being",
+                            "Educational foundation & policies",
+                            "Global awareness"
+                        ]
+                ",
+            "Week": [
+                "Week": "Number",
+                "Course topics": "Information of Course topics in this week",
+                "ILOs achieved": "Which point number of ILOs achieved in this week",
+                "ATs": "Information of ATs in this week",
+                "TLAs": "Information of TLAs in this week, The TLAs must be explained clearly, exhibiting weaving from lesson to lesson",
+                "Ed tech tools" : "Information of Ed tech tools in this week",
+                "Other learning resources" : "Information of learning resources in this week",
+                "Mode of learning": "Information of Mode of learning in this week, 
+                    Do take note that 30-60 percent of the course should be online and the nature of the lesson should decide the mode of learning
+                    just list out the suitable Mode of learning without percentage of each"
+                ]      
+        }} 
+        """
+
+# Sent after ELABORATE when its JSON is cut off or incomplete, parts lists what to send again, see shared_code/outline.py
+REPAIR_OUTLINE = """Your JSON answer above is cut off or incomplete. Do not repeat the parts that are already complete.
+Reply with ONLY a JSON object, no other text before or after it, using the same structure as before and containing just:
+{parts}"""
@@ -0,0 +1,197 @@
+import functools
+import logging
+import os
+import re
+import threading
+import time
+
+from shared_code import stores, telemetry
+
+# Client side token buckets for the Azure OpenAI quota, shared by the chat functions and
+# Upload_files so they stop sending calls before the service starts answering 429. Every call
+# asks for its estimated cost first: prompt tokens + max_tokens for chat, like the service
+# counts them, and the input tokens for embeddings.
+#
+# Quota per deployment per minute, 0 leaves it unlimited on our side. RATE_LIMIT_TPM_<DEPLOYMENT>
+# and RATE_LIMIT_RPM_<DEPLOYMENT> override it for one deployment, e.g. RATE_LIMIT_TPM_GPT_35_TURBO=120000
+RATE_LIMIT_TPM = int(os.environ.get("RATE_LIMIT_TPM") or 0)
+RATE_LIMIT_RPM = int(os.environ.get("RATE_LIMIT_RPM") or 0)
+# Share of every bucket that bulk calls (the embeddings of Upload_files) leave to interactive ones
+RATE_LIMIT_INTERACTIVE_RESERVE = float(os.environ.get("RATE_LIMIT_INTERACTIVE_RESERVE") or 0.2)
+# A call that waited this long goes out anyway and lets the service decide
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT") or 60)
+# Where the buckets live: "memory" for this worker process, "sqlite" for the worker processes
+# of one instance, "cosmos" for every instance of the function app
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE") or "memory"
+RATE_LIMIT_SQLITE_PATH = os.environ.get("RATE_LIMIT_SQLITE_PATH") or "ratelimit.sqlite3"
+RATE_LIMIT_CONTAINER = os.environ.get("RATE_LIMIT_CONTAINER") or "ratelimits"
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+
+@functools.lru_cache(maxsize=None)
+def limits(deployment):
+    # (tokens per minute, requests per minute) of a deployment
+    suffix = re.sub(r"[^A-Za-z0-9]", "_", deployment).upper()
+    tpm = int(os.environ.get(f"RATE_LIMIT_TPM_{suffix}") or RATE_LIMIT_TPM)
+    rpm = int(os.environ.get(f"RATE_LIMIT_RPM_{suffix}") or RATE_LIMIT_RPM)
+    return tpm, rpm
+
+
+def refill(state, now, tpm, rpm):
+    # Both buckets refill continuously and hold at most a minute of quota
+    elapsed = max(0.0, now - state.get("updated", now))
+    return {
+        "tokens": min(tpm, state.get("tokens", tpm) + elapsed * tpm / 60),
+        "requests": min(rpm, state.get("requests", rpm) + elapsed * rpm / 60),
+        "paused_until": state.get("paused_until", 0),
+        "updated": now,
+    }
+
+
+def take(state, now, tokens, tpm, rpm, reserve=0.0):
+    # (new state, seconds to wait before asking again), the call may go out when that is 0
+    state = refill(state, now, tpm, rpm)
+    if state["paused_until"] > now:
+        return state, state["paused_until"] - now
+    wait = 0.0
+    if tpm:
+        # A call larger than the bucket waits for a full one instead of forever
+        tokens = min(tokens, tpm * (1 - reserve))
+        needed = tokens + tpm * reserve
+        if state["tokens"] < needed:
+            wait = max(wait, (needed - state["tokens"]) * 60 / tpm)
+    if rpm:
+        needed = min(rpm, 1 + rpm * reserve)
+        if state["requests"] < needed:
+            wait = max(wait, (needed - state["requests"]) * 60 / rpm)
+    if wait:
+        return state, wait
+    if tpm:
+        state["tokens"] -= tokens
+    if rpm:
+        state["requests"] -= 1
+    return state, 0.0
+
+
+def header_values(headers):
+    return {name.lower(): value for name, value in (headers or {}).items()}
+
+
+def retry_after(headers):
+    # Seconds the service asked us to wait, None when it didn't say
+    headers = header_values(headers)
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) * scale
+            except ValueError:
+                pass
+    return None
+
+
+class RateLimiter:
+    def __init__(self, store):
+        # A document per deployment in a store of shared_code/stores.py, the bucket state under "state"
+        self.store = store
+        self._condition = threading.Condition()
+        self._interactive_waiting = {}
+
+    def acquire(self, deployment, tokens, priority=INTERACTIVE):
+        # Blocks until the call fits in the quota of the deployment, returns the seconds it waited
+        tpm, rpm = limits(deployment)
+        reserve = RATE_LIMIT_INTERACTIVE_RESERVE if priority == BULK else 0.0
+        start = time.monotonic()
+        deadline = start + RATE_LIMIT_MAX_WAIT
+        if priority == INTERACTIVE:
+            with self._condition:
+                self._interactive_waiting[deployment] = self._interactive_waiting.get(deployment, 0) + 1
+        try:
+            while True:
+                with self._condition:
+                    # Bulk calls of this worker step aside while an interactive one waits for the same deployment
+                    while priority == BULK and self._interactive_waiting.get(deployment) and time.monotonic() < deadline:
+                        self._condition.wait(deadline - time.monotonic())
+                wait = self._update(deployment, lambda state: take(state, time.time(), tokens, tpm, rpm, reserve))
+                remaining = deadline - time.monotonic()
+                if wait <= 0:
+                    return time.monotonic() - start
+                if remaining <= 0:
+                    logging.warning(f"No quota for deployment {deployment} after {RATE_LIMIT_MAX_WAIT:g}s, sending the call anyway")
+                    return time.monotonic() - start
+                with self._condition:
+                    self._condition.wait(min(wait, remaining))
+        finally:
+            if priority == INTERACTIVE:
+                with self._condition:
+                    self._interactive_waiting[deployment] -= 1
+                    self._condition.notify_all()
+
+    def _update(self, deployment, fn):
+        # fn(state) -> (new state, result), applied atomically
+        def update(document):
+            state, result = fn(document["state"] if document else {})
+            return {"id": deployment, "state": state}, result
+        return self.store.update(deployment, update)
+
+    def pause(self, deployment, seconds):
+        # Nobody sends to the deployment until then, what a 429 with Retry-After asks for
+        until = time.time() + seconds
+
+        def update(state):
+            return dict(state, paused_until=max(state.get("paused_until", 0), until)), None
+        self._update(deployment, update)
+
+    def observe(self, deployment, headers):
+        # The service knows best how much is left, never hold more than it says
+        headers = header_values(headers)
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        tpm, rpm = limits(deployment)
+        if remaining_tokens is None and remaining_requests is None or not (tpm or rpm):
+            return
+
+        def update(state):
+            state = refill(state, time.time(), tpm, rpm)
+            try:
+                if remaining_tokens is not None and tpm:
+                    state["tokens"] = min(state["tokens"], float(remaining_tokens))
+                if remaining_requests is not None and rpm:
+                    state["requests"] = min(state["requests"], float(remaining_requests))
+            except ValueError:
+                pass
+            return state, None
+        self._update(deployment, update)
+
+
+_lock = threading.Lock()
+_limiter = None
+
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        with _lock:
+            if _limiter is None:
+                _limiter = RateLimiter(stores.make_store(RATE_LIMIT_STORE, RATE_LIMIT_CONTAINER, RATE_LIMIT_SQLITE_PATH))
+    return _limiter
+
+
+def acquire(deployment, tokens, priority=INTERACTIVE):
+    # Deployments without a limit still go through their bucket, a Retry-After pause applies to them too
+    with telemetry.span("quota", deployment=deployment, priority=priority, tokens=tokens) as attributes:
+        waited = get_limiter().acquire(deployment, tokens, priority)
+        attributes["waited_ms"] = round(waited * 1000, 1)
+    return waited
+
+
+def note_error(deployment, error):
+    # Called with every failed call, a 429 holds back all calls to the deployment for its Retry-After
+    headers = getattr(error, "headers", None) or {}
+    get_limiter().observe(deployment, headers)
+    if getattr(error, "http_status", None) == 429:
+        delay = retry_after(headers)
+        if delay:
+            get_limiter().pause(deployment, delay)
@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+
+from shared_code import rate_limit, streaming, telemetry
+
+# Per call timeout handed to the OpenAI SDK, in seconds
+CHAT_TIMEOUT = float(os.environ.get("CHAT_TIMEOUT") or 120)
+CHAT_MAX_RETRIES = int(os.environ.get("CHAT_MAX_RETRIES") or 3)
+# Longest we wait between two attempts, also caps what Retry-After can ask for
+CHAT_MAX_BACKOFF = float(os.environ.get("CHAT_MAX_BACKOFF") or 30)
+
+# A deployment that failed this many calls in a row is skipped for CIRCUIT_COOLDOWN seconds
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD") or 5)
+CIRCUIT_COOLDOWN = float(os.environ.get("CIRCUIT_COOLDOWN") or 30)
+
+# Send the same request to the fallback deployment when the first one is slower than this
+# percentile of its recent latencies. Needs HEDGE_MIN_SAMPLES calls before it kicks in. Latencies
+# are kept per deployment and kind of call (the stage and its max_tokens), a short engage
+# answer and a long elaborate one don't share a percentile.
+HEDGE_REQUESTS = (os.environ.get("HEDGE_REQUESTS") or "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE") or 95)
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES") or 20)
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.APIError,
+)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name, threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown=CIRCUIT_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.cooldown or self._probing:
+                raise CircuitOpenError(f"Circuit for deployment {self.name} is open")
+            # Half open: let a single call through to see if the deployment is back
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.threshold:
+                if self._opened_at is None or self._probing:
+                    logging.warning(f"Opening the circuit for deployment {self.name} after {self._failures} failures")
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def release(self):
+        # The call ended without telling whether the deployment works (a bad request, a bug, a
+        # cancelled task). A probe is over, the next call after the cooldown probes again.
+        with self._lock:
+            self._probing = False
+
+
+class LatencyTracker:
+    def __init__(self, size=200):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=size)
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p):
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+_lock = threading.Lock()
+_breakers = {}
+_latencies = {}
+_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("HEDGE_WORKERS") or 16))
+
+
+def get_breaker(deployment):
+    with _lock:
+        if deployment not in _breakers:
+            _breakers[deployment] = CircuitBreaker(deployment)
+        return _breakers[deployment]
+
+
+def get_latency(deployment, kind=None):
+    with _lock:
+        if (deployment, kind) not in _latencies:
+            _latencies[(deployment, kind)] = LatencyTracker()
+        return _latencies[(deployment, kind)]
+
+
+def retry_delay(error, attempt):
+    # Azure OpenAI says how long to wait on a 429, otherwise back off exponentially with jitter
+    delay = rate_limit.retry_after(getattr(error, "headers", None))
+    if delay is not None:
+        return min(delay, CHAT_MAX_BACKOFF)
+    return min(random.uniform(0, 2 ** attempt), CHAT_MAX_BACKOFF)
+
+
+def _interrupted(breaker, deployment, error):
+    # Tokens of the answer were passed on already, the error is raised without another attempt
+    if isinstance(error.__cause__, RETRYABLE_ERRORS):
+        breaker.record_failure()
+        rate_limit.note_error(deployment, error.__cause__)
+    else:
+        breaker.release()
+
+
+def call_with_retries(fn, deployment, max_retries=CHAT_MAX_RETRIES, kind=None):
+    # fn(deployment) does the actual request
+    breaker = get_breaker(deployment)
+    for attempt in range(max_retries + 1):
+        breaker.before_call()
+        start = time.monotonic()
+        try:
+            result = fn(deployment)
+        except streaming.StreamInterruptedError as e:
+            _interrupted(breaker, deployment, e)
+            raise
+        except RETRYABLE_ERRORS as e:
+            breaker.record_failure()
+            # Other calls to the deployment wait out a Retry-After too, instead of each finding out with its own 429
+            rate_limit.note_error(deployment, e)
+            if attempt == max_retries:
+                raise
+            delay = retry_delay(e, attempt)
+            logging.warning(f"Call to deployment {deployment} failed ({e!r}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+        get_latency(deployment, kind).record(time.monotonic() - start)
+        return result
+
+
+async def call_with_retries_async(fn, deployment, max_retries=CHAT_MAX_RETRIES, kind=None):
+    # call_with_retries() for a coroutine fn(deployment), waits on the event loop instead of a thread
+    breaker = get_breaker(deployment)
+    for attempt in range(max_retries + 1):
+        breaker.before_call()
+        start = time.monotonic()
+        try:
+            result = await fn(deployment)
+        except streaming.StreamInterruptedError as e:
+            await asyncio.to_thread(_interrupted, breaker, deployment, e)
+            raise
+        except RETRYABLE_ERRORS as e:
+            breaker.record_failure()
+            # The limiter may be shared through a store, off the event loop
+            await asyncio.to_thread(rate_limit.note_error, deployment, e)
+            if attempt == max_retries:
+                raise
+            delay = retry_delay(e, attempt)
+            logging.warning(f"Call to deployment {deployment} failed ({e!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+        get_latency(deployment, kind).record(time.monotonic() - start)
+        return result
+
+
+def _fall_back(fn, deployment, fallback, error, kind=None):
+    if not fallback:
+        raise error
+    logging.warning(f"Deployment {deployment} is unavailable ({error!r}), falling back to {fallback}")
+    return call_with_retries(fn, fallback, CHAT_MAX_RETRIES, kind)
+
+
+def hedged_call(fn, deployment, hedge_deployment, kind=None):
+    # When deployment fails before the hedge was sent, hedge_deployment is the fallback. Once both
+    # were sent the fallback had its attempts, the error of the one that failed last is raised.
+    threshold = get_latency(deployment, kind).percentile(HEDGE_PERCENTILE)
+    primary = _executor.submit(telemetry.wrap(call_with_retries), fn, deployment, CHAT_MAX_RETRIES, kind)
+    done, _ = wait([primary], timeout=threshold)
+    if done:
+        try:
+            return primary.result()
+        except (CircuitOpenError,) + RETRYABLE_ERRORS as e:
+            return _fall_back(fn, deployment, hedge_deployment, e, kind)
+
+    logging.info(f"Deployment {deployment} is slower than its p{HEDGE_PERCENTILE:g} ({threshold:.1f}s), hedging on {hedge_deployment}")
+    secondary = _executor.submit(telemetry.wrap(call_with_retries), fn, hedge_deployment, CHAT_MAX_RETRIES, kind)
+    pending = {primary, secondary}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                # The slower call keeps running in the background, its result is dropped
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def call(fn, deployment, fallback=None, hedge=HEDGE_REQUESTS, kind=None):
+    # kind tells calls of different sizes apart for hedging, e.g. (stage, max_tokens)
+    if hedge and fallback:
+        return hedged_call(fn, deployment, fallback, kind)
+    try:
+        return call_with_retries(fn, deployment, CHAT_MAX_RETRIES, kind)
+    except (CircuitOpenError,) + RETRYABLE_ERRORS as e:
+        return _fall_back(fn, deployment, fallback, e, kind)
+
+
+async def call_async(fn, deployment, fallback=None, kind=None):
+    # call() for the async pipeline, without hedging
+    try:
+        return await call_with_retries_async(fn, deployment, CHAT_MAX_RETRIES, kind)
+    except (CircuitOpenError,) + RETRYABLE_ERRORS as e:
+        if not fallback:
+            raise
+        logging.warning(f"Deployment {deployment} is unavailable ({e!r}), falling back to {fallback}")
+        return await call_with_retries_async(fn, fallback, CHAT_MAX_RETRIES, kind)
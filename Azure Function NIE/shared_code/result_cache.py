@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from shared_code import priming_cache, prompts, stores
+
+# Finished outlines are reused for the same course request. "memory" keeps them in this
+# worker only, "cosmos" also shares them between workers through the outlines container.
+RESULT_CACHE_STORE = os.environ.get("RESULT_CACHE_STORE") or "memory"
+RESULT_CACHE_CONTAINER = os.environ.get("RESULT_CACHE_CONTAINER") or "outlines"
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE") or 256)
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL") or 7 * 86400)
+
+
+def normalize_input(Input):
+    # "A 5-week course outline on  Food Fiction." and "a 5 week course outline on food fiction" are the same request
+    text = Input.lower().replace("“", "\"").replace("”", "\"").replace("’", "'")
+    text = re.sub(r"[-_]", " ", text)
+    text = re.sub(r"\s+", " ", text)
+    return text.strip().strip(".!?\"' ")
+
+
+def route_scope(routes):
+    return sorted((stage, route["deployment"], route["temperature"], route["max_tokens"]) for stage, route in routes.items())
+
+
+def make_scope(routes):
+    # Everything besides the course request that changes the outline
+    return json.dumps([prompts.PROMPT_VERSION, route_scope(routes), priming_cache.index_generation()])
+
+
+def make_key(Input, routes):
+    key = json.dumps([normalize_input(Input), make_scope(routes)])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class LRUCache:
+    def __init__(self, capacity=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_lock = threading.Lock()
+_memory = LRUCache()
+_store = None
+
+
+def _get_store():
+    global _store
+    if RESULT_CACHE_STORE != "cosmos":
+        return None
+    if _store is None:
+        with _lock:
+            if _store is None:
+                # Cosmos expires the cached outlines by itself
+                _store = stores.CosmosStore(RESULT_CACHE_CONTAINER, RESULT_CACHE_TTL)
+    return _store
+
+
+def get(Input, routes):
+    key = make_key(Input, routes)
+    response = _memory.get(key)
+    if response is None and _get_store():
+        document = _get_store().get(key)
+        if document is not None:
+            response = document["response"]
+            _memory.put(key, response)
+    return response
+
+
+def put(Input, routes, response):
+    key = make_key(Input, routes)
+    _memory.put(key, response)
+    if _get_store():
+        _get_store().put({"id": key, "response": response})
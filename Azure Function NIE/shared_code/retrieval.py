@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from shared_code import embeddings, telemetry, vector_index
+
+KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT") or "content"
+KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE") or "sourcepage"
+
+# How many engage searches run at the same time
+ENGAGE_CONCURRENCY = int(os.environ.get("ENGAGE_CONCURRENCY") or 7)
+
+# Where the sources come from:
+#   search   - Azure Cognitive Search hybrid query
+#   local    - the in-process vector index mirror, copied from the search index when the worker
+#              starts and kept in sync by Upload_files, see shared_code/vector_index.py
+#   fallback - Azure Cognitive Search, the local index when it fails or takes longer than SEARCH_TIMEOUT seconds
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND") or "search"
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT") or 5)
+
+# Answer the engage questions in parallel, each one on its own instead of on top of the previous answers
+ENGAGE_INDEPENDENT_ANSWERS = (os.environ.get("ENGAGE_INDEPENDENT_ANSWERS") or "false").lower() == "true"
+
+
+def run_concurrently(fn, items, max_workers=ENGAGE_CONCURRENCY):
+    # Results come back in the same order as items
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        return list(executor.map(telemetry.wrap(fn), items))
+
+
+async def run_concurrently_async(fn, items, max_workers=ENGAGE_CONCURRENCY):
+    # run_concurrently() for a coroutine fn, at most max_workers in flight
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+
+    async def run(item):
+        async with semaphore:
+            return await fn(item)
+    return list(await asyncio.gather(*(run(item) for item in items)))
+
+
+_fallback_executor = ThreadPoolExecutor(max_workers=ENGAGE_CONCURRENCY)
+
+
+def search_local(query_vector, exclude_category=None, top=5):
+    # Vector only, the local index has no keyword or semantic ranking
+    results = vector_index.get_index().search(query_vector, top=top, exclude_category=exclude_category)
+    return [{
+        "id": doc["id"],
+        "sourcepage": str(doc[KB_FIELDS_SOURCEPAGE]),
+        "content": str(doc[KB_FIELDS_CONTENT]).replace("\n", "").replace("\r", "")
+    } for doc in results]
+
+
+def search_sources(search_client, query, query_vector, exclude_category=None, top=5):
+    with telemetry.span("search", backend=RETRIEVAL_BACKEND):
+        return _search_sources(search_client, query, query_vector, exclude_category, top)
+
+
+def _search_sources(search_client, query, query_vector, exclude_category=None, top=5):
+    if RETRIEVAL_BACKEND == "local":
+        return search_local(query_vector, exclude_category, top)
+    if RETRIEVAL_BACKEND == "fallback":
+        future = _fallback_executor.submit(telemetry.wrap(search_remote), search_client, query, query_vector, exclude_category, top)
+        try:
+            return future.result(timeout=SEARCH_TIMEOUT)
+        except Exception as e:
+            logging.warning(f"Cognitive Search failed or was too slow ({e!r}), using the local vector index")
+            return search_local(query_vector, exclude_category, top)
+    return search_remote(search_client, query, query_vector, exclude_category, top)
+
+
+def search_arguments(query_vector, exclude_category, top):
+    # Alternatively simply use search_client.search(q, top=3) if not using semantic search
+    filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+    return dict(
+        filter=filter,
+        # query_type=QueryType.SEMANTIC,
+        query_language="en-us",
+        query_speller="lexicon",
+        semantic_configuration_name="default",
+        top=top,
+        vector=query_vector if query_vector else None,
+        top_k=50 if query_vector else None,
+        vector_fields="embedding" if query_vector else None
+    )
+
+
+def to_source(doc):
+    return {
+        "id": doc.get("id") or str(doc[KB_FIELDS_SOURCEPAGE]),
+        "sourcepage": str(doc[KB_FIELDS_SOURCEPAGE]),
+        "content": str(doc[KB_FIELDS_CONTENT]).replace("\n", "").replace("\r", "")
+    }
+
+
+def search_remote(search_client, query, query_vector, exclude_category=None, top=5):
+    r = search_client.search(query, **search_arguments(query_vector, exclude_category, top))
+    return [to_source(doc) for doc in r]
+
+
+async def search_remote_async(search_client, query, query_vector, exclude_category=None, top=5):
+    # search_client is an azure.search.documents.aio.SearchClient
+    r = await search_client.search(query, **search_arguments(query_vector, exclude_category, top))
+    return [to_source(doc) async for doc in r]
+
+
+async def search_sources_async(search_client, query, query_vector, exclude_category=None, top=5):
+    with telemetry.span("search", backend=RETRIEVAL_BACKEND):
+        # The local index reads its files and scores the matrix, that gets a thread
+        if RETRIEVAL_BACKEND == "local":
+            return await asyncio.to_thread(search_local, query_vector, exclude_category, top)
+        if RETRIEVAL_BACKEND == "fallback":
+            try:
+                return await asyncio.wait_for(search_remote_async(search_client, query, query_vector, exclude_category, top), SEARCH_TIMEOUT)
+            except Exception as e:
+                logging.warning(f"Cognitive Search failed or was too slow ({e!r}), using the local vector index")
+                return await asyncio.to_thread(search_local, query_vector, exclude_category, top)
+        return await search_remote_async(search_client, query, query_vector, exclude_category, top)
+
+
+def format_sources(chunks):
+    return "\n".join(chunk["sourcepage"] + ": " + chunk["content"] for chunk in chunks)
+
+
+def retrieve(search_client, query):
+    query_vector = embeddings.embed_text(query)
+    return query_vector, search_sources(search_client, query, query_vector)
+
+
+def retrieve_all(search_client, queries, max_workers=ENGAGE_CONCURRENCY):
+    # One embeddings request for all the questions, then the hybrid searches side by side
+    queries = list(queries)
+    query_vectors = embeddings.embed_texts(queries)
+    sources = run_concurrently(lambda pair: search_sources(search_client, pair[0], pair[1]), zip(queries, query_vectors), max_workers)
+    return list(zip(query_vectors, sources))
+
+
+async def retrieve_all_async(search_client, queries, max_workers=ENGAGE_CONCURRENCY):
+    queries = list(queries)
+    query_vectors = await embeddings.embed_texts_async(queries)
+    sources = await run_concurrently_async(lambda pair: search_sources_async(search_client, pair[0], pair[1]), list(zip(queries, query_vectors)), max_workers)
+    return list(zip(query_vectors, sources))
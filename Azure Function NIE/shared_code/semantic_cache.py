@@ -0,0 +1,191 @@
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+# What to do with a course request that is close enough to one we answered before:
+#   off    - nothing, only exact matches are served from result_cache
+#   return - answer with the stored outline
+#   seed   - run the pipeline but give the stored outline to the explore stage as a starting point
+SEMANTIC_CACHE_MODE = os.environ.get("SEMANTIC_CACHE_MODE") or "off"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD") or 0.95)
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE") or 1024)
+# /home is kept across restarts on Azure Functions
+SEMANTIC_CACHE_PATH = os.environ.get("SEMANTIC_CACHE_PATH") or os.path.join(os.environ.get("HOME") or tempfile.gettempdir(), "data", "semantic_cache.npz")
+# Adds within this many seconds are written to the file together, 0 writes after every add
+SEMANTIC_CACHE_SAVE_DELAY = float(os.environ.get("SEMANTIC_CACHE_SAVE_DELAY") or 5)
+
+
+class SemanticCache:
+    def __init__(self, capacity=SEMANTIC_CACHE_SIZE, threshold=SEMANTIC_CACHE_THRESHOLD, path=None, save_delay=SEMANTIC_CACHE_SAVE_DELAY):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.path = path
+        self.save_delay = save_delay
+        self._lock = threading.Lock()
+        # One save at a time, and the pending delayed save
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        # One normalized embedding per row, rows past self._count are unused
+        self._vectors = None
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._entries = []
+        self._count = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path and os.path.exists(path):
+            try:
+                self.load(path)
+            except Exception as e:
+                logging.warning(f"Could not load the semantic cache from {path}: {e}")
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, vector, scope):
+        # Returns (entry, similarity) of the closest previous request in the same scope, or None
+        query = self._normalize(vector)
+        with self._lock:
+            if self._count:
+                similarities = self._vectors[:self._count] @ query
+                in_scope = np.array([entry["scope"] == scope for entry in self._entries])
+                similarities = np.where(in_scope, similarities, -1.0)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    self._last_used[best] = time.time()
+                    return self._entries[best], float(similarities[best])
+            self.misses += 1
+            return None
+
+    def add(self, vector, Input, response, scope):
+        vector = self._normalize(vector)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.capacity, vector.shape[0]), dtype=np.float32)
+            if self._count < self.capacity:
+                row = self._count
+                self._count += 1
+                self._entries.append(None)
+            else:
+                # Full, replace the entry that was used least recently
+                row = int(np.argmin(self._last_used[:self._count]))
+                self.evictions += 1
+            self._vectors[row] = vector
+            self._last_used[row] = time.time()
+            self._entries[row] = {"input": Input, "response": response, "scope": scope}
+        if self.path:
+            self._schedule_save()
+
+    def _schedule_save(self):
+        # The cache is only an optimization, an add never fails because the file couldn't be written
+        try:
+            if self.save_delay <= 0:
+                self.save(self.path)
+                return
+            with self._lock:
+                if self._save_timer is not None:
+                    return
+                self._save_timer = threading.Timer(self.save_delay, self._delayed_save)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+        except Exception as e:
+            logging.warning(f"Could not save the semantic cache to {self.path}: {e}")
+
+    def _delayed_save(self):
+        with self._lock:
+            self._save_timer = None
+        try:
+            self.save(self.path)
+        except Exception as e:
+            logging.warning(f"Could not save the semantic cache to {self.path}: {e}")
+
+    def flush(self):
+        # Writes a pending delayed save now, e.g. when the worker stops
+        with self._lock:
+            timer, self._save_timer = self._save_timer, None
+        if timer is None:
+            return
+        timer.cancel()
+        try:
+            self.save(self.path)
+        except Exception as e:
+            logging.warning(f"Could not save the semantic cache to {self.path}: {e}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": self._count,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def save(self, path):
+        with self._save_lock:
+            with self._lock:
+                if self._vectors is None:
+                    return
+                vectors = self._vectors[:self._count].copy()
+                last_used = self._last_used[:self._count].copy()
+                entries = json.dumps(self._entries)
+            directory = os.path.dirname(path) or "."
+            os.makedirs(directory, exist_ok=True)
+            # A temp file of its own, other threads and other instances sharing the path write theirs.
+            # Readers never see a half written file, the last complete one wins.
+            with tempfile.NamedTemporaryFile(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp", delete=False) as f:
+                tmp_path = f.name
+                try:
+                    np.savez(f, vectors=vectors, last_used=last_used, entries=np.array(entries))
+                except BaseException:
+                    f.close()
+                    os.remove(tmp_path)
+                    raise
+            try:
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    def load(self, path):
+        with np.load(path) as data:
+            vectors = data["vectors"]
+            last_used = data["last_used"]
+            entries = json.loads(str(data["entries"]))
+        count = min(len(entries), self.capacity)
+        # Keep the most recently used entries when the capacity went down
+        keep = np.argsort(last_used)[::-1][:count]
+        with self._lock:
+            self._vectors = np.zeros((self.capacity, vectors.shape[1]), dtype=np.float32)
+            self._vectors[:count] = vectors[keep]
+            self._last_used[:count] = last_used[keep]
+            self._entries = [entries[i] for i in keep]
+            self._count = count
+
+
+_lock = threading.Lock()
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                _cache = SemanticCache(path=SEMANTIC_CACHE_PATH)
+                atexit.register(_cache.flush)
+    return _cache
+
+
+def enabled():
+    return SEMANTIC_CACHE_MODE in ("return", "seed")
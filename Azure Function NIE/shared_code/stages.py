@@ -0,0 +1,134 @@
+import asyncio
+import collections
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from shared_code import telemetry
+
+# Stages that only build on the conversation so far, not on each other, run at the same time.
+# Each one gets its own copy of the conversation plus the turns of the stages it comes after, and
+# the turns of all stages are appended to the conversation in the order the stages are listed,
+# whichever finished first. "false" runs them one after the other, every stage seeing all earlier ones.
+STAGE_PARALLEL = (os.environ.get("STAGE_PARALLEL") or "true").lower() == "true"
+
+# run(messages) appends the turns of the stage to messages and returns its answer,
+# after names the stages whose turns it needs
+Stage = collections.namedtuple("Stage", ["name", "after", "run"])
+
+
+def _needs(stages, stage, parallel):
+    # The stages whose turns come before the ones of stage, in list order
+    names = [s.name for s in stages]
+    if not parallel:
+        return names[:names.index(stage.name)]
+    by_name = {s.name: s for s in stages}
+    needed = set()
+    todo = list(stage.after)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(by_name[name].after)
+    return [name for name in names if name in needed]
+
+
+def _ready(stages, pending, turns, parallel):
+    return [stage for stage in pending if all(name in turns for name in _needs(stages, stage, parallel))]
+
+
+def _conversation(stages, stage, messages, turns, parallel):
+    conversation = list(messages)
+    for name in _needs(stages, stage, parallel):
+        conversation.extend(turns[name])
+    return conversation
+
+
+def _answer(turns):
+    return turns[-1]["content"] if turns else None
+
+
+def _merge(stages, messages, turns):
+    for stage in stages:
+        messages.extend(turns[stage.name])
+
+
+def run_stages(stages, messages, done=None, on_stage=None, parallel=None, done_answers=None):
+    # done has the turns of stages finished earlier (a checkpoint) and done_answers their answers
+    # when that isn't the last turn. on_stage(name, turns, answer) is called as every stage finishes.
+    # Returns {name: answer}. When a stage fails the running ones still finish and get their
+    # on_stage, then the error is raised.
+    parallel = STAGE_PARALLEL if parallel is None else parallel
+    turns = dict(done or {})
+    answers = {name: (done_answers or {}).get(name, _answer(stage_turns)) for name, stage_turns in turns.items()}
+    pending = [stage for stage in stages if stage.name not in turns]
+    error = None
+
+    def run(stage, conversation):
+        start = len(conversation)
+        answer = stage.run(conversation)
+        return answer, conversation[start:]
+
+    with ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+        running = {}
+        while pending or running:
+            if error is None:
+                for stage in _ready(stages, pending, turns, parallel):
+                    pending.remove(stage)
+                    running[executor.submit(telemetry.wrap(run), stage, _conversation(stages, stage, messages, turns, parallel))] = stage
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    answers[stage.name], turns[stage.name] = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if on_stage:
+                    on_stage(stage.name, turns[stage.name], answers[stage.name])
+    if error is not None:
+        raise error
+    if pending:
+        raise ValueError(f"Stages {[stage.name for stage in pending]} come after stages that are not in the list")
+    _merge(stages, messages, turns)
+    return answers
+
+
+async def run_stages_async(stages, messages, done=None, on_stage=None, parallel=None, done_answers=None):
+    # run_stages() with coroutine functions for run and on_stage
+    parallel = STAGE_PARALLEL if parallel is None else parallel
+    turns = dict(done or {})
+    answers = {name: (done_answers or {}).get(name, _answer(stage_turns)) for name, stage_turns in turns.items()}
+    pending = [stage for stage in stages if stage.name not in turns]
+    error = None
+
+    async def run(stage, conversation):
+        start = len(conversation)
+        answer = await stage.run(conversation)
+        return answer, conversation[start:]
+
+    running = {}
+    while pending or running:
+        if error is None:
+            for stage in _ready(stages, pending, turns, parallel):
+                pending.remove(stage)
+                running[asyncio.ensure_future(run(stage, _conversation(stages, stage, messages, turns, parallel)))] = stage
+        if not running:
+            break
+        finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in finished:
+            stage = running.pop(task)
+            try:
+                answers[stage.name], turns[stage.name] = task.result()
+            except Exception as e:
+                error = error or e
+                continue
+            if on_stage:
+                await on_stage(stage.name, turns[stage.name], answers[stage.name])
+    if error is not None:
+        raise error
+    if pending:
+        raise ValueError(f"Stages {[stage.name for stage in pending]} come after stages that are not in the list")
+    _merge(stages, messages, turns)
+    return answers
@@ -0,0 +1,152 @@
+import json
+import sqlite3
+import threading
+import time
+
+# Small JSON documents by id for jobs, checkpoints, cached outlines, the index generation and the
+# rate limit buckets. "memory" keeps them in this worker process, "sqlite" in a file shared by the
+# worker processes of one instance, "cosmos" in a container every instance sees. Documents are
+# removed after ttl seconds, None keeps them.
+
+
+class MemoryStore:
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._documents = {}
+
+    def _expire(self, now):
+        for key in [k for k, v in self._documents.items() if v[0] is not None and v[0] < now]:
+            del self._documents[key]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._documents.get(key)
+        if entry is None or entry[0] is not None and entry[0] < time.time():
+            return None
+        return json.loads(entry[1])
+
+    def put(self, document):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            self._documents[document["id"]] = (now + self.ttl if self.ttl else None, json.dumps(document))
+
+    def delete(self, key):
+        with self._lock:
+            self._documents.pop(key, None)
+
+    def update(self, key, fn):
+        # fn(document or None) -> (new document, result), applied atomically
+        with self._lock:
+            now = time.time()
+            entry = self._documents.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < now:
+                entry = None
+            document, result = fn(None if entry is None else json.loads(entry[1]))
+            self._documents[key] = (now + self.ttl if self.ttl else None, json.dumps(document))
+            return result
+
+
+class SqliteStore:
+    def __init__(self, path, table, ttl=None):
+        self.table = table
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._db.execute(f"CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, body TEXT, expires REAL)")
+
+    def _expires(self, now):
+        return now + self.ttl if self.ttl else None
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(f"SELECT body FROM {self.table} WHERE id = ? AND (expires IS NULL OR expires >= ?)", (key, time.time())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, document):
+        with self._lock:
+            now = time.time()
+            self._db.execute(f"DELETE FROM {self.table} WHERE expires < ?", (now,))
+            self._db.execute(f"INSERT OR REPLACE INTO {self.table} (id, body, expires) VALUES (?, ?, ?)", (document["id"], json.dumps(document), self._expires(now)))
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute(f"DELETE FROM {self.table} WHERE id = ?", (key,))
+
+    def update(self, key, fn):
+        with self._lock:
+            # Locks the database file, the other worker processes wait for us
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._db.execute(f"SELECT body FROM {self.table} WHERE id = ? AND (expires IS NULL OR expires >= ?)", (key, now)).fetchone()
+                document, result = fn(None if row is None else json.loads(row[0]))
+                self._db.execute(f"INSERT OR REPLACE INTO {self.table} (id, body, expires) VALUES (?, ?, ?)", (key, json.dumps(document), self._expires(now)))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            return result
+
+
+class CosmosStore:
+    # Partitioned by /id, Cosmos removes expired documents by itself (default_ttl of the container)
+    def __init__(self, container_name, ttl=None):
+        self.container_name = container_name
+        self.ttl = ttl
+
+    @property
+    def container(self):
+        from shared_code import cosmos
+
+        return cosmos.get_named_container(self.container_name, self.ttl)
+
+    def _read(self, key):
+        from azure.cosmos import exceptions
+
+        try:
+            return self.container.read_item(item=key, partition_key=key)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    def get(self, key):
+        document = self._read(key)
+        return None if document is None else {k: v for k, v in document.items() if not k.startswith("_")}
+
+    def put(self, document):
+        self.container.upsert_item(body=document)
+
+    def delete(self, key):
+        from azure.cosmos import exceptions
+
+        try:
+            self.container.delete_item(item=key, partition_key=key)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+    def update(self, key, fn):
+        from azure.core import MatchConditions
+        from azure.cosmos import exceptions
+
+        while True:
+            current = self._read(key)
+            document, result = fn(None if current is None else {k: v for k, v in current.items() if not k.startswith("_")})
+            try:
+                if current is None:
+                    self.container.create_item(body=document)
+                else:
+                    # Only succeeds if no other worker changed the document since we read it
+                    self.container.replace_item(item=key, body=document, etag=current["_etag"], match_condition=MatchConditions.IfNotModified)
+                return result
+            except (exceptions.CosmosAccessConditionFailedError, exceptions.CosmosResourceExistsError):
+                continue
+
+
+def make_store(kind, container_name, sqlite_path=None, ttl=None):
+    # kind is the *_STORE setting of the module that asks
+    if kind == "memory":
+        return MemoryStore(ttl)
+    if kind == "sqlite":
+        return SqliteStore(sqlite_path or f"{container_name}.sqlite3", container_name, ttl)
+    return CosmosStore(container_name, ttl)
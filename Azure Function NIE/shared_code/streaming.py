@@ -0,0 +1,51 @@
+# Token by token answers of the OpenAI calls. The pipeline passes the tokens of the outline on
+# as "token" events of on_event. They are not sent to HTTP clients: the v1 Python worker only
+# returns a complete body, so server-sent events would arrive all at once when the pipeline is
+# done. Clients poll the job API instead, a job keeps the outline written so far in its "partial"
+# field, see shared_code/jobs.py.
+
+
+
+class StreamInterruptedError(Exception):
+    # The stream broke after some of its tokens were passed on. Another attempt would pass them on
+    # a second time, so shared_code/resilience.py neither retries it nor sends it to the fallback.
+    def __init__(self, error, text):
+        super().__init__(f"Stream interrupted after {len(text)} characters: {error!r}")
+        self.text = text
+
+
+def collect(response, on_token):
+    # response is the iterator returned by ChatCompletion.create(..., stream=True)
+    parts = []
+    try:
+        for chunk in response:
+            # Azure sends a first chunk with the prompt filter results and no choices
+            if not chunk["choices"]:
+                continue
+            text = chunk["choices"][0].get("delta", {}).get("content")
+            if text:
+                parts.append(text)
+                on_token(text)
+    except Exception as e:
+        if parts:
+            raise StreamInterruptedError(e, "".join(parts)) from e
+        raise
+    return "".join(parts)
+
+
+async def collect_async(response, on_token):
+    # The same for the async generator of ChatCompletion.acreate(..., stream=True)
+    parts = []
+    try:
+        async for chunk in response:
+            if not chunk["choices"]:
+                continue
+            text = chunk["choices"][0].get("delta", {}).get("content")
+            if text:
+                parts.append(text)
+                on_token(text)
+    except Exception as e:
+        if parts:
+            raise StreamInterruptedError(e, "".join(parts)) from e
+        raise
+    return "".join(parts)
@@ -0,0 +1,149 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Add a Server-Timing header with the per stage durations to the HTTP responses
+SERVER_TIMING = (os.environ.get("SERVER_TIMING") or "false").lower() == "true"
+# The Functions host only forwards the text of a log record to Application Insights, extra fields
+# are dropped. With a connection string (set by the portal when Application Insights is on) the
+# pipeline telemetry goes out through the opencensus AzureLogHandler instead, which sends the
+# custom_dimensions as customDimensions. Without it the JSON in the message has to be parsed.
+TELEMETRY_EXPORTER = (os.environ.get("TELEMETRY_EXPORTER") or "true").lower() == "true"
+APPLICATIONINSIGHTS_CONNECTION_STRING = os.environ.get("APPLICATIONINSIGHTS_CONNECTION_STRING")
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.spans = []
+        self.usage = []
+
+    def add_span(self, name, start, duration, attributes):
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "start_ms": round((start - self.started) * 1000, 1),
+                "duration_ms": round(duration * 1000, 1),
+                **attributes
+            })
+
+    def add_usage(self, stage, deployment, usage):
+        with self._lock:
+            self.usage.append({
+                "stage": stage,
+                "deployment": deployment,
+                "prompt_tokens": usage.get("prompt_tokens", 0),
+                "completion_tokens": usage.get("completion_tokens", 0),
+                **({"estimated": True} if usage.get("estimated") else {})
+            })
+
+    def durations(self):
+        # Total time per span name, spans that ran in parallel are added up
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                totals[span["name"]] = totals.get(span["name"], 0) + span["duration_ms"]
+        return totals
+
+    def summary(self):
+        with self._lock:
+            spans = list(self.spans)
+            usage = list(self.usage)
+        return {
+            "name": self.name,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "spans": spans,
+            "usage": usage,
+            "prompt_tokens": sum(u["prompt_tokens"] for u in usage),
+            "completion_tokens": sum(u["completion_tokens"] for u in usage),
+        }
+
+    def server_timing(self):
+        return ", ".join(f"{name.replace(' ', '_')};dur={duration:.1f}" for name, duration in self.durations().items())
+
+
+@contextmanager
+def trace(name):
+    # Everything timed inside the block goes to one Trace, nested blocks join the outer one
+    existing = _current.get()
+    if existing is not None:
+        yield existing
+        return
+    new_trace = Trace(name)
+    token = _current.set(new_trace)
+    try:
+        yield new_trace
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    trace = _current.get()
+    start_time = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        if trace is not None:
+            trace.add_span(name, start_time, time.perf_counter() - start_time, attributes)
+
+
+def summary():
+    trace = _current.get()
+    return None if trace is None else trace.summary()
+
+
+def record_usage(stage, deployment, usage):
+    trace = _current.get()
+    if trace is not None and usage:
+        trace.add_usage(stage, deployment, usage)
+
+
+def wrap(fn):
+    # Threads don't inherit context variables, run fn in a copy of the caller's context
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+_lock = threading.Lock()
+_logger = None
+
+
+def get_logger():
+    global _logger
+    if _logger is None:
+        with _lock:
+            if _logger is None:
+                logger = logging.getLogger("pipeline.telemetry")
+                if TELEMETRY_EXPORTER and APPLICATIONINSIGHTS_CONNECTION_STRING:
+                    try:
+                        from opencensus.ext.azure.log_exporter import AzureLogHandler
+
+                        logger.addHandler(AzureLogHandler(connection_string=APPLICATIONINSIGHTS_CONNECTION_STRING))
+                        # The host would send the same line again, without the dimensions
+                        logger.propagate = False
+                    except Exception as e:
+                        logging.warning(f"Pipeline telemetry goes to the function log only, the Application Insights exporter failed: {e}")
+                _logger = logger
+    return _logger
+
+
+def log(trace):
+    summary = trace.summary()
+    # custom_dimensions end up as customDimensions in Application Insights, see TELEMETRY_EXPORTER
+    get_logger().info(f"Pipeline telemetry {json.dumps(summary)}", extra={"custom_dimensions": {
+        "name": summary["name"],
+        "total_ms": summary["total_ms"],
+        "prompt_tokens": summary["prompt_tokens"],
+        "completion_tokens": summary["completion_tokens"],
+        **{f"{name}_ms": duration for name, duration in trace.durations().items()},
+    }})
+    return summary
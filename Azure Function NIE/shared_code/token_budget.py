@@ -0,0 +1,153 @@
+import os
+import threading
+
+import tiktoken
+
+# Context window of the chat deployment and the largest prompt we are willing to send.
+# The prompt always leaves room for max_tokens of completion inside the window. Nothing is
+# trimmed unless one of them is set, a guessed window would cut prompts the model accepts.
+CHAT_CONTEXT_WINDOW = int(os.environ.get("CHAT_CONTEXT_WINDOW") or 0) or None
+TOKEN_BUDGET = int(os.environ.get("TOKEN_BUDGET") or 0) or None
+
+# What to give up, in this order, until the prompt fits:
+#   sources  - drop the SOURCES block of the oldest user turns
+#   condense - cut the oldest assistant answers down to CONDENSED_TURN_TOKENS
+#   turns    - drop the oldest user/assistant turns
+TOKEN_BUDGET_POLICY = [p.strip() for p in (os.environ.get("TOKEN_BUDGET_POLICY") or "sources,condense,turns").split(",") if p.strip()]
+CONDENSED_TURN_TOKENS = int(os.environ.get("CONDENSED_TURN_TOKENS") or 150)
+
+SOURCES_MARKER = " \nSOURCES:\n"
+SOURCES_OMITTED = "(sources omitted)"
+# How shared_code/context.py points back to a chunk pasted in an earlier turn, and what that
+# line becomes once the earlier turn lost its sources
+SAME_SOURCE = ": (same source as above)"
+SOURCE_OMITTED = ": (source omitted)"
+
+
+def get_encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Azure deployment names are not model names, every chat model uses cl100k_base
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class TokenBudget:
+    def __init__(self, model="gpt-4", context_window=CHAT_CONTEXT_WINDOW, budget=TOKEN_BUDGET, policy=TOKEN_BUDGET_POLICY):
+        self.encoding = get_encoding(model)
+        self.context_window = context_window
+        self.budget = budget
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def count_text(self, text):
+        return len(self.encoding.encode(text))
+
+    def count_message(self, message):
+        # Messages are counted once and remembered, the history only ever grows by a few turns
+        key = tuple(sorted(message.items()))
+        with self._lock:
+            if key in self._counts:
+                return self._counts[key]
+        num_tokens = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        for k, value in message.items():
+            num_tokens += self.count_text(value)
+            if k == "name":  # if there's a name, the role is omitted
+                num_tokens += -1  # role is always required and always 1 token
+        with self._lock:
+            if len(self._counts) > 4096:
+                self._counts.clear()
+            self._counts[key] = num_tokens
+        return num_tokens
+
+    def count(self, messages):
+        return sum(self.count_message(m) for m in messages) + 2  # every reply is primed with <im_start>assistant
+
+    def limit(self, max_response_tokens):
+        limits = [self.context_window - max_response_tokens] if self.context_window else []
+        if self.budget:
+            limits.append(self.budget)
+        return min(limits) if limits else None
+
+    def fit(self, messages, max_response_tokens):
+        # Returns a copy of messages that fits the budget. The first system message and the
+        # latest message are always kept, only their references to dropped sources change.
+        limit = self.limit(max_response_tokens)
+        messages = [dict(m) for m in messages]
+        if limit is None:
+            return messages
+        total = self.count(messages)
+        for step in self.policy:
+            if total <= limit:
+                break
+            if step == "sources":
+                total = self._drop_sources(messages, total, limit)
+            elif step == "condense":
+                total = self._condense(messages, total, limit)
+            elif step == "turns":
+                messages, total = self._drop_turns(messages, total, limit)
+        return messages
+
+    def _replace(self, messages, i, content):
+        before = self.count_message(messages[i])
+        messages[i]["content"] = content
+        return self.count_message(messages[i]) - before
+
+    def _drop_sources(self, messages, total, limit):
+        # Sources that a later turn points back to go last, and that turn then says they were omitted
+        for keep_referenced in (True, False):
+            for i in range(1, len(messages) - 1):
+                if total <= limit:
+                    return total
+                content = messages[i]["content"]
+                if messages[i]["role"] != "user" or SOURCES_MARKER not in content or content.endswith(SOURCES_MARKER + SOURCES_OMITTED):
+                    continue
+                referenced = self._referenced(messages, i)
+                if referenced and keep_referenced:
+                    continue
+                question = content.split(SOURCES_MARKER, 1)[0]
+                total += self._replace(messages, i, question + SOURCES_MARKER + SOURCES_OMITTED)
+                total += self._omit_references(messages, i, referenced)
+        return total
+
+    def _referenced(self, messages, i):
+        # Sourcepages pasted in message i that later messages refer to as "(same source as above)"
+        content = messages[i]["content"]
+        if messages[i]["role"] != "user" or SOURCES_MARKER not in content:
+            return set()
+        references = set()
+        for message in messages[i + 1:]:
+            if message["role"] == "user" and SOURCES_MARKER in message["content"]:
+                references.update(line[:-len(SAME_SOURCE)] for line in message["content"].split(SOURCES_MARKER, 1)[1].split("\n") if line.endswith(SAME_SOURCE))
+        lines = content.split(SOURCES_MARKER, 1)[1].split("\n")
+        return {page for page in references if any(line.startswith(page + ": ") and line != page + SAME_SOURCE for line in lines)}
+
+    def _omit_references(self, messages, i, pages):
+        change = 0
+        for j in range(i + 1, len(messages)):
+            content = messages[j]["content"]
+            if not pages or messages[j]["role"] != "user" or SOURCES_MARKER not in content:
+                continue
+            question, sources = content.split(SOURCES_MARKER, 1)
+            lines = [line[:-len(SAME_SOURCE)] + SOURCE_OMITTED if line.endswith(SAME_SOURCE) and line[:-len(SAME_SOURCE)] in pages else line for line in sources.split("\n")]
+            if lines != sources.split("\n"):
+                change += self._replace(messages, j, question + SOURCES_MARKER + "\n".join(lines))
+        return change
+
+    def _condense(self, messages, total, limit):
+        for i in range(1, len(messages) - 1):
+            if total <= limit:
+                break
+            if messages[i]["role"] == "assistant":
+                tokens = self.encoding.encode(messages[i]["content"])
+                if len(tokens) > CONDENSED_TURN_TOKENS:
+                    total += self._replace(messages, i, self.encoding.decode(tokens[:CONDENSED_TURN_TOKENS]) + " ...")
+        return total
+
+    def _drop_turns(self, messages, total, limit):
+        while total > limit and len(messages) > 2:
+            total += self._omit_references(messages, 1, self._referenced(messages, 1))
+            total -= self.count_message(messages[1])
+            del messages[1]
+        return messages, total
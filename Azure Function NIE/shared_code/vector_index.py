@@ -0,0 +1,325 @@
+import contextlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+
+# A local copy of the search corpus: memory-mapped float32 matrices of normalized section
+# embeddings plus a JSON file with the id and metadata of every row. Upload_files keeps it in sync
+# and the chat functions copy the search index into it when it doesn't match, see sync().
+# The index is a list of segments, each a directory with one matrix that is never changed. An
+# upsert adds a segment and a delete only records the ids that are gone, the "current" file lists
+# the segments and is switched in one step, so readers always see matrices and metadata that
+# belong together. When there are too many segments or deleted rows they are merged into one.
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR") or os.path.join(os.environ.get("HOME") or tempfile.gettempdir(), "data", "vector_index")
+# "exact" scores every row, "ivf" only scores the rows in the VECTOR_INDEX_NPROBE closest clusters
+VECTOR_INDEX_MODE = os.environ.get("VECTOR_INDEX_MODE") or "exact"
+VECTOR_INDEX_NLIST = int(os.environ.get("VECTOR_INDEX_NLIST") or 64)
+VECTOR_INDEX_NPROBE = int(os.environ.get("VECTOR_INDEX_NPROBE") or 8)
+# A write lock older than this many seconds was left by a writer that died and is taken over
+VECTOR_INDEX_LOCK_TIMEOUT = float(os.environ.get("VECTOR_INDEX_LOCK_TIMEOUT") or 60)
+VECTOR_INDEX_MAX_SEGMENTS = int(os.environ.get("VECTOR_INDEX_MAX_SEGMENTS") or 8)
+
+METADATA_FIELDS = ["id", "content", "category", "sourcepage", "sourcefile"]
+
+
+class EmptyIndexError(Exception):
+    pass
+
+
+def kmeans(vectors, k, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(k):
+            members = vectors[assignments == c]
+            if len(members):
+                centroid = members.mean(axis=0)
+                norm = np.linalg.norm(centroid)
+                centroids[c] = centroid / norm if norm else centroid
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+
+class VectorIndex:
+    def __init__(self, directory=VECTOR_INDEX_DIR, mode=VECTOR_INDEX_MODE):
+        self.directory = directory
+        self.mode = mode
+        self._lock = threading.Lock()
+        # [{"name", "vectors", "rows", "deleted", "alive", "offset"}], offset is where the alive
+        # rows of the segment start in _metadata
+        self._segments = []
+        self._metadata = []
+        self._centroids = None
+        self._lists = None
+        self._loaded = None
+        self.load()
+
+    @property
+    def pointer_path(self):
+        return os.path.join(self.directory, "current")
+
+    @property
+    def lock_path(self):
+        return os.path.join(self.directory, "write.lock")
+
+    def __len__(self):
+        return len(self._metadata)
+
+    def _current(self):
+        # The contents of the pointer, None when there is no index yet. Before segments it held the
+        # name of a single version directory, and before versions there was no pointer and the
+        # files were in the directory itself.
+        try:
+            with open(self.pointer_path) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return "." if os.path.exists(os.path.join(self.directory, "metadata.json")) else None
+
+    @staticmethod
+    def _manifest(current):
+        if current is None:
+            return {"segments": []}
+        if current.startswith("{"):
+            return json.loads(current)
+        return {"segments": [{"name": current, "deleted": []}]}
+
+    def _read_segment(self, name):
+        path = os.path.join(self.directory, name)
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+        rows = metadata["rows"]
+        vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r", shape=(len(rows), metadata["dimensions"])) if rows else None
+        return vectors, rows
+
+    def load(self):
+        current = self._current()
+        segments = []
+        metadata = []
+        for entry in self._manifest(current)["segments"]:
+            vectors, rows = self._read_segment(entry["name"])
+            deleted = set(entry["deleted"])
+            alive = np.array([i for i, row in enumerate(rows) if row["id"] not in deleted], dtype=np.int64)
+            segments.append({"name": entry["name"], "vectors": vectors, "rows": rows, "deleted": entry["deleted"], "alive": alive, "offset": len(metadata)})
+            metadata.extend(rows[i] for i in alive)
+        with self._lock:
+            self._segments = segments
+            self._metadata = metadata
+            self._loaded = current
+            self._build_ivf()
+        logging.info(f"Loaded {len(metadata)} sections in {len(segments)} segments into the local vector index")
+
+    def _alive_vectors(self, segments):
+        parts = [np.asarray(s["vectors"])[s["alive"]] for s in segments if len(s["alive"])]
+        return np.vstack(parts) if parts else None
+
+    def _build_ivf(self):
+        self._centroids = None
+        self._lists = None
+        if self.mode != "ivf" or len(self._metadata) < VECTOR_INDEX_NLIST * 4:
+            return
+        self._centroids, assignments = kmeans(self._alive_vectors(self._segments), VECTOR_INDEX_NLIST)
+        self._lists = [np.flatnonzero(assignments == c) for c in range(VECTOR_INDEX_NLIST)]
+
+    @contextlib.contextmanager
+    def _write_lock(self):
+        # One writer at a time across threads, processes and instances. The lock file is created
+        # with O_EXCL, which also holds on the SMB share of HOME where flock is not seen by other instances.
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    stale = time.time() - os.path.getmtime(self.lock_path) > VECTOR_INDEX_LOCK_TIMEOUT
+                except FileNotFoundError:
+                    continue
+                if stale:
+                    logging.warning(f"Taking over the vector index lock {self.lock_path} left by a writer that stopped")
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self.lock_path)
+                    continue
+                time.sleep(0.05)
+        try:
+            os.write(fd, str(os.getpid()).encode())
+            os.close(fd)
+            yield
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.lock_path)
+
+    def _write_segment(self, vectors, rows):
+        name = f"v-{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        path = os.path.join(self.directory, name)
+        os.makedirs(path)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with open(os.path.join(path, "vectors.f32"), "wb") as f:
+            f.write(vectors.tobytes())
+        with open(os.path.join(path, "metadata.json"), "w") as f:
+            json.dump({"dimensions": vectors.shape[1] if len(rows) else 0, "rows": rows}, f)
+        return name
+
+    def _publish(self, segments):
+        # segments: [{"name", "deleted"}] of the new index. Merged into one segment when there are
+        # too many or when more rows are deleted than alive, then the pointer is swapped to it.
+        total = sum(len(self._segment_rows(s)) for s in segments)
+        deleted = sum(len(s["deleted"]) for s in segments)
+        if len(segments) > VECTOR_INDEX_MAX_SEGMENTS or deleted * 2 > total:
+            segments = self._compact(segments)
+        previous = self._manifest(self._current())
+        with open(self.pointer_path + ".tmp", "w") as f:
+            json.dump({"version": uuid.uuid4().hex, "segments": segments}, f)
+        os.replace(self.pointer_path + ".tmp", self.pointer_path)
+        # The segments of the index before stay for readers that are still loading it
+        keep = {s["name"] for s in segments + previous["segments"]}
+        for entry in os.listdir(self.directory):
+            if entry.startswith("v-") and entry not in keep:
+                shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+
+    def _segment_rows(self, entry):
+        loaded = next((s for s in self._segments if s["name"] == entry["name"]), None)
+        return loaded["rows"] if loaded else self._read_segment(entry["name"])[1]
+
+    def _compact(self, segments):
+        vectors = []
+        rows = []
+        for entry in segments:
+            segment_vectors, segment_rows = self._read_segment(entry["name"])
+            deleted = set(entry["deleted"])
+            alive = [i for i, row in enumerate(segment_rows) if row["id"] not in deleted]
+            if alive:
+                vectors.append(np.asarray(segment_vectors)[alive])
+                rows.extend(segment_rows[i] for i in alive)
+        if not rows:
+            return []
+        return [{"name": self._write_segment(np.vstack(vectors), rows), "deleted": []}]
+
+    def _without(self, matches):
+        # The segments of the loaded index with the alive rows that match marked deleted
+        return [{
+            "name": s["name"],
+            "deleted": s["deleted"] + [s["rows"][i]["id"] for i in s["alive"] if matches(s["rows"][i])],
+        } for s in self._segments]
+
+    @staticmethod
+    def _prepare(sections):
+        # Sections as produced by create_sections in Upload_files, with their "embedding"
+        sections = [s for s in sections if s.get("embedding")]
+        vectors = np.array([s["embedding"] for s in sections], dtype=np.float32)
+        if len(sections):
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.where(norms == 0, 1, norms)
+        return vectors, [{field: s.get(field) for field in METADATA_FIELDS} for s in sections]
+
+    def upsert(self, sections):
+        vectors, rows = self._prepare(sections)
+        if not rows:
+            return
+        ids = {row["id"] for row in rows}
+        with self._write_lock():
+            # What another writer added since this worker last loaded the index is kept
+            self.refresh()
+            segments = self._without(lambda row: row["id"] in ids)
+            self._publish(segments + [{"name": self._write_segment(vectors, rows), "deleted": []}])
+            self.load()
+
+    def delete(self, sourcefile=None):
+        # Same semantics as remove_from_index: None removes everything
+        with self._write_lock():
+            self.refresh()
+            if sourcefile is None:
+                segments = []
+            else:
+                segments = self._without(lambda row: row["sourcefile"] == sourcefile)
+                if sum(len(s["deleted"]) for s in segments) == sum(len(s["deleted"]) for s in self._segments):
+                    return
+            self._publish(segments)
+            self.load()
+
+    def replace(self, sections):
+        # The whole index at once, what sync() copies from the search index
+        vectors, rows = self._prepare(sections)
+        with self._write_lock():
+            self._publish([{"name": self._write_segment(vectors, rows), "deleted": []}] if rows else [])
+            self.load()
+
+    def refresh(self):
+        # Another worker (or Upload_files on another instance) may have synced the files since
+        current = self._current()
+        if current != self._loaded:
+            self.load()
+
+    def _scores(self, candidates, query):
+        # candidates are positions in _metadata, each segment scores its own
+        scores = np.empty(len(candidates), dtype=np.float32)
+        for s in self._segments:
+            mask = (candidates >= s["offset"]) & (candidates < s["offset"] + len(s["alive"]))
+            if mask.any():
+                scores[mask] = np.asarray(s["vectors"][s["alive"][candidates[mask] - s["offset"]]]) @ query
+        return scores
+
+    def search(self, query_vector, top=5, exclude_category=None):
+        self.refresh()
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        query = query / norm if norm else query
+        with self._lock:
+            if not self._metadata:
+                # Answers grounded on nothing look fine and are wrong, better to fail the request
+                logging.error(f"The local vector index in {self.directory} is empty, sync it from the search index")
+                raise EmptyIndexError(f"The local vector index in {self.directory} is empty")
+            if self._centroids is not None:
+                probes = np.argsort(self._centroids @ query)[::-1][:VECTOR_INDEX_NPROBE]
+                candidates = np.concatenate([self._lists[c] for c in probes])
+            else:
+                candidates = np.arange(len(self._metadata))
+            if exclude_category:
+                candidates = np.array([i for i in candidates if self._metadata[i]["category"] != exclude_category], dtype=np.int64)
+            if len(candidates) == 0:
+                return []
+            scores = self._scores(candidates, query)
+            best = np.argsort(scores)[::-1][:top] if len(scores) <= top else np.argpartition(-scores, top)[:top]
+            best = best[np.argsort(-scores[best])]
+            return [dict(self._metadata[candidates[i]], score=float(scores[i])) for i in best]
+
+
+_lock = threading.Lock()
+_index = None
+
+
+def get_index():
+    global _index
+    if _index is None:
+        with _lock:
+            if _index is None:
+                _index = VectorIndex()
+    return _index
+
+
+def sync(search_client, page_size=1000):
+    # Copies the search index into the local index when the number of sections differs, e.g. on a
+    # new instance or after documents were indexed without Upload_files. Paged with skip, which
+    # Cognitive Search allows up to 100000 documents.
+    index = get_index()
+    count = search_client.get_document_count()
+    index.refresh()
+    if count == len(index):
+        return False
+    logging.warning(f"The local vector index has {len(index)} sections and the search index {count}, copying the search index")
+    sections = []
+    while True:
+        page = list(search_client.search("*", select=METADATA_FIELDS + ["embedding"], top=page_size, skip=len(sections)))
+        sections.extend(page)
+        if len(page) < page_size:
+            break
+    index.replace(sections)
+    if len(index) != count:
+        logging.warning(f"Copied {len(index)} of the {count} sections of the search index, the others have no embedding")
+    return True